@@ -0,0 +1,104 @@
+# Cold start benchmark: how long `import scrape` and first-use initialisation take in a fresh interpreter.
+# Import time comes from `python -X importtime`, so it can be tracked as a regression metric across commits.
+# Run from the repository root: python benchmarks/bench_cold_start.py [--runs 5] [--max-import-ms 150]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Times each first-use initialisation step in the child interpreter and prints them as JSON
+INIT_SCRIPT = '''
+import json, time
+import scrape
+timings = {}
+for name, step in (
+    ('config', scrape.get_config),
+    ('client', scrape.get_client),
+    ('regions', scrape.get_regions),
+    ('classify', lambda: scrape.classify_points([53.5461], [-113.4938])),
+):
+    start = time.perf_counter()
+    step()
+    timings[name] = (time.perf_counter() - start) * 1000
+print(json.dumps(timings))
+'''
+
+HEAVY_MODULES = ('boto3', 'botocore', 'shapely', 'numpy', 'discord_webhook', 'pytz')
+
+
+def child_env():
+    env = dict(os.environ)
+    env.setdefault('DISCORD_WEBHOOK', 'https://discord.invalid/webhook')
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    return env
+
+
+def import_profile():
+    # Returns the cumulative import time of scrape and of each module it imports directly, in ms.
+    # -X importtime lists a module's imports, indented one level deeper, just before the module itself.
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import scrape'],
+        cwd=ROOT, env=child_env(), capture_output=True, text=True, check=True
+    )
+    children = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(parts[1]) / 1000
+        except ValueError:
+            continue  # the header line
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 1:
+            children[name] = cumulative
+        elif depth == 0:
+            if name == 'scrape':
+                return cumulative, children
+            children = {}
+    raise RuntimeError('scrape was not found in the -X importtime output')
+
+
+def init_profile():
+    result = subprocess.run(
+        [sys.executable, '-c', INIT_SCRIPT],
+        cwd=ROOT, env=child_env(), capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import and first-use init time of scrape.py')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--max-import-ms', type=float, default=None,
+                        help='exit with status 1 if the median import time is above this')
+    args = parser.parse_args()
+
+    imports = [import_profile() for _ in range(args.runs)]
+    inits = [init_profile() for _ in range(args.runs)]
+
+    importMs = statistics.median(total for total, modules in imports)
+    slowest = sorted(imports[-1][1].items(), key=lambda item: item[1], reverse=True)[:args.top]
+    result = {
+        'benchmark': 'cold_start',
+        'runs': args.runs,
+        'import_ms': round(importMs, 2),
+        'heavy_modules_imported': sorted(m for m in HEAVY_MODULES if m in imports[-1][1]),
+        'slowest_imports_ms': {name: round(ms, 2) for name, ms in slowest},
+        'init_ms': {step: round(statistics.median(run[step] for run in inits), 2) for step in inits[0]},
+    }
+    print(json.dumps(result))
+    if args.max_import_ms is not None and importMs > args.max_import_ms:
+        sys.exit(f"import scrape took {importMs:.1f} ms, above the {args.max_import_ms} ms budget")
+
+
+if __name__ == '__main__':
+    main()
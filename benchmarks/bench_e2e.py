@@ -0,0 +1,309 @@
+# End-to-end benchmark: drives check_and_post_events over a synthetic feed and its churned snapshots, against
+# an in-process stub of DynamoDB and of Discord/the 511 API. Reports wall time per phase, DynamoDB and HTTP call
+# counts and peak traced memory, for the first run (everything new) and the average churn run.
+# Run from the repository root: python benchmarks/bench_e2e.py [--events 1000,10000] [--snapshots 5] [--shards 4]
+import argparse
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import ExitStack
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DISCORD_WEBHOOK', 'https://discord.invalid/webhook')
+
+import scrape
+from feedgen import FeedGenerator
+
+BENCH_CONFIG = {
+    'Thread-Edmonton': '1', 'Thread-Calgary': '2', 'Thread-NorthOfEdmonton': '3',
+    'Thread-SouthOfEdmonton': '4', 'Thread-CatchAll': '5', 'db_name': 'bench',
+    'timezone': 'US/Mountain', 'license_notice': 'Contains information licensed under the Open Government Licence – Alberta.'
+}
+# DynamoDB returns at most 1 MB per Query page
+QUERY_PAGE_BYTES = 1024 * 1024
+
+# Functions timed as phases of a run. apply includes regions and render, which are also reported on their own.
+PHASES = (
+    ('feed_state', scrape, 'load_feed_state'),
+    ('fetch_parse', scrape, 'index_feed'),
+    ('cleanup', scrape, 'cleanup_old_events'),
+    ('load_index', scrape, 'load_active_index'),
+    ('diff', scrape, 'diff_events'),
+    ('apply', scrape, 'apply_diff'),
+    ('regions', scrape, 'resolve_regions'),
+    ('render', scrape, 'render_embed'),
+    ('pack', scrape.EmbedBatcher, 'flush'),
+    ('write', scrape.WriteBatcher, 'flush'),
+    ('write', scrape.LocalWriter, 'flush'),
+    ('discord', scrape.DiscordDispatcher, 'wait'),
+)
+
+
+class StubDynamoDB:
+    # Just enough of the DynamoDB client API for DynamoDBStore, holding items as attribute values, and the
+    # table's name. Calls are counted by API name, and each takes latency seconds like a request would.
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.items = {}
+        self.calls = Counter()
+        self.meta = self  # table.meta.client
+        self.client = self
+
+    def get_item(self, Key, ConsistentRead=False, **kwargs):
+        self.request('GetItem')
+        item = self.items.get(Key['EventID']['S'])
+        return {'Item': item} if item is not None else {}
+
+    def put_item(self, Item, **kwargs):
+        self.request('PutItem')
+        self.items[Item['EventID']['S']] = Item
+
+    def query(self, IndexName, ExpressionAttributeValues, ExclusiveStartKey=None, **kwargs):
+        self.request('Query')
+        if IndexName == scrape.ACTIVE_INDEX:
+            matches = [item for item in self.items.values() if 'ActiveFlag' in item]
+        elif IndexName == scrape.OUTBOX_INDEX:
+            matches = [item for item in self.items.values() if 'OutboxFlag' in item]
+        else:
+            # InactiveFlag = :flag AND LastUpdated < :cutoff
+            cutoff = scrape.Decimal(ExpressionAttributeValues[':cutoff']['N'])
+            matches = sorted(
+                (item for item in self.items.values() if 'InactiveFlag' in item and scrape.Decimal(item['LastUpdated']['N']) < cutoff),
+                key=lambda item: scrape.Decimal(item['LastUpdated']['N'])
+            )
+        start = ExclusiveStartKey or 0
+        page, size = [], 0
+        for item in matches[start:]:
+            size += len(json.dumps(item))
+            if page and size > QUERY_PAGE_BYTES:
+                return {'Items': page, 'LastEvaluatedKey': start + len(page)}
+            page.append(item)
+        return {'Items': page}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ConditionExpression=None, **kwargs):
+        self.request('UpdateItem')
+        eventID = Key['EventID']['S']
+        if ConditionExpression == scrape.CLAIM_CONDITION:
+            from botocore.exceptions import ClientError
+            item = scrape.claim_local(
+                self.items.get(eventID), scrape.Decimal(ExpressionAttributeValues[':due']['N']),
+                scrape.Decimal(ExpressionAttributeValues[':lease']['N'])
+            )
+            if item is None:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+            self.items[eventID] = item
+            return {}
+        self.update(eventID, UpdateExpression, ExpressionAttributeValues)
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.request('BatchGetItem')
+        (name, request), = RequestItems.items()
+        keys = [key['EventID']['S'] for key in request['Keys']]
+        return {'Responses': {name: [self.items[k] for k in keys if k in self.items]}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.request('BatchWriteItem')
+        for request in next(iter(RequestItems.values())):
+            if 'PutRequest' in request:
+                item = request['PutRequest']['Item']
+                self.items[item['EventID']['S']] = item
+            else:
+                self.items.pop(request['DeleteRequest']['Key']['EventID']['S'], None)
+        return {'UnprocessedItems': {}}
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        self.request('TransactWriteItems')
+        for action in TransactItems:
+            if 'Put' in action:
+                item = action['Put']['Item']
+                self.items[item['EventID']['S']] = item
+            elif 'Delete' in action:
+                self.items.pop(action['Delete']['Key']['EventID']['S'], None)
+            else:
+                update = action['Update']
+                self.update(update['Key']['EventID']['S'], update['UpdateExpression'], update['ExpressionAttributeValues'])
+
+    def request(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def update(self, eventID, expression, values):
+        if expression == scrape.DEACTIVATE_EXPRESSION:
+            attributes = {'isActive': values[':val'], 'InactiveFlag': values[':flag'], 'ActiveFlag': None}
+        elif expression == scrape.TOUCH_EXPRESSION:
+            attributes = {'LastUpdated': values[':updated'], 'lastTouched': values[':touched']}
+        else:
+            raise ValueError(f'Unsupported update expression: {expression}')
+        self.items[eventID] = scrape.apply_local_operation(self.items.get(eventID), 'update', attributes)
+
+
+class StubResponse:
+    def __init__(self, status_code=200, body=b'', headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.body = body
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class StubHTTP:
+    # Serves the current feed snapshot and accepts Discord webhook posts, counting both. Posts take latency seconds.
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.feed = b'[]'
+        self.etag = None
+
+    def open_feed(self, headers):
+        self.calls['feed_get'] += 1
+        return StubResponse(200, self.feed, {'ETag': self.etag})
+
+    def post(self, url, json=None, params=None, timeout=None):
+        self.calls['discord_post'] += 1
+        return StubResponse(204)
+
+    def get_http_session(self, name):
+        return self
+
+
+def timed(phases, name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            phases[name] += time.perf_counter() - start
+    return wrapper
+
+
+def make_store(kind, path, latency):
+    if kind == 'dynamodb':
+        stub = StubDynamoDB(BENCH_CONFIG['db_name'], latency)
+        return stub, scrape.DynamoDBStore()
+    if kind == 'sqlite':
+        return None, scrape.SQLiteStore(path)
+    return None, scrape.MemoryStore()
+
+
+def run_snapshots(args, events, traceMemory):
+    # Runs the first snapshot and args.snapshots churned ones; returns a list of per-run measurements
+    generator = FeedGenerator(args.full_closure_ratio, args.seed)
+    snapshots = [generator.snapshot(events)] + [generator.churn(args.churn) for _ in range(args.snapshots)]
+    sqlitePath = os.path.join(args.tmp, f'bench-e2e-{os.getpid()}.db')
+    if os.path.exists(sqlitePath):
+        os.remove(sqlitePath)
+    stub, store = make_store(args.store, sqlitePath, args.latency_ms / 1000)
+    http = StubHTTP(args.latency_ms / 1000)
+    phases = Counter()
+    runs = []
+    with ExitStack() as stack:
+        stack.enter_context(patch('scrape.config', dict(BENCH_CONFIG, shards=args.shards, outbox=args.outbox)))
+        stack.enter_context(patch('scrape.store', store))
+        stack.enter_context(patch('scrape.client', stub))
+        stack.enter_context(patch('scrape.open_feed', http.open_feed))
+        stack.enter_context(patch('scrape.get_http_session', http.get_http_session))
+        stack.enter_context(patch('scrape.region_cache', scrape.RegionCache()))
+        # Keep the per-run metrics records out of the benchmark's own output
+        stack.enter_context(patch.object(scrape.RunMetrics, 'emit', lambda self: None))
+        for name, owner, attribute in PHASES:
+            stack.enter_context(patch.object(owner, attribute, timed(phases, name, getattr(owner, attribute))))
+        for i, snapshot in enumerate(snapshots):
+            http.feed = json.dumps(snapshot).encode()
+            http.etag = f'"{i}"'
+            phases.clear()
+            dbBefore = Counter(stub.calls) if stub else Counter()
+            httpBefore = Counter(http.calls)
+            if traceMemory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            scrape.check_and_post_events()
+            wall = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if traceMemory else None
+            if traceMemory:
+                tracemalloc.stop()
+            runs.append({
+                'wall_s': wall,
+                'phases_s': dict(phases),
+                'calls': {**dict((stub.calls - dbBefore) if stub else {}), **dict(http.calls - httpBefore)},
+                'peak_mb': peak / 2 ** 20 if peak is not None else None,
+            })
+        # The stored active set has to match the full closures of the last snapshot
+        expected = {event['ID'] for event in snapshots[-1] if event['IsFullClosure']}
+        if set(scrape.load_active_index()) != expected:
+            raise SystemExit('Active events in the store do not match the last snapshot')
+    if args.store == 'sqlite':
+        store.close()
+        os.remove(sqlitePath)
+    return runs
+
+
+def summarise(runs):
+    # Averages timings and call counts over the runs, and takes the highest memory peak
+    def mean(values):
+        return round(sum(values) / len(runs), 6)
+    phases = sorted({name for run in runs for name in run['phases_s']})
+    calls = sorted({name for run in runs for name in run['calls']})
+    summary = {
+        'wall_s': mean([run['wall_s'] for run in runs]),
+        'phases_s': {name: mean([run['phases_s'].get(name, 0) for run in runs]) for name in phases},
+        'calls': {name: mean([run['calls'].get(name, 0) for run in runs]) for name in calls},
+    }
+    peaks = [run['peak_mb'] for run in runs if run['peak_mb'] is not None]
+    if peaks:
+        summary['peak_mb'] = round(max(peaks), 2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end run benchmark over synthetic feeds')
+    parser.add_argument('--events', default='1000,10000', help='comma separated feed sizes')
+    parser.add_argument('--full-closure-ratio', type=float, default=0.3)
+    parser.add_argument('--churn', type=float, default=0.05, help='fraction of the feed changing between snapshots')
+    parser.add_argument('--snapshots', type=int, default=5, help='churned snapshots after the first')
+    parser.add_argument('--store', choices=('dynamodb', 'sqlite', 'memory'), default='dynamodb',
+                        help='dynamodb uses an in-process stub of the table')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='time each stubbed DynamoDB and Discord request takes')
+    parser.add_argument('--shards', type=int, default=1, help='split each run into this many EventID shards')
+    parser.add_argument('--outbox', action='store_true', help='store notifications in the outbox and deliver them from it')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--seed', type=int, default=511)
+    parser.add_argument('--tmp', default='/tmp')
+    args = parser.parse_args()
+
+    for events in (int(size) for size in args.events.split(',')):
+        runs = run_snapshots(args, events, traceMemory=False)
+        if not args.no_memory:
+            # Peak memory comes from a second, traced pass, so tracing doesn't distort the timings
+            for run, traced in zip(runs, run_snapshots(args, events, traceMemory=True)):
+                run['peak_mb'] = traced['peak_mb']
+        print(json.dumps({
+            'benchmark': 'e2e',
+            'events': events,
+            'full_closure_ratio': args.full_closure_ratio,
+            'churn': args.churn,
+            'store': args.store,
+            'shards': args.shards,
+            'outbox': args.outbox,
+            'latency_ms': args.latency_ms,
+            'first': summarise(runs[:1]),
+            'churn_runs': summarise(runs[1:]) if len(runs) > 1 else None,
+        }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Benchmark for stored event items: size and capacity of the raw feed event, the FEED_FIELDS subset and the
+# slim item schema, and the cost of serializing them through boto3's TypeSerializer vs serialize_item.
+# Run from the repository root: python benchmarks/bench_item_size.py [--events 1000]
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DISCORD_WEBHOOK', 'https://discord.invalid/webhook')
+
+import scrape
+
+
+def synthetic_events(count, seed=511):
+    # Events with every field the 511 feed returns
+    rng = random.Random(seed)
+    events = []
+    for i in range(count):
+        start = 1735000000 + rng.randrange(10 ** 6)
+        events.append({
+            'ID': f'ABTMC-{100000 + i}', 'Organization': 'ABTMC', 'RoadwayName': f'Highway {rng.randrange(1, 100)}',
+            'DirectionOfTravel': rng.choice(['Northbound', 'Southbound', 'Both Directions']),
+            'Description': 'Road closed between two interchanges due to a collision. Use an alternate route. ' * rng.randrange(1, 3),
+            'Reported': start, 'LastUpdated': start + rng.randrange(3600), 'StartDate': start,
+            'PlannedEndDate': rng.choice([None, start + 86400]), 'LanesAffected': 'All Lanes Closed',
+            'Latitude': round(rng.uniform(49, 60), 6), 'Longitude': round(rng.uniform(-120, -110), 6),
+            'LatitudeSecondary': round(rng.uniform(49, 60), 6), 'LongitudeSecondary': round(rng.uniform(-120, -110), 6),
+            'EventType': 'closures', 'IsFullClosure': True, 'Comment': rng.choice(['', 'Detour in place']),
+            'Recurrence': '', 'RecurrenceSchedules': '', 'EventSubType': 'Collision', 'EncodedPolyline': 'a' * rng.randrange(40, 200),
+            'LinkId': str(rng.randrange(10 ** 9)),
+        })
+    return events
+
+
+def stored_fields(event, region):
+    # What the table held per event before: the event itself plus the managed attributes
+    item = dict(event, EventID=str(event['ID']), lastTouched=1735000000, DetectedPolygon=region)
+    return scrape.set_active_flags(item, True)
+
+
+def attribute_size(value):
+    # DynamoDB's item size accounting for an AttributeValue
+    (kind, inner), = value.items()
+    if kind == 'S':
+        return len(inner.encode('utf-8'))
+    if kind == 'N':
+        digits = inner.lstrip('-').split('E')[0].split('e')[0].replace('.', '').strip('0') or '0'
+        return math.ceil(len(digits) / 2) + 1
+    if kind in ('BOOL', 'NULL'):
+        return 1
+    if kind == 'M':
+        return 3 + sum(len(k.encode('utf-8')) + attribute_size(v) + 1 for k, v in inner.items())
+    if kind == 'L':
+        return 3 + sum(attribute_size(v) + 1 for v in inner)
+    raise ValueError(kind)
+
+
+def item_size(serialized):
+    return sum(len(name.encode('utf-8')) + attribute_size(value) for name, value in serialized.items())
+
+
+def capacity(sizes):
+    # WCU to put every item, and RCU for an eventually consistent read of them all, 1 MB query pages apart
+    wcu = sum(math.ceil(size / 1024) for size in sizes)
+    rcu = 0
+    page = 0
+    for size in sizes:
+        if page + size > 1024 * 1024:
+            rcu += math.ceil(page / 4096) / 2
+            page = 0
+        page += size
+    rcu += math.ceil(page / 4096) / 2
+    return wcu, rcu
+
+
+def per_item_us(func, items, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        timings.append(time.perf_counter() - start)
+    return min(timings) / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare stored item size and serialization cost')
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    from boto3.dynamodb.types import TypeSerializer
+    serializer = TypeSerializer()
+
+    events = synthetic_events(args.events)
+    scrape.utc_timestamp = 1735000000
+    layouts = {
+        'raw_event': [stored_fields(event, 'Edmonton') for event in events],
+        'feed_fields': [stored_fields({k: e[k] for k in scrape.FEED_FIELDS if k in e}, 'Edmonton') for e in events],
+        'slim': [scrape.build_item(event, 'Edmonton') for event in events],
+    }
+    result = {'benchmark': 'item_size', 'events': args.events}
+    for name, items in layouts.items():
+        sizes = [item_size(scrape.serialize_item(item)) for item in items]
+        wcu, rcu = capacity(sizes)
+        result[f'{name}_avg_bytes'] = round(sum(sizes) / len(sizes), 1)
+        result[f'{name}_put_wcu'] = wcu
+        result[f'{name}_read_rcu'] = rcu
+
+    def type_serializer(item):
+        # The old write path: Decimal(str(x)) for every float, then boto3's TypeSerializer
+        item = scrape.float_to_decimal(dict(item))
+        return {key: serializer.serialize(value) for key, value in item.items()}
+
+    slim = layouts['slim']
+    if [type_serializer(item) for item in slim] != [scrape.serialize_item(item) for item in slim]:
+        raise SystemExit('serialize_item does not match the TypeSerializer output')
+    result['type_serializer_us'] = round(per_item_us(type_serializer, slim, args.repeat), 2)
+    result['serialize_item_us'] = round(per_item_us(scrape.serialize_item, slim, args.repeat), 2)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Benchmark for region classification: the old per-point path vs the batch classifier.
+# Run from the repository root: python benchmarks/bench_polygons.py [--points 10000]
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DISCORD_WEBHOOK', 'https://discord.invalid/webhook')
+
+from shapely.geometry import Point, Polygon
+
+import scrape
+
+# Rough bounding box of Alberta, (lat, lon)
+ALBERTA_BOUNDS = ((49.0, 60.0), (-120.0, -110.0))
+
+
+def synthetic_points(count, seed=511):
+    # Uniform points over Alberta, with a third clustered around Edmonton and Calgary like the real feed
+    rng = random.Random(seed)
+    (minLat, maxLat), (minLon, maxLon) = ALBERTA_BOUNDS
+    centres = [(53.5461, -113.4938), (51.0447, -114.0719)]
+    points = []
+    for i in range(count):
+        if i % 3 == 0:
+            lat, lon = rng.choice(centres)
+            points.append((lat + rng.gauss(0, 0.3), lon + rng.gauss(0, 0.3)))
+        else:
+            points.append((rng.uniform(minLat, maxLat), rng.uniform(minLon, maxLon)))
+    return points
+
+
+def per_point(points):
+    # The classification path as it was before batching: unprepared polygons, one Point at a time
+    regions = [(name, Polygon(polygon.exterior.coords)) for name, polygon in scrape.get_regions()]
+    labels = []
+    for lat, lon in points:
+        point = Point(lat, lon)
+        for name, polygon in regions:
+            if polygon.contains(point):
+                labels.append(name)
+                break
+        else:
+            labels.append('Other')
+    return labels
+
+
+def batch(points):
+    return scrape.classify_points([p[0] for p in points], [p[1] for p in points])
+
+
+def best_of(func, points, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(points)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-point and batch region classification')
+    parser.add_argument('--points', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    points = synthetic_points(args.points)
+    perPointTime, expected = best_of(per_point, points, args.repeat)
+    batchTime, labels = best_of(batch, points, args.repeat)
+    if labels != expected:
+        raise SystemExit('Batch classification does not match the per-point path')
+
+    print(json.dumps({
+        'benchmark': 'polygons',
+        'points': args.points,
+        'per_point_s': round(perPointTime, 6),
+        'batch_s': round(batchTime, 6),
+        'speedup': round(perPointTime / batchTime, 1),
+    }))
+
+
+if __name__ == '__main__':
+    main()
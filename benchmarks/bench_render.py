@@ -0,0 +1,124 @@
+# Benchmark for Discord embed rendering: per-event cost of the template renderer, with the old
+# DiscordEmbed path for comparison when discord_webhook is installed.
+# Run from the repository root: python benchmarks/bench_render.py [--events 2000]
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DISCORD_WEBHOOK', 'https://discord.invalid/webhook')
+
+import scrape
+
+BENCH_CONFIG = {
+    'Thread-Edmonton': '1', 'Thread-Calgary': '2', 'Thread-NorthOfEdmonton': '3',
+    'Thread-SouthOfEdmonton': '4', 'Thread-CatchAll': '5',
+    'timezone': 'US/Mountain', 'license_notice': 'Contains information licensed under the Open Government Licence – Alberta.'
+}
+KINDS = ('closure', 'updated', 'completed')
+
+
+def synthetic_events(count, seed=511):
+    # Feed-shaped events; start and end times repeat across events the way they do in the real feed
+    rng = random.Random(seed)
+    times = [1735000000 + 900 * rng.randrange(2000) for _ in range(count // 4 + 1)]
+    events = []
+    for i in range(count):
+        events.append({
+            'ID': f'AB--{i}', 'EventID': f'AB--{i}',
+            'RoadwayName': f'Highway {rng.randrange(1, 100)}',
+            'DirectionOfTravel': rng.choice(['Northbound', 'Southbound', 'Both Directions']),
+            'Description': 'Lane closure between two interchanges. Expect delays. ' * rng.randrange(1, 4),
+            'StartDate': rng.choice(times), 'LastUpdated': rng.choice(times), 'lastTouched': rng.choice(times),
+            'PlannedEndDate': rng.choice(times + [None]),
+            'Comment': rng.choice(['', None, 'Lanes reopening shortly']),
+            'Latitude': round(rng.uniform(49, 60), 6), 'Longitude': round(rng.uniform(-120, -110), 6),
+            'EventType': rng.choice(['closures', 'accidentsAndIncidents', 'roadwork'])
+        })
+    return events
+
+
+def legacy_render(kind, event):
+    # The rendering path before templates: a DiscordEmbed per event and a pytz lookup per time field
+    from discord_webhook import DiscordEmbed
+    from pytz import timezone
+
+    def readable(unix_timestamp):
+        utc_time = datetime.utcfromtimestamp(int(unix_timestamp))
+        local_tz = timezone(BENCH_CONFIG['timezone'])
+        return utc_time.replace(tzinfo=timezone('UTC')).astimezone(local_tz).strftime('%Y-%b-%d %I:%M %p')
+
+    urlType = 'Incidents' if event['EventType'] == 'accidentsAndIncidents' else 'Closures'
+    urlWME = f"https://www.waze.com/en-GB/editor?env=usa&lon={event['Longitude']}&lat={event['Latitude']}&zoomLevel=15"
+    url511 = f"https://511.alberta.ca/map#{urlType}-{event['ID']}"
+    urlLivemap = f"https://www.waze.com/live-map/directions?dir_first=no&latlng={event['Latitude']}%2C{event['Longitude']}&overlay=false&zoom=16"
+    title, color = {'closure': ('Closed', 15548997), 'updated': ('Closure Update', 'ff9a00'), 'completed': ('Cleared', '34e718')}[kind]
+    embed = DiscordEmbed(title=title, color=color)
+    embed.add_embed_field(name="Road", value=event['RoadwayName'])
+    embed.add_embed_field(name="Direction", value=event['DirectionOfTravel'])
+    embed.add_embed_field(name="Information", value=event['Description'], inline=False)
+    embed.add_embed_field(name="Start Time", value=readable(event['StartDate']))
+    if kind == 'completed':
+        embed.add_embed_field(name="Ended", value=readable(event['lastTouched']))
+        embed.add_embed_field(name="Links", value=f"[WME]({urlWME}) | [Livemap]({urlLivemap})", inline=False)
+        embed.set_timestamp(datetime.utcfromtimestamp(int(event['lastTouched'])))
+    else:
+        if event['PlannedEndDate'] is not None:
+            embed.add_embed_field(name="Planned End Time", value=readable(event['PlannedEndDate']))
+        if kind == 'updated' and event['Comment'] is not None:
+            embed.add_embed_field(name="Comment", value=event['Comment'], inline=False)
+        embed.add_embed_field(name="Links", value=f"[511]({url511}) | [WME]({urlWME}) | [Livemap]({urlLivemap})", inline=False)
+        embed.set_timestamp(datetime.utcfromtimestamp(int(event['StartDate' if kind == 'closure' else 'LastUpdated'])))
+    embed.set_footer(text=BENCH_CONFIG['license_notice'])
+    return embed.__dict__
+
+
+def template_render(kind, event):
+    overrides = {'Ended': event['lastTouched']} if kind == 'completed' else None
+    return scrape.render_embed(kind, event, overrides)[0]
+
+
+def per_event_us(render, events, repeat):
+    # Best of repeat, in microseconds per rendered embed
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i, event in enumerate(events):
+            render(KINDS[i % 3], event)
+        timings.append(time.perf_counter() - start)
+    return min(timings) / len(events) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure per-event Discord embed render cost')
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    events = synthetic_events(args.events)
+    result = {'benchmark': 'render', 'events': args.events}
+    with patch('scrape.config', BENCH_CONFIG):
+        scrape.format_local_time.cache_clear()
+        scrape.embed_timestamp.cache_clear()
+        result['template_cold_us'] = round(per_event_us(template_render, events, 1), 2)
+        result['template_us'] = round(per_event_us(template_render, events, args.repeat), 2)
+        try:
+            import discord_webhook  # noqa: F401
+        except ImportError:
+            pass
+        else:
+            for i, event in enumerate(events):
+                if legacy_render(KINDS[i % 3], event) != template_render(KINDS[i % 3], event):
+                    raise SystemExit('Template rendering does not match the DiscordEmbed path')
+            result['legacy_us'] = round(per_event_us(legacy_render, events, args.repeat), 2)
+            result['speedup'] = round(result['legacy_us'] / result['template_us'], 1)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
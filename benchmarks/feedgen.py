@@ -0,0 +1,117 @@
+# Synthetic Alberta 511 feeds for benchmarks: a first snapshot of any size, then snapshots that churn from it.
+# Importable from the other benchmark scripts, or run on its own to write a feed as JSON:
+#   python benchmarks/feedgen.py --events 10000 --full-closure-ratio 0.3 > feed.json
+import argparse
+import json
+import random
+import sys
+
+# Population centres events cluster around, as (lat, lon, spread in degrees, share of events)
+CENTRES = (
+    (53.5461, -113.4938, 0.25, 0.3),  # Edmonton
+    (51.0447, -114.0719, 0.25, 0.3),  # Calgary
+)
+# Rough bounding box of Alberta, (lat, lon)
+ALBERTA_BOUNDS = ((49.0, 60.0), (-120.0, -110.0))
+ROADS = ['Highway 2', 'Highway 16', 'Highway 43', 'Anthony Henday Drive', 'Stoney Trail', 'Deerfoot Trail',
+         'Highway 1', 'Highway 63', 'Highway 3', 'Whitemud Drive']
+DIRECTIONS = ['Northbound', 'Southbound', 'Eastbound', 'Westbound', 'Both Directions']
+EVENT_TYPES = ['closures', 'accidentsAndIncidents', 'roadwork', 'specialEvents']
+DESCRIPTIONS = [
+    'Road closed due to a collision. Use an alternate route.',
+    'Bridge maintenance. All lanes closed between the interchanges.',
+    'Flooding on the roadway. Road closed until further notice.',
+    'Paving operations. Expect delays and lane closures.',
+]
+COMMENTS = ['', '', 'Detour in place', 'Emergency crews on scene', 'Reopening expected this evening']
+START_TIME = 1735000000
+
+
+class FeedGenerator:
+    # Keeps the current snapshot and hands out new event IDs, so churned snapshots stay consistent
+    def __init__(self, fullClosureRatio=0.3, seed=511):
+        self.rng = random.Random(seed)
+        self.fullClosureRatio = fullClosureRatio
+        self.nextID = 100000
+        self.now = START_TIME
+        self.events = []
+
+    def event(self):
+        rng = self.rng
+        self.nextID += 1
+        roll = rng.random()
+        for lat, lon, spread, share in CENTRES:
+            if roll < share:
+                lat, lon = lat + rng.gauss(0, spread), lon + rng.gauss(0, spread)
+                break
+            roll -= share
+        else:
+            (minLat, maxLat), (minLon, maxLon) = ALBERTA_BOUNDS
+            lat, lon = rng.uniform(minLat, maxLat), rng.uniform(minLon, maxLon)
+        start = self.now - rng.randrange(7 * 86400)
+        return {
+            'ID': f'ABTMC-{self.nextID}',
+            'Organization': 'ABTMC',
+            'RoadwayName': rng.choice(ROADS),
+            'DirectionOfTravel': rng.choice(DIRECTIONS),
+            'Description': rng.choice(DESCRIPTIONS),
+            'Reported': start,
+            'LastUpdated': start + rng.randrange(3600),
+            'StartDate': start,
+            'PlannedEndDate': rng.choice([None, start + 86400 * rng.randrange(1, 30)]),
+            'LanesAffected': 'All Lanes Closed',
+            'Latitude': round(lat, 6),
+            'Longitude': round(lon, 6),
+            'LatitudeSecondary': 0.0,
+            'LongitudeSecondary': 0.0,
+            'EventType': rng.choice(EVENT_TYPES),
+            'IsFullClosure': rng.random() < self.fullClosureRatio,
+            'Comment': rng.choice(COMMENTS),
+            'Recurrence': '',
+            'RecurrenceSchedules': '',
+            'EncodedPolyline': ''.join(rng.choice('abcdefghij_~') for _ in range(rng.randrange(20, 120))),
+            'LinkId': str(rng.randrange(10 ** 9)),
+        }
+
+    def snapshot(self, count):
+        # A fresh feed of count events
+        self.events = [self.event() for _ in range(count)]
+        return self.events
+
+    def churn(self, rate, seconds=60):
+        # The next snapshot, seconds later: a third of rate is removed and replaced with new events, a third has
+        # LastUpdated bumped (half of those with a visible change too), and a tenth flips IsFullClosure
+        rng = self.rng
+        self.now += seconds
+        events = [dict(event) for event in self.events]
+        changes = max(1, int(len(events) * rate / 3)) if events else 0
+        for index in sorted(rng.sample(range(len(events)), min(changes, len(events))), reverse=True):
+            del events[index]
+        events.extend(self.event() for _ in range(changes))
+        for event in rng.sample(events, min(changes, len(events))):
+            event['LastUpdated'] = self.now
+            if rng.random() < 0.5:
+                event['Comment'] = rng.choice(COMMENTS[2:]) + f' ({self.now})'
+        for event in rng.sample(events, min(max(1, changes // 3), len(events))):
+            event['IsFullClosure'] = not event['IsFullClosure']
+        self.events = events
+        return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic Alberta 511 feed as JSON')
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--full-closure-ratio', type=float, default=0.3)
+    parser.add_argument('--churn', type=float, default=0.0, help='churn the feed once by this fraction before writing')
+    parser.add_argument('--seed', type=int, default=511)
+    args = parser.parse_args()
+
+    generator = FeedGenerator(args.full_closure_ratio, args.seed)
+    events = generator.snapshot(args.events)
+    if args.churn:
+        events = generator.churn(args.churn)
+    json.dump(events, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
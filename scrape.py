@@ -1,19 +1,26 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import time
-import boto3
-from boto3.dynamodb.conditions import Attr
-from boto3.dynamodb.conditions import Key
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError
-from shapely.geometry import Point, Polygon
 from decimal import Decimal
-from discord_webhook import DiscordWebhook, DiscordEmbed
 import os
+import sys
 from datetime import datetime, timedelta, date
 import calendar
-from pytz import timezone
+import codecs
+import hashlib
+import math
 import logging
 import random
+import functools
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import contextvars
+import zlib
 
 logging.basicConfig(
     level=logging.INFO,
@@ -26,300 +33,399 @@ logging.basicConfig(
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-polygon_Edmonton = Polygon([
-   (53.24836842, -113.18427309),
-    (53.22671673, -113.56849409),
-    (53.23791725, -113.69823105),
-    (53.31474832, -113.91903339),
-    (53.4167272, -114.03255323),
-    (53.55553094, -114.03130576),
-    (53.68279995, -114.00885128),
-    (53.85974393, -113.84293767),
-    (53.87592649, -113.53855479),
-    (53.87739732, -113.2903081),
-    (53.78315977, -113.07075324),
-    (53.5762753, -113.01461706),
-    (53.24836842, -113.18427309),
-])
-
-polygon_NorthOfEdmonton = Polygon([
-    (53.50243339, -110.00377323),
-    (53.5762753, -113.01461706),
-    (53.78315977, -113.07075324),
-    (53.87739732, -113.2903081),
-    (53.87592649, -113.53855479),
-    (53.85974393, -113.84293767),
-    (53.68279995, -114.00885128),
-    (53.55553094, -114.03130576),
-    (53.59736172, -119.90627337),
-    (53.85107632, -120.01788168),
-    (54.96100652, -119.98712166),
-    (59.99900962, -119.95504949),
-    (60.02591534, -109.9782346),
-    (54.57031627, -109.9782346),
-    (54.0463325, -110.01212127),
-    (53.50243339, -110.00377323),
-])
-
-polygon_SouthOfEdmonton = Polygon([
-    (53.55553094, -114.03130576),
-    (53.4167272, -114.03255323),
-    (53.31474832, -113.91903339),
-    (53.23791725, -113.69823105),
-    (53.22671673, -113.56849409),
-    (53.24836842, -113.18427309),
-    (53.5762753, -113.01461706),
-    (53.50243339, -110.00377323),
-    (53.31762057, -110.00096103),
-    (53.21968902, -110.00209789),
-    (53.1475128, -110.00209789),
-    (52.84412248, -110.00337243),
-    (48.99913055, -110.00270566),
-    (48.99680373, -111.69899418),
-    (48.99859613, -113.48778087),
-    (49.00466077, -114.06914793),
-    (49.051805, -114.05065923),
-    (49.07939732, -114.1276955),
-    (49.14058405, -114.16467291),
-    (49.15872384, -114.16467291),
-    (49.19162724, -114.23451913),
-    (49.17551402, -114.28587665),
-    (49.21310337, -114.39989033),
-    (49.24597062, -114.38345592),
-    (49.26474209, -114.44713924),
-    (49.38858851, -114.57245158),
-    (49.45339973, -114.61251044),
-    (49.51378852, -114.58110718),
-    (49.56678001, -114.58477738),
-    (49.55478748, -114.63818919),
-    (49.55945159, -114.73474132),
-    (49.62070996, -114.74295852),
-    (49.64598988, -114.66181365),
-    (49.70647531, -114.65975935),
-    (49.74100465, -114.62586339),
-    (49.7695392, -114.6546236),
-    (49.96947183, -114.67413945),
-    (50.38650836, -114.81485904),
-    (50.57409707, -115.02747915),
-    (50.52841237, -115.2062033),
-    (50.71999074, -115.3633573),
-    (50.73107632, -115.43408915),
-    (50.85002018, -115.63510018),
-    (50.90753636, -115.58134141),
-    (51.01353362, -115.67717225),
-    (51.08516826, -115.79283366),
-    (51.06824959, -116.06716859),
-    (51.37960225, -116.37162475),
-    (51.40963136, -116.31896794),
-    (52.28018639, -117.7493307),
-    (52.7667831, -118.456811),
-    (52.93860097, -118.60292107),
-    (53.25260316, -118.99511124),
-    (53.22498922, -119.34885139),
-    (53.5186203, -119.87177161),
-    (53.59736172, -119.90627337),
-    (53.55553094, -114.03130576),
-    (51.21463168, -114.5251865),
-    (51.06945384, -114.6147229),
-    (50.88422136, -114.61123447),
-    (50.73874109, -114.47053442),
-    (50.7107688, -114.01587559),
-    (50.72181249, -113.77401105),
-    (50.84018427, -113.66005564),
-    (51.01681467, -113.46005227),
-    (51.11035407, -113.52633246),
-    (51.2546757, -113.65191597),
-    (51.33102662, -113.87401274),
-    (51.3259405, -113.99610782),
-    (51.30268252, -114.27285667),
-    (51.21463168, -114.5251865),
-])
-
-polygon_Calgary = Polygon([
-    (50.72181249, -113.77401105),
-    (50.7107688, -114.01587559),
-    (50.73874109, -114.47053442),
-    (50.88422136, -114.61123447),
-    (51.06945384, -114.6147229),
-    (51.21463168, -114.5251865),
-    (51.30268252, -114.27285667),
-    (51.3259405, -113.99610782),
-    (51.33102662, -113.87401274),
-    (51.2546757, -113.65191597),
-    (51.11035407, -113.52633246),
-    (51.01681467, -113.46005227),
-    (50.84018427, -113.66005564),
-    (50.72181249, -113.77401105),
-])
-# Define the coordinates of your polygon
-
-polygon_Edmonton = Polygon([
-   (53.24836842, -113.18427309),
-    (53.22671673, -113.56849409),
-    (53.23791725, -113.69823105),
-    (53.31474832, -113.91903339),
-    (53.4167272, -114.03255323),
-    (53.55553094, -114.03130576),
-    (53.68279995, -114.00885128),
-    (53.85974393, -113.84293767),
-    (53.87592649, -113.53855479),
-    (53.87739732, -113.2903081),
-    (53.78315977, -113.07075324),
-    (53.5762753, -113.01461706),
-    (53.24836842, -113.18427309),
-])
-
-polygon_NorthOfEdmonton = Polygon([
-    (53.50243339, -110.00377323),
-    (53.5762753, -113.01461706),
-    (53.78315977, -113.07075324),
-    (53.87739732, -113.2903081),
-    (53.87592649, -113.53855479),
-    (53.85974393, -113.84293767),
-    (53.68279995, -114.00885128),
-    (53.55553094, -114.03130576),
-    (53.59736172, -119.90627337),
-    (53.85107632, -120.01788168),
-    (54.96100652, -119.98712166),
-    (59.99900962, -119.95504949),
-    (60.02591534, -109.9782346),
-    (54.57031627, -109.9782346),
-    (54.0463325, -110.01212127),
-    (53.50243339, -110.00377323),
-])
-
-polygon_SouthOfEdmonton = Polygon([
-    (53.55553094, -114.03130576),
-    (53.4167272, -114.03255323),
-    (53.31474832, -113.91903339),
-    (53.23791725, -113.69823105),
-    (53.22671673, -113.56849409),
-    (53.24836842, -113.18427309),
-    (53.5762753, -113.01461706),
-    (53.50243339, -110.00377323),
-    (53.31762057, -110.00096103),
-    (53.21968902, -110.00209789),
-    (53.1475128, -110.00209789),
-    (52.84412248, -110.00337243),
-    (48.99913055, -110.00270566),
-    (48.99680373, -111.69899418),
-    (48.99859613, -113.48778087),
-    (49.00466077, -114.06914793),
-    (49.051805, -114.05065923),
-    (49.07939732, -114.1276955),
-    (49.14058405, -114.16467291),
-    (49.15872384, -114.16467291),
-    (49.19162724, -114.23451913),
-    (49.17551402, -114.28587665),
-    (49.21310337, -114.39989033),
-    (49.24597062, -114.38345592),
-    (49.26474209, -114.44713924),
-    (49.38858851, -114.57245158),
-    (49.45339973, -114.61251044),
-    (49.51378852, -114.58110718),
-    (49.56678001, -114.58477738),
-    (49.55478748, -114.63818919),
-    (49.55945159, -114.73474132),
-    (49.62070996, -114.74295852),
-    (49.64598988, -114.66181365),
-    (49.70647531, -114.65975935),
-    (49.74100465, -114.62586339),
-    (49.7695392, -114.6546236),
-    (49.96947183, -114.67413945),
-    (50.38650836, -114.81485904),
-    (50.57409707, -115.02747915),
-    (50.52841237, -115.2062033),
-    (50.71999074, -115.3633573),
-    (50.73107632, -115.43408915),
-    (50.85002018, -115.63510018),
-    (50.90753636, -115.58134141),
-    (51.01353362, -115.67717225),
-    (51.08516826, -115.79283366),
-    (51.06824959, -116.06716859),
-    (51.37960225, -116.37162475),
-    (51.40963136, -116.31896794),
-    (52.28018639, -117.7493307),
-    (52.7667831, -118.456811),
-    (52.93860097, -118.60292107),
-    (53.25260316, -118.99511124),
-    (53.22498922, -119.34885139),
-    (53.5186203, -119.87177161),
-    (53.59736172, -119.90627337),
-    (53.55553094, -114.03130576),
-    (51.21463168, -114.5251865),
-    (51.06945384, -114.6147229),
-    (50.88422136, -114.61123447),
-    (50.73874109, -114.47053442),
-    (50.7107688, -114.01587559),
-    (50.72181249, -113.77401105),
-    (50.84018427, -113.66005564),
-    (51.01681467, -113.46005227),
-    (51.11035407, -113.52633246),
-    (51.2546757, -113.65191597),
-    (51.33102662, -113.87401274),
-    (51.3259405, -113.99610782),
-    (51.30268252, -114.27285667),
-    (51.21463168, -114.5251865),
-])
-
-polygon_Calgary = Polygon([
-    (50.72181249, -113.77401105),
-    (50.7107688, -114.01587559),
-    (50.73874109, -114.47053442),
-    (50.88422136, -114.61123447),
-    (51.06945384, -114.6147229),
-    (51.21463168, -114.5251865),
-    (51.30268252, -114.27285667),
-    (51.3259405, -113.99610782),
-    (51.33102662, -113.87401274),
-    (51.2546757, -113.65191597),
-    (51.11035407, -113.52633246),
-    (51.01681467, -113.46005227),
-    (50.84018427, -113.66005564),
-    (50.72181249, -113.77401105),
-])
-
-# Load the configuration file
-with open('config.json', 'r') as f:
-    config = json.load(f)
-
-DISCORD_WEBHOOK_URL = os.environ['DISCORD_WEBHOOK']
-AWS_ACCESS_KEY_ID = os.environ.get('AWS_DB_KEY', None)
-AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_DB_SECRET_ACCESS_KEY', None)
+# Region boundaries as (lat, lon) rings, in the order a point is checked against them; the first match wins
+REGION_COORDINATES = (
+    ('Edmonton', (
+        (53.24836842, -113.18427309),
+        (53.22671673, -113.56849409),
+        (53.23791725, -113.69823105),
+        (53.31474832, -113.91903339),
+        (53.4167272, -114.03255323),
+        (53.55553094, -114.03130576),
+        (53.68279995, -114.00885128),
+        (53.85974393, -113.84293767),
+        (53.87592649, -113.53855479),
+        (53.87739732, -113.2903081),
+        (53.78315977, -113.07075324),
+        (53.5762753, -113.01461706),
+        (53.24836842, -113.18427309),
+    )),
+    ('Calgary', (
+        (50.72181249, -113.77401105),
+        (50.7107688, -114.01587559),
+        (50.73874109, -114.47053442),
+        (50.88422136, -114.61123447),
+        (51.06945384, -114.6147229),
+        (51.21463168, -114.5251865),
+        (51.30268252, -114.27285667),
+        (51.3259405, -113.99610782),
+        (51.33102662, -113.87401274),
+        (51.2546757, -113.65191597),
+        (51.11035407, -113.52633246),
+        (51.01681467, -113.46005227),
+        (50.84018427, -113.66005564),
+        (50.72181249, -113.77401105),
+    )),
+    ('NorthOfEdmonton', (
+        (53.50243339, -110.00377323),
+        (53.5762753, -113.01461706),
+        (53.78315977, -113.07075324),
+        (53.87739732, -113.2903081),
+        (53.87592649, -113.53855479),
+        (53.85974393, -113.84293767),
+        (53.68279995, -114.00885128),
+        (53.55553094, -114.03130576),
+        (53.59736172, -119.90627337),
+        (53.85107632, -120.01788168),
+        (54.96100652, -119.98712166),
+        (59.99900962, -119.95504949),
+        (60.02591534, -109.9782346),
+        (54.57031627, -109.9782346),
+        (54.0463325, -110.01212127),
+        (53.50243339, -110.00377323),
+    )),
+    ('SouthOfEdmonton', (
+        (53.55553094, -114.03130576),
+        (53.4167272, -114.03255323),
+        (53.31474832, -113.91903339),
+        (53.23791725, -113.69823105),
+        (53.22671673, -113.56849409),
+        (53.24836842, -113.18427309),
+        (53.5762753, -113.01461706),
+        (53.50243339, -110.00377323),
+        (53.31762057, -110.00096103),
+        (53.21968902, -110.00209789),
+        (53.1475128, -110.00209789),
+        (52.84412248, -110.00337243),
+        (48.99913055, -110.00270566),
+        (48.99680373, -111.69899418),
+        (48.99859613, -113.48778087),
+        (49.00466077, -114.06914793),
+        (49.051805, -114.05065923),
+        (49.07939732, -114.1276955),
+        (49.14058405, -114.16467291),
+        (49.15872384, -114.16467291),
+        (49.19162724, -114.23451913),
+        (49.17551402, -114.28587665),
+        (49.21310337, -114.39989033),
+        (49.24597062, -114.38345592),
+        (49.26474209, -114.44713924),
+        (49.38858851, -114.57245158),
+        (49.45339973, -114.61251044),
+        (49.51378852, -114.58110718),
+        (49.56678001, -114.58477738),
+        (49.55478748, -114.63818919),
+        (49.55945159, -114.73474132),
+        (49.62070996, -114.74295852),
+        (49.64598988, -114.66181365),
+        (49.70647531, -114.65975935),
+        (49.74100465, -114.62586339),
+        (49.7695392, -114.6546236),
+        (49.96947183, -114.67413945),
+        (50.38650836, -114.81485904),
+        (50.57409707, -115.02747915),
+        (50.52841237, -115.2062033),
+        (50.71999074, -115.3633573),
+        (50.73107632, -115.43408915),
+        (50.85002018, -115.63510018),
+        (50.90753636, -115.58134141),
+        (51.01353362, -115.67717225),
+        (51.08516826, -115.79283366),
+        (51.06824959, -116.06716859),
+        (51.37960225, -116.37162475),
+        (51.40963136, -116.31896794),
+        (52.28018639, -117.7493307),
+        (52.7667831, -118.456811),
+        (52.93860097, -118.60292107),
+        (53.25260316, -118.99511124),
+        (53.22498922, -119.34885139),
+        (53.5186203, -119.87177161),
+        (53.59736172, -119.90627337),
+        (53.55553094, -114.03130576),
+        (51.21463168, -114.5251865),
+        (51.06945384, -114.6147229),
+        (50.88422136, -114.61123447),
+        (50.73874109, -114.47053442),
+        (50.7107688, -114.01587559),
+        (50.72181249, -113.77401105),
+        (50.84018427, -113.66005564),
+        (51.01681467, -113.46005227),
+        (51.11035407, -113.52633246),
+        (51.2546757, -113.65191597),
+        (51.33102662, -113.87401274),
+        (51.3259405, -113.99610782),
+        (51.30268252, -114.27285667),
+        (51.21463168, -114.5251865),
+    )),
+)
+
+# config.json and the DynamoDB client are loaded on first use rather than at import, to keep cold starts fast
+config = None
+client = None
+store = None
+recorders = {}  # record_path -> SnapshotRecorder
+geojson_exports = {}  # geojson_path -> LiveGeoJSON
+init_lock = threading.RLock()
+
+# Discord delivery: worker threads for sending, and attempts per message when rate limited
+DISCORD_WORKERS = 4
+DISCORD_MAX_ATTEMPTS = 5
+# Pooled HTTP sessions per host. Timeouts are (connect, read) seconds. Only the idempotent feed GET is retried
+# here; Discord 429s are handled by the rate limiter.
+HTTP_SESSIONS = {
+    '511': {
+        'pool_size': 2,
+        'pool_hosts': 8,  # a connection pool per feed host, for multi-feed deployments
+        'timeout': (5, 30),
+        'retries': Retry(total=2, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=('GET',))
+    },
+    'discord': {
+        'pool_size': DISCORD_WORKERS,
+        'pool_size_setting': 'discord_workers',  # sized to match the dispatcher's threads
+        'timeout': (5, 15),
+        'retries': 0
+    }
+}
+# Discord accepts up to 10 embeds per message, with at most 6000 characters across them
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARACTERS = 6000
 
 discordUsername = "AB511"
 discordAvatarURL = "https://pbs.twimg.com/profile_images/1256233970905341959/EKlyRkOM_400x400.jpg"
 
-# Fallback mechanism for credentials
-try:
-    # Use environment variables if they exist
+# Forum thread config key for each region's notifications
+THREAD_SETTINGS = {
+    'Edmonton': 'Thread-Edmonton',
+    'Calgary': 'Thread-Calgary',
+    'NorthOfEdmonton': 'Thread-NorthOfEdmonton',
+    'SouthOfEdmonton': 'Thread-SouthOfEdmonton'
+}
+# 511 map layer for an event type's link
+URL_TYPES = {'closures': 'Closures', 'accidentsAndIncidents': 'Incidents'}
+# Formatted local times are cached by timestamp; the feed repeats the same start and end times across runs
+TIME_FORMAT_CACHE_SIZE = 4096
+
+MAP_LINKS = {
+    '511': "[511]({mapURL}#{urlType}-{id})",
+    'WME': "[WME](https://www.waze.com/en-GB/editor?env=usa&lon={lon}&lat={lat}&zoomLevel=15)",
+    'Livemap': "[Livemap](https://www.waze.com/live-map/directions?dir_first=no&latlng={lat}%2C{lon}&overlay=false&zoom=16)"
+}
+# Embed layout per notification kind. Fields are (name, key, value type, inline, optional); optional fields are
+# left out when the event has no value. timestamp is the key whose time stamps the embed and orders it in a message.
+EMBED_FIELDS = (
+    ('Road', 'RoadwayName', 'text', True, False),
+    ('Direction', 'DirectionOfTravel', 'text', True, False),
+    ('Information', 'Description', 'text', False, False),
+    ('Start Time', 'StartDate', 'time', True, False)
+)
+EMBED_TEMPLATES = {
+    'closure': {
+        'title': 'Closed',
+        'color': 15548997,
+        'timestamp': 'StartDate',
+        'fields': EMBED_FIELDS + (
+            ('Planned End Time', 'PlannedEndDate', 'time', True, True),
+            ('Links', None, 'links', False, False)
+        ),
+        'links': ' | '.join(MAP_LINKS[name] for name in ('511', 'WME', 'Livemap'))
+    },
+    'updated': {
+        'title': 'Closure Update',
+        'color': 0xff9a00,
+        'timestamp': 'LastUpdated',
+        'fields': EMBED_FIELDS + (
+            ('Planned End Time', 'PlannedEndDate', 'time', True, True),
+            ('Comment', 'Comment', 'text', False, True),
+            ('Links', None, 'links', False, False)
+        ),
+        'links': ' | '.join(MAP_LINKS[name] for name in ('511', 'WME', 'Livemap'))
+    },
+    'completed': {
+        'title': 'Cleared',
+        'color': 0x34e718,
+        'timestamp': 'Ended',
+        'fields': EMBED_FIELDS + (
+            ('Ended', 'Ended', 'time', True, False),
+            ('Links', None, 'links', False, False)
+        ),
+        'links': ' | '.join(MAP_LINKS[name] for name in ('WME', 'Livemap'))
+    }
+}
+
+def get_config():
+    # Loads the configuration file once
+    global config
+    if config is None:
+        with init_lock:
+            if config is None:
+                with open('config.json', 'r') as f:
+                    config = json.load(f)
+    return config
+
+def table_name():
+    # Every request goes through the client, so the table is only ever needed by name
+    return get_config()['db_name']
+
+def get_client():
+    # Creates the plain DynamoDB client once. Unlike a boto3 resource it can be shared by the threads of
+    # run_feeds, so every read and write goes through it
+    global client
+    if client is None:
+        with init_lock:
+            if client is None:
+                client = connect_client()
+    return client
+
+def dynamodb_connection_args():
+    AWS_ACCESS_KEY_ID = os.environ.get('AWS_DB_KEY', None)
+    AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_DB_SECRET_ACCESS_KEY', None)
+    args = {'region_name': 'us-east-1'}
+    # Use environment variables if they exist, otherwise IAM role permissions (default behavior of boto3)
     if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
-        dynamodb = boto3.resource(
-            'dynamodb',
-            region_name='us-east-1',
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        )
-    else:
-        # Otherwise, use IAM role permissions (default behavior of boto3)
-        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-except (NoCredentialsError, PartialCredentialsError):
-    print("AWS credentials are not properly configured. Ensure IAM role or environment variables are set.")
-    raise
+        args['aws_access_key_id'] = AWS_ACCESS_KEY_ID
+        args['aws_secret_access_key'] = AWS_SECRET_ACCESS_KEY
+    return args
+
+def connect_client():
+    # A low-level client without the resource layer's TypeSerializer: requests send items already
+    # serialized by serialize_item, and responses are read back with deserialize_item
+    import boto3
+    from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+    # Fallback mechanism for credentials
+    try:
+        return boto3.client('dynamodb', **dynamodb_connection_args())
+    except (NoCredentialsError, PartialCredentialsError):
+        print("AWS credentials are not properly configured. Ensure IAM role or environment variables are set.")
+        raise
+
+FEED_URL = "https://511.alberta.ca/api/v2/get/event"
+MAP_URL = "https://511.alberta.ca/map"
+# Region sets a feed in config.json can name instead of listing its own polygons
+REGION_SETS = {'alberta': REGION_COORDINATES}
+FEED_CHUNK_SIZE = 64 * 1024
+FEED_STATE_KEY = 'FeedState'
+LAST_CLEANUP_KEY = 'LastCleanup'
+# Runs are processed in full at least this often, even when the feed has not changed
+HEARTBEAT_SECONDS = 300
+# Poller mode (--poll): the interval between polls halves when the full closures change and grows by
+# POLL_BACKOFF while they don't, within these bounds
+POLL_MIN_SECONDS = 15
+POLL_MAX_SECONDS = 120
+POLL_BACKOFF = 1.5
+# Run metrics: every run emits one CloudWatch Embedded Metric Format record to stdout. Detail logged from inside
+# a run goes out at hot_loop_log_level, DEBUG unless config.json says otherwise.
+METRICS_NAMESPACE = 'AB511'
+METRIC_PHASES = ('Fetch', 'Parse', 'Diff', 'Classify', 'DBRead', 'DBWrite', 'Discord')
+METRIC_COUNTS = (
+    'FeedEvents', 'FullClosures', 'New', 'Updated', 'Touched', 'Cleared', 'Notifications', 'DiscordMessages',
+    'DiscordRequests', 'DiscordRateLimited', 'DiscordRetries', 'DiscordFailures', 'DynamoDBRequests',
+    'DynamoDBReadCapacity', 'DynamoDBWriteCapacity', 'RegionCacheHits', 'RegionCacheMisses', 'OutboxRetries',
+    'OutboxDropped'
+)
+HOT_LOOP_LOG_LEVEL = 'DEBUG'
+# Snapshot recording (config.json 'record_path'): events are identified by this many hex characters of the
+# sha256 of their JSON, and stored once per recording however many snapshots they appear in
+SNAPSHOT_DIGEST_SIZE = 16
+# Live GeoJSON export (config.json 'geojson_path'): the stored fields each closure's Feature carries, and the
+# sidecar file next to the export that holds its ETag
+GEOJSON_PROPERTIES = ('RoadwayName', 'DirectionOfTravel', 'Description', 'StartDate', 'LastUpdated')
+GEOJSON_ETAG_SUFFIX = '.etag'
+
+# Ask for brotli as well as gzip when the brotli decoder is installed for urllib3 to use
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = 'br, gzip, deflate'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+# The fields of a 511 event that the bot reads; everything else is dropped while parsing
+FEED_FIELDS = (
+    'ID', 'EventType', 'IsFullClosure', 'RoadwayName', 'DirectionOfTravel', 'Description',
+    'Comment', 'StartDate', 'PlannedEndDate', 'LastUpdated', 'Latitude', 'Longitude'
+)
+# Stored event items keep only the feed fields that are read back, by the cleared notification, the diff and
+# the region reuse, plus the attributes this module manages
+ITEM_FEED_FIELDS = ('RoadwayName', 'DirectionOfTravel', 'Description', 'StartDate', 'LastUpdated', 'Latitude', 'Longitude')
+ITEM_FIELDS = ('EventID',) + ITEM_FEED_FIELDS + ('ContentDigest', 'DetectedPolygon', 'lastTouched', 'isActive', 'ActiveFlag', 'InactiveFlag')
+# Fields an update notification shows. A newer LastUpdated with the same digest over these is not worth posting.
+CONTENT_FIELDS = ('RoadwayName', 'DirectionOfTravel', 'Description', 'PlannedEndDate', 'Comment')
+# Event reads project just those attributes, through placeholders so no name can clash with a reserved word
+ITEM_PROJECTION = {
+    'ProjectionExpression': ', '.join(f'#f{i}' for i in range(len(ITEM_FIELDS))),
+    'ExpressionAttributeNames': {f'#f{i}': name for i, name in enumerate(ITEM_FIELDS)}
+}
 
-# Specify the name of your DynamoDB table
-table = dynamodb.Table(config['db_name'])
+# Region lookups are cached per event, with coordinates rounded to this many decimal places
+COORDINATE_PRECISION = 5
+REGION_CACHE_SIZE = 4096
+
+# Run-level liveness checkpoint, split into shards of this many events to stay under the item size limit
+LAST_SEEN_KEY = 'LastSeen'
+LAST_SEEN_SHARD_SIZE = 5000
+
+# Sparse global secondary indexes: active items carry ActiveFlag, inactive items carry InactiveFlag
+ACTIVE_INDEX = 'ActiveEvents'  # hash ActiveFlag (S), range EventID (S)
+INACTIVE_INDEX = 'InactiveEvents'  # hash InactiveFlag (S), range LastUpdated (N)
+INDEX_FLAG = '1'
+# Notification outbox (config.json 'outbox'): pending notifications are items keyed Outbox#<digest> carrying
+# OutboxFlag, delivered by drain_outbox and retried with exponential backoff until they are given up on
+OUTBOX_KEY = 'Outbox'
+OUTBOX_INDEX = 'PendingNotifications'  # hash OutboxFlag (S), range EventID (S)
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE_SECONDS = 30
+OUTBOX_RETRY_MAX_SECONDS = 3600
+# A drain claims the items it sends for this long, so another drain can take them over if it dies while sending
+OUTBOX_CLAIM_SECONDS = 300
+CLAIM_EXPRESSION = "SET NextAttemptAt = :lease"
+CLAIM_CONDITION = "NextAttemptAt = :due"
+DEACTIVATE_EXPRESSION = "SET isActive = :val, InactiveFlag = :flag REMOVE ActiveFlag"
+# Records a newer LastUpdated on an item whose content did not change, without re-putting it
+TOUCH_EXPRESSION = "SET LastUpdated = :updated, lastTouched = :touched"
+
+# SQLite state store (state_store: "sqlite"): default file, and the most keys bound in one IN (...) query
+SQLITE_PATH = 'ab511-state.db'
+SQLITE_VARIABLE_LIMIT = 500
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    EventID TEXT PRIMARY KEY,
+    Active INTEGER,
+    Inactive INTEGER,
+    LastUpdated REAL,
+    Item TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ActiveEvents ON events (Active) WHERE Active = 1;
+CREATE INDEX IF NOT EXISTS InactiveEvents ON events (Inactive, LastUpdated) WHERE Inactive = 1;
+"""
+
+# DynamoDB request limits for batched reads and writes
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+TRANSACT_WRITE_SIZE = 100
+# Touches go out as single UpdateItems, this many at a time
+UPDATE_WORKERS = 8
+WRITE_RETRY_ATTEMPTS = 6
+WRITE_RETRY_BASE_DELAY = 0.05
 
 utc_timestamp = None
+replay_time = None  # the recorded time of the snapshot being replayed, which runs use in place of the clock
 
 def update_utc_timestamp():
     global utc_timestamp
-    utc_timestamp = calendar.timegm(datetime.utcnow().timetuple())
+    if replay_time is not None:
+        utc_timestamp = replay_time
+    else:
+        utc_timestamp = calendar.timegm(datetime.utcnow().timetuple())
 
 # set the current UTC timestamp for use in a few places
 update_utc_timestamp()
 
 
+def to_decimal(value):
+    # Converts a single float to Decimal so it compares equal to what DynamoDB returns
+    if isinstance(value, float):
+        return Decimal(str(value))
+    return value
+
 # Function to convert the float values in the event data to Decimal, as DynamoDB doesn't support float type
 def float_to_decimal(event):
     for key, value in event.items():
@@ -329,280 +435,1957 @@ def float_to_decimal(event):
             event[key] = float_to_decimal(value)
     return event
 
+def serialize_value(value):
+    # Converts a value to a DynamoDB AttributeValue. Floats go straight to number strings: repr() is the
+    # shortest exact form, the same text Decimal(str(value)) gave except for exponent forms, which are
+    # passed through Decimal to keep them identical.
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, float):
+        text = repr(value)
+        if 'e' in text or 'n' in text:
+            if not math.isfinite(value):
+                raise Exception(f"DynamoDB cannot store the number {text}")
+            text = str(Decimal(text))
+        return {'N': text}
+    if isinstance(value, (int, Decimal)):
+        return {'N': str(value)}
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, dict):
+        return {'M': serialize_item(value)}
+    if isinstance(value, (list, tuple)):
+        return {'L': [serialize_value(v) for v in value]}
+    raise Exception(f"Cannot store {type(value).__name__} values in DynamoDB")
+
+def serialize_item(item):
+    return {key: serialize_value(value) for key, value in item.items()}
+
+def deserialize_value(value):
+    # The reverse of serialize_value, giving back what boto3's resource layer returns: numbers as Decimal
+    (kind, inner), = value.items()
+    if kind == 'N':
+        return Decimal(inner)
+    if kind == 'NULL':
+        return None
+    if kind == 'M':
+        return deserialize_item(inner)
+    if kind == 'L':
+        return [deserialize_value(v) for v in inner]
+    return inner
+
+def deserialize_item(item):
+    return {key: deserialize_value(value) for key, value in item.items()}
+
+def content_digest(event):
+    # Stable digest of the fields an update notification shows
+    values = [event.get(key) for key in CONTENT_FIELDS]
+    return hashlib.sha256(json.dumps(values, separators=(',', ':'), default=str).encode()).hexdigest()[:32]
+
+def build_item(event, region):
+    # The stored item for an active feed event
+    item = {key: event[key] for key in ITEM_FEED_FIELDS if key in event}
+    item['EventID'] = event_key(event)
+    item['ContentDigest'] = content_digest(event)
+    item['DetectedPolygon'] = region
+    item['lastTouched'] = utc_timestamp
+    return set_active_flags(item, True)
+
+@dataclass
+class Feed:
+    # A 511 feed and where its notifications and state go. settings is the feed's entry in config.json's 'feeds';
+    # without one, the feed is Alberta's, configured by the top-level settings as before multi-feed support.
+    # Its EventIDs and state keys are namespaced by keyPrefix so several feeds can share one table.
+    name: str = 'AB'
+    url: str = FEED_URL
+    mapURL: str = MAP_URL
+    regions: tuple = REGION_COORDINATES
+    keyPrefix: str = ''
+    settings: dict = None
+    excludedPrefixes: tuple = ()  # longer prefixes of other feeds, whose keys also start with keyPrefix
+
+    def setting(self, name, default=None):
+        # The feed's own value, falling back to the top-level config
+        if self.settings is not None and name in self.settings:
+            return self.settings[name]
+        return get_config().get(name, default)
+
+    def thread_id(self, region):
+        # Unknown regions, including 'Other', go to the catch all thread
+        if self.settings is None or 'threads' not in self.settings:
+            return get_config()[THREAD_SETTINGS.get(region, 'Thread-CatchAll')]
+        threads = self.settings['threads']
+        return threads.get(region, threads['CatchAll'])
+
+    def owns(self, eventID):
+        return eventID.startswith(self.keyPrefix) and not eventID.startswith(self.excludedPrefixes)
+
+DEFAULT_FEED = Feed()
+
+# The feed being processed. Set for the length of a run, so feeds can run side by side on threads.
+current_feed = contextvars.ContextVar('current_feed', default=None)
+
+def get_feed():
+    # The current run's feed; outside a run, the Alberta feed configured by the top-level settings
+    feed = current_feed.get()
+    return feed if feed is not None else DEFAULT_FEED
+
+def feed_from_settings(settings):
+    regions = settings.get('regions', ())
+    if isinstance(regions, str):
+        regions = REGION_SETS[regions]
+    elif isinstance(regions, dict):
+        regions = tuple((name, tuple(tuple(point) for point in ring)) for name, ring in regions.items())
+    return Feed(
+        name=settings['name'],
+        url=settings['url'],
+        mapURL=settings.get('map_url', settings['url'].split('/api/')[0] + '/map'),
+        regions=regions,
+        keyPrefix=settings.get('key_prefix', ''),
+        settings=settings
+    )
+
+def get_feeds():
+    # The feeds config.json's 'feeds' lists, or just the Alberta feed when it lists none
+    entries = get_config().get('feeds')
+    if not entries:
+        return [DEFAULT_FEED]
+    feeds = [feed_from_settings(entry) for entry in entries]
+    names = [feed.name for feed in feeds]
+    prefixes = [feed.keyPrefix for feed in feeds]
+    if len(set(names)) != len(names) or len(set(prefixes)) != len(prefixes):
+        raise Exception("Every feed in config.json needs a unique name and key_prefix")
+    for feed in feeds:
+        feed.excludedPrefixes = tuple(prefix for prefix in prefixes if prefix != feed.keyPrefix and prefix.startswith(feed.keyPrefix))
+    return feeds
+
+def event_key(event):
+    # The EventID a feed event is stored under
+    return get_feed().keyPrefix + str(event['ID'])
+
+def feed_key(name):
+    # The key of one of the feed's state items, such as FeedState
+    return get_feed().keyPrefix + name
+
+@functools.lru_cache(maxsize=None)
+def prepare_regions(regionCoordinates):
+    # Builds and prepares a region set's polygons on first use, so runs that classify nothing never load shapely
+    import shapely
+    from shapely.geometry import Polygon
+    regions = []
+    for name, coordinates in regionCoordinates:
+        polygon = Polygon(coordinates)
+        shapely.prepare(polygon)
+        regions.append((name, polygon))
+    return tuple(regions)
+
+def get_regions():
+    return prepare_regions(get_feed().regions)
+
+def classify_points(latitudes, longitudes):
+    # Classifies many points at once against the regions, returning a region name per point in the same order.
+    # Points outside every region, or with missing coordinates, are "Other".
+    # The polygons are stored as (lat, lon), so latitude is x and longitude is y.
+    import numpy as np
+    import shapely
+    x = np.asarray(latitudes, dtype=float)
+    y = np.asarray(longitudes, dtype=float)
+    labels = np.full(len(x), 'Other', dtype=object)
+    unassigned = np.isfinite(x) & np.isfinite(y)
+    for name, polygon in get_regions():
+        # Only test points inside the region's bounding box
+        minx, miny, maxx, maxy = polygon.bounds
+        candidates = np.flatnonzero(unassigned & (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+        if candidates.size == 0:
+            continue
+        inside = candidates[shapely.contains_xy(polygon, x[candidates], y[candidates])]
+        labels[inside] = name
+        unassigned[inside] = False
+    return labels.tolist()
+
+def quantize_coordinate(value):
+    # Rounds a coordinate to about a metre so tiny float differences still match
+    if value is None:
+        return None
+    return round(float(value), COORDINATE_PRECISION)
+
+class RegionCache:
+    # Bounded LRU of region lookups keyed by (EventID, quantized lat, quantized lon).
+    # Lives at module level so it survives across warm Lambda invocations, and is shared by feeds and shards.
+    def __init__(self, maxsize=REGION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stored_hits = 0  # regions reused from the DetectedPolygon already in the table
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            region = self.entries.get(key)
+            if region is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return region
+
+    def stored_hit(self):
+        # Counts a region reused from a stored item, which never reaches the cache itself
+        with self.lock:
+            self.stored_hits += 1
+
+    def put(self, key, region):
+        with self.lock:
+            self.entries[key] = region
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'stored_hits': self.stored_hits,
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+region_cache = RegionCache()
+
+def resolve_regions(pending):
+    # Takes (event, storedItem) pairs (storedItem may be None) and returns a dict of EventID -> region.
+    # A stored DetectedPolygon is reused when the coordinates have not moved, then the LRU cache is tried,
+    # and whatever is left is classified in a single batch.
+    regionByID = {}
+    misses = []
+    for event, storedItem in pending:
+        eventID = event_key(event)
+        key = (eventID, quantize_coordinate(event.get('Latitude')), quantize_coordinate(event.get('Longitude')))
+        if storedItem is not None and storedItem.get('DetectedPolygon') is not None \
+                and key[1:] == (quantize_coordinate(storedItem.get('Latitude')), quantize_coordinate(storedItem.get('Longitude'))):
+            region_cache.stored_hit()
+            regionByID[eventID] = storedItem['DetectedPolygon']
+            continue
+        region = region_cache.get(key)
+        if region is not None:
+            regionByID[eventID] = region
+        else:
+            misses.append(key)
+    run_metrics().count('RegionCacheHits', len(pending) - len(misses))
+    run_metrics().count('RegionCacheMisses', len(misses))
+    labels = classify_points([key[1] for key in misses], [key[2] for key in misses])
+    for key, region in zip(misses, labels):
+        region_cache.put(key, region)
+        regionByID[key[0]] = region
+    return regionByID
+
 def check_which_polygon_point(point):
     # Function to see which polygon a point is in, and returns the text. Returns "Other" if unknown.
-    try:
-        if polygon_Edmonton.contains(point):
-            return 'Edmonton'
-        elif polygon_Calgary.contains(point):
-            return 'Calgary'
-        elif polygon_NorthOfEdmonton.contains(point):
-            return 'NorthOfEdmonton'
-        elif polygon_SouthOfEdmonton.contains(point):
-            return 'SouthOfEdmonton'
-        else:
-            return 'Other'
-    except:
+    if point.is_empty:
         return 'Other'
+    return classify_points([point.x], [point.y])[0]
 
 def getThreadID(threadName):
-    if threadName == 'Edmonton':
-        return config['Thread-Edmonton']
-    elif threadName == 'Calgary':
-        return config['Thread-Calgary']
-    elif threadName == 'NorthOfEdmonton':
-        return config['Thread-NorthOfEdmonton']
-    elif threadName == 'SouthOfEdmonton':
-        return config['Thread-SouthOfEdmonton']
-    else:
-        return config['Thread-CatchAll'] #Other catch all thread
+    return get_feed().thread_id(threadName)
 
-def unix_to_readable(unix_timestamp):
-    utc_time = datetime.utcfromtimestamp(int(unix_timestamp))
-    local_tz = timezone(config['timezone'])
-    local_time = utc_time.replace(tzinfo=timezone('UTC')).astimezone(local_tz)
+@functools.lru_cache(maxsize=None)
+def get_timezone(name):
+    # pytz zone lookups read and parse the zone file, so each zone is built once
+    from pytz import timezone
+    return timezone(name)
+
+@functools.lru_cache(maxsize=TIME_FORMAT_CACHE_SIZE)
+def format_local_time(unix_timestamp, timezoneName):
+    from pytz import utc
+    local_time = datetime.fromtimestamp(unix_timestamp, utc).astimezone(get_timezone(timezoneName))
     return local_time.strftime('%Y-%b-%d %I:%M %p')
 
-def post_to_discord_closure(event,threadName=None):
-    # Create a webhook instance
-    threadID = getThreadID(threadName)
-    if threadID is not None:
-        webhook = DiscordWebhook(url=DISCORD_WEBHOOK_URL, username=discordUsername, avatar_url=discordAvatarURL, thread_id=threadID)
-    else:
-        webhook = DiscordWebhook(url=DISCORD_WEBHOOK_URL, username=discordUsername, avatar_url=discordAvatarURL)
+def unix_to_readable(unix_timestamp):
+    return format_local_time(int(unix_timestamp), get_feed().setting('timezone'))
+
+@functools.lru_cache(maxsize=TIME_FORMAT_CACHE_SIZE)
+def embed_timestamp(unix_timestamp):
+    # Naive UTC ISO 8601, the form discord_webhook's set_timestamp produced
+    return datetime.utcfromtimestamp(unix_timestamp).isoformat()
+
+def render_embed(kind, event, overrides=None):
+    # Builds the embed for a notification kind from its template, as the plain dict Discord receives.
+    # overrides supplies values that don't come from the event, such as the 'Ended' time.
+    template = EMBED_TEMPLATES[kind]
+    fields = []
+    for name, key, valueType, inline, optional in template['fields']:
+        if valueType == 'links':
+            value = template['links'].format(
+                mapURL=get_feed().mapURL, urlType=URL_TYPES.get(event.get('EventType'), 'Closures'),
+                id=event.get('ID'), lat=event['Latitude'], lon=event['Longitude']
+            )
+        else:
+            value = overrides[key] if overrides and key in overrides else (event.get(key) if optional else event[key])
+            if optional and value is None:
+                continue
+            if valueType == 'time':
+                value = unix_to_readable(value)
+        fields.append({'name': name, 'value': value, 'inline': inline})
+    timestampKey = template['timestamp']
+    eventTime = int(overrides[timestampKey] if overrides and timestampKey in overrides else event[timestampKey])
+    # Same keys, in the same order, as a serialized DiscordEmbed
+    embed = {
+        'title': template['title'],
+        'description': None,
+        'url': None,
+        'footer': {'text': get_feed().setting('license_notice'), 'icon_url': None, 'proxy_icon_url': None},
+        'image': None,
+        'thumbnail': None,
+        'video': None,
+        'provider': None,
+        'author': None,
+        'fields': fields,
+        'color': template['color'],
+        'timestamp': embed_timestamp(eventTime)
+    }
+    return embed, eventTime
+
+@dataclass
+class WebhookMessage:
+    # A webhook message for one forum thread
+    url: str
+    thread_id: object = None
+    embeds: list = field(default_factory=list)
+    username: str = discordUsername
+
+    @property
+    def json(self):
+        # Same payload discord_webhook's DiscordWebhook.json produced for these messages
+        data = {'attachments': [], 'avatar_url': discordAvatarURL, 'embeds': self.embeds}
+        if self.thread_id:
+            data['thread_id'] = self.thread_id
+        data['username'] = self.username
+        data['wait'] = True
+        return data
+
+def new_webhook(threadID, embeds):
+    # Builds a webhook message carrying one or more embeds for a forum thread
+    # A feed can name its own webhook's environment variable and bot name
+    feed = get_feed()
+    return WebhookMessage(
+        url=os.environ[feed.setting('webhook_env', 'DISCORD_WEBHOOK')], thread_id=threadID, embeds=list(embeds),
+        username=feed.setting('username', discordUsername)
+    )
+
+def embed_length(embed):
+    # Counts the characters Discord includes in its per-message embed limit
+    length = len(embed.get('title') or '') + len(embed.get('description') or '')
+    for embedField in embed.get('fields') or ():
+        length += len(str(embedField['name'])) + len(str(embedField['value']))
+    if embed.get('footer'):
+        length += len(embed['footer'].get('text') or '')
+    if embed.get('author'):
+        length += len(embed['author'].get('name') or '')
+    return length
+
+class EmbedBatcher:
+    # Collects a run's embeds per forum thread and packs them into multi-embed messages,
+    # ordered by event time and kept within Discord's embed count and character limits.
+    # Shards of a run add to it from their own threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads = {}  # threadID -> list of (eventTime, sequence, embed, tag)
+        self.sequence = 0
+        self.sent = []  # (webhook, [tags]) for every message the last flush sent
+
+    def add(self, threadID, embed, eventTime, tag=None):
+        # tag identifies the notification: which event it is about, or the outbox item it came from
+        with self.lock:
+            self.threads.setdefault(threadID, []).append((eventTime, self.sequence, embed, tag))
+            self.sequence += 1
+
+    def take(self):
+        # Removes and returns every (threadID, entry) added so far
+        with self.lock:
+            threads, self.threads = self.threads, {}
+        return [(threadID, entry) for threadID, entries in threads.items() for entry in entries]
+
+    def pack_entries(self):
+        # Returns a list of (threadID, [entries]) messages
+        messages = []
+        for threadID, entries in self.threads.items():
+            message = []
+            length = 0
+            for entry in sorted(entries, key=lambda entry: entry[:2]):
+                size = embed_length(entry[2])
+                if message and (len(message) == MAX_EMBEDS_PER_MESSAGE or length + size > MAX_EMBED_CHARACTERS):
+                    messages.append((threadID, message))
+                    message = []
+                    length = 0
+                message.append(entry)
+                length += size
+            if message:
+                messages.append((threadID, message))
+        return messages
+
+    def pack(self):
+        # Returns a list of (threadID, [embeds]) messages
+        return [(threadID, [entry[2] for entry in entries]) for threadID, entries in self.pack_entries()]
+
+    def event_ids(self):
+        # The EventIDs of every event notified about so far
+        with self.lock:
+            return {tag_event_id(entry[3]) for entries in self.threads.values() for entry in entries} - {None}
+
+    def flush(self):
+        # Hands every packed message to send_webhook, remembering the notifications each one carries
+        messages = self.pack_entries()
+        self.threads = {}
+        self.sent = []
+        for threadID, entries in messages:
+            webhook = new_webhook(threadID, [entry[2] for entry in entries])
+            self.sent.append((webhook, [entry[3] for entry in entries]))
+            send_webhook(webhook)
+        return len(messages)
+
+    def failed_event_ids(self, failures):
+        # The EventIDs notified about in the flushed messages among a dispatcher's failures
+        failed = {id(webhook) for webhook, error in failures}
+        return {tag_event_id(tag) for webhook, tags in self.sent if id(webhook) in failed for tag in tags} - {None}
 
-    #define type for URL
-    if event['EventType'] == 'closures':
-        URLType = 'Closures'
-    elif event['EventType'] == 'accidentsAndIncidents':
-        URLType = 'Incidents'
+def tag_event_id(tag):
+    # The EventID in a post_embed tag such as 'updated#EventID', None for any other tag
+    return tag.split('#', 1)[1] if isinstance(tag, str) and '#' in tag else None
+
+# The current run's EmbedBatcher, None outside a run
+current_embed_batcher = contextvars.ContextVar('current_embed_batcher', default=None)
+
+def send_embed(threadID, embed, eventTime, tag=None):
+    # Adds the embed to the run's batch, or sends it on its own outside of a run
+    embed_batcher = current_embed_batcher.get()
+    if embed_batcher is not None:
+        embed_batcher.add(threadID, embed, eventTime, tag)
     else:
-        URLType = 'Closures'
-
-
-    urlWME = f"https://www.waze.com/en-GB/editor?env=usa&lon={event['Longitude']}&lat={event['Latitude']}&zoomLevel=15"
-    url511 = f"https://511.alberta.ca/map#{URLType}-{event['ID']}"
-    urlLivemap = f"https://www.waze.com/live-map/directions?dir_first=no&latlng={event['Latitude']}%2C{event['Longitude']}&overlay=false&zoom=16"
-
-    embed = DiscordEmbed(title=f"Closed", color=15548997)
-    embed.add_embed_field(name="Road", value=event['RoadwayName'])
-    embed.add_embed_field(name="Direction", value=event['DirectionOfTravel'])
-    embed.add_embed_field(name="Information", value=event['Description'], inline=False)
-    embed.add_embed_field(name="Start Time", value=unix_to_readable(event['StartDate']))
-    if 'PlannedEndDate' in event and event['PlannedEndDate'] is not None:
-        embed.add_embed_field(name="Planned End Time", value=unix_to_readable(event['PlannedEndDate']))
-    embed.add_embed_field(name="Links", value=f"[511]({url511}) | [WME]({urlWME}) | [Livemap]({urlLivemap})", inline=False)
-    embed.set_footer(text=config['license_notice'])
-    embed.set_timestamp(datetime.utcfromtimestamp(int(event['StartDate'])))
-    # Send the closure notification
-    webhook.add_embed(embed)
-    webhook.execute()
+        send_webhook(new_webhook(threadID, [embed]))
+
+def post_embed(kind, event, threadName=None, overrides=None):
+    embed, eventTime = render_embed(kind, event, overrides)
+    # Stored items carry their EventID, feed events only their ID
+    eventID = event['EventID'] if 'EventID' in event else event_key(event)
+    send_embed(getThreadID(threadName), embed, eventTime, f"{kind}#{eventID}")
+
+def post_to_discord_closure(event,threadName=None):
+    post_embed('closure', event, threadName)
 
 def post_to_discord_updated(event,threadName=None):
     # Function to post to discord that an event was updated (already previously reported)
-    # Create a webhook instance
-    threadID = getThreadID(threadName)
-    if threadID is not None:
-        webhook = DiscordWebhook(url=DISCORD_WEBHOOK_URL, username=discordUsername, avatar_url=discordAvatarURL, thread_id=threadID)
-    else:
-        webhook = DiscordWebhook(url=DISCORD_WEBHOOK_URL, username=discordUsername, avatar_url=discordAvatarURL)
+    post_embed('updated', event, threadName)
 
-    #define type for URL
-    if event['EventType'] == 'closures':
-        URLType = 'Closures'
-    elif event['EventType'] == 'accidentsAndIncidents':
-        URLType = 'Incidents'
+def post_to_discord_completed(event,threadName=None,lastSeen=None):
+    # The event ended after the last run that saw it
+    if lastSeen and event.get('EventID') in lastSeen:
+        lastTouched = int(lastSeen[event['EventID']])
+    elif 'lastTouched' in event:
+        lastTouched = int(event['lastTouched'])
     else:
-        URLType = 'Closures'
-
-    urlWME = f"https://www.waze.com/en-GB/editor?env=usa&lon={event['Longitude']}&lat={event['Latitude']}&zoomLevel=15"
-    url511 = f"https://511.alberta.ca/map#{URLType}-{event['ID']}"
-    urlLivemap = f"https://www.waze.com/live-map/directions?dir_first=no&latlng={event['Latitude']}%2C{event['Longitude']}&overlay=false&zoom=16"
-
-    embed = DiscordEmbed(title=f"Closure Update", color='ff9a00')
-    embed.add_embed_field(name="Road", value=event['RoadwayName'])
-    embed.add_embed_field(name="Direction", value=event['DirectionOfTravel'])
-    embed.add_embed_field(name="Information", value=event['Description'], inline=False)
-    embed.add_embed_field(name="Start Time", value=unix_to_readable(event['StartDate']))
-    if 'PlannedEndDate' in event and event['PlannedEndDate'] is not None:
-        embed.add_embed_field(name="Planned End Time", value=unix_to_readable(event['PlannedEndDate']))
-    if 'Comment' in event and event['Comment'] is not None:
-        embed.add_embed_field(name="Comment", value=event['Comment'], inline=False)
-    embed.add_embed_field(name="Links", value=f"[511]({url511}) | [WME]({urlWME}) | [Livemap]({urlLivemap})", inline=False)
-    embed.set_footer(text=config['license_notice'])
-    embed.set_timestamp(datetime.utcfromtimestamp(int(event['LastUpdated'])))
-
-    # Send the closure notification
-    webhook.add_embed(embed)
-    webhook.execute()
-
-def post_to_discord_completed(event,threadName=None):
-    # Create a webhook instance
-    threadID = getThreadID(threadName)
-    if threadID is not None:
-        webhook = DiscordWebhook(url=DISCORD_WEBHOOK_URL, username=discordUsername, avatar_url=discordAvatarURL, thread_id=threadID)
+        lastTouched = utc_timestamp
+    post_embed('completed', event, threadName, {'Ended': lastTouched})
+
+class DiscordRateLimiter:
+    # Tracks Discord's rate limits from the X-RateLimit-* headers and 429 responses.
+    # Routes are (webhook url, thread id); Discord maps each route to a bucket.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routeBuckets = {}  # route -> X-RateLimit-Bucket
+        self.resumeAt = {}  # bucket -> time.monotonic() when it may send again
+        self.globalResumeAt = 0
+        self.rateLimited = 0
+        self.retries = 0
+
+    def wait(self, route):
+        # Sleeps until the route's bucket, and the global limit, allow another request
+        with self.lock:
+            bucket = self.routeBuckets.get(route, route)
+            resumeAt = max(self.resumeAt.get(bucket, 0), self.globalResumeAt)
+        delay = resumeAt - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, route, response):
+        # Records the limits reported by a response. Returns True if it was a 429 and should be retried.
+        headers = response.headers
+        bucket = headers.get('X-RateLimit-Bucket')
+        remaining = header_float(headers, 'X-RateLimit-Remaining')
+        resetAfter = header_float(headers, 'X-RateLimit-Reset-After')
+        limited = response.status_code == 429
+        if limited:
+            retryAfter = None
+            try:
+                retryAfter = float(response.json()['retry_after'])
+            except (ValueError, KeyError, TypeError):
+                retryAfter = header_float(headers, 'Retry-After')
+            resetAfter = retryAfter if retryAfter is not None else 1.0
+        now = time.monotonic()
+        with self.lock:
+            if isinstance(bucket, str):
+                self.routeBuckets[route] = bucket
+            else:
+                bucket = self.routeBuckets.get(route, route)
+            if limited:
+                self.rateLimited += 1
+                if headers.get('X-RateLimit-Global') == 'true':
+                    self.globalResumeAt = now + resetAfter
+                else:
+                    self.resumeAt[bucket] = now + resetAfter
+            elif remaining == 0 and resetAfter is not None:
+                self.resumeAt[bucket] = now + resetAfter
+        return limited
+
+def header_float(headers, name):
+    # Reads a numeric header, returning None if it is missing or malformed
+    value = headers.get(name)
+    if not isinstance(value, (str, int, float)):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+discord_rate_limiter = DiscordRateLimiter()
+
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+def get_http_session(name):
+    # Returns the pooled session for a host, creating it on first use. Sessions live at module level
+    # so their keep-alive connections are reused across warm Lambda invocations.
+    with http_sessions_lock:
+        session = http_sessions.get(name)
+        if session is None:
+            settings = HTTP_SESSIONS[name]
+            poolSize = settings['pool_size']
+            if 'pool_size_setting' in settings:
+                poolSize = get_config().get(settings['pool_size_setting'], poolSize)
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(
+                pool_connections=settings.get('pool_hosts', 1),
+                pool_maxsize=poolSize,
+                max_retries=settings['retries']
+            ))
+            http_sessions[name] = session
+        return session
+
+def reset_http_session(name):
+    # Drops a session after a connection error so the next request starts with fresh connections
+    with http_sessions_lock:
+        session = http_sessions.pop(name, None)
+    if session is not None:
+        session.close()
+
+def http_session_stats(name):
+    # Counts requests and newly opened connections for a session; the difference is connections reused
+    session = http_sessions.get(name)
+    stats = {'requests': 0, 'connections': 0}
+    if not isinstance(session, requests.Session):
+        return stats
+    poolManager = session.get_adapter('https://').poolmanager
+    for key in list(poolManager.pools.keys()):
+        pool = poolManager.pools.get(key)
+        if pool is not None:
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+    return stats
+
+def log_http_session_stats():
+    for name in HTTP_SESSIONS:
+        stats = http_session_stats(name)
+        if stats['requests']:
+            hot_loop_log(
+                "HTTP %s: %d requests over %d connections (%d reused) since the session was created",
+                name, stats['requests'], stats['connections'], stats['requests'] - stats['connections']
+            )
+
+def open_feed(headers):
+    # Starts a streamed GET of the 511 feed on the pooled session
+    return get_http_session('511').get(get_feed().url, stream=True, headers=headers, timeout=HTTP_SESSIONS['511']['timeout'])
+
+def execute_webhook(webhook):
+    # Posts a webhook message through the pooled Discord session, resetting the session if the connection fails
+    params = {'thread_id': webhook.thread_id} if webhook.thread_id else {}
+    try:
+        return get_http_session('discord').post(
+            webhook.url, json=webhook.json, params=params, timeout=HTTP_SESSIONS['discord']['timeout']
+        )
+    except requests.RequestException:
+        reset_http_session('discord')
+        raise
+
+def deliver_webhook(webhook):
+    # Sends a webhook now, waiting out Discord's rate limits and retrying 429s
+    route = (webhook.url, webhook.thread_id)
+    for attempt in range(DISCORD_MAX_ATTEMPTS):
+        discord_rate_limiter.wait(route)
+        response = execute_webhook(webhook)
+        run_metrics().count('DiscordRequests')
+        if not discord_rate_limiter.update(route, response):
+            if not response.ok:
+                raise Exception(f"Discord returned HTTP {response.status_code} for thread {webhook.thread_id}")
+            return response
+        run_metrics().count('DiscordRateLimited')
+        if attempt + 1 < DISCORD_MAX_ATTEMPTS:
+            run_metrics().count('DiscordRetries')
+        discord_rate_limiter.retries += 1
+        logging.warning(f"Discord rate limited thread {webhook.thread_id}, retrying")
+    raise Exception(f"Discord still rate limited after {DISCORD_MAX_ATTEMPTS} attempts")
+
+class DiscordDispatcher:
+    # Sends queued webhooks on a bounded thread pool. Each (webhook, thread) route is drained by one
+    # worker at a time, so messages to the same thread keep their order while threads send in parallel.
+    def __init__(self, maxWorkers=DISCORD_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='discord')
+        self.lock = threading.Lock()
+        self.queues = {}  # route -> deque of webhooks waiting to be sent
+        self.futures = []
+        self.failures = []  # (webhook, exception) for every message that could not be sent
+
+    def submit(self, webhook):
+        route = (webhook.url, webhook.thread_id)
+        with self.lock:
+            if route in self.queues:
+                self.queues[route].append(webhook)
+                return
+            self.queues[route] = deque([webhook])
+            # Workers run in a copy of the submitting run's context, so they count towards its metrics
+            self.futures.append(self.executor.submit(contextvars.copy_context().run, self._drain, route))
+
+    def _drain(self, route):
+        while True:
+            with self.lock:
+                queue = self.queues[route]
+                if not queue:
+                    del self.queues[route]
+                    return
+                webhook = queue.popleft()
+            try:
+                deliver_webhook(webhook)
+            except Exception as e:
+                logging.error(f"Failed to send Discord notification to thread {webhook.thread_id}: {e}")
+                run_metrics().count('DiscordFailures')
+                self.failures.append((webhook, e))
+
+    def wait(self):
+        # Blocks until everything queued has been sent, then raises the first failure, if any
+        while True:
+            with self.lock:
+                futures, self.futures = self.futures, []
+            if not futures:
+                break
+            for future in futures:
+                future.result()
+        if self.failures:
+            raise self.failures[0][1]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+# The current run's DiscordDispatcher, None outside a run
+current_dispatcher = contextvars.ContextVar('current_dispatcher', default=None)
+
+def send_webhook(webhook):
+    # Queues the webhook on the running dispatcher, or sends it straight away outside of a run
+    dispatcher = current_dispatcher.get()
+    if dispatcher is not None:
+        dispatcher.submit(webhook)
     else:
-        webhook = DiscordWebhook(url=DISCORD_WEBHOOK_URL, username=discordUsername, avatar_url=discordAvatarURL)
+        deliver_webhook(webhook)
 
-    urlWME = f"https://www.waze.com/en-GB/editor?env=usa&lon={event['Longitude']}&lat={event['Latitude']}&zoomLevel=15"
-    urlLivemap = f"https://www.waze.com/live-map/directions?dir_first=no&latlng={event['Latitude']}%2C{event['Longitude']}&overlay=false&zoom=16"
+class RunMetrics:
+    # Phase timings and counters for one run, summarised as a single Embedded Metric Format record.
+    # Updated from the Discord worker threads as well as the run itself.
+    def __init__(self, feedName=None):
+        self.feedName = feedName
+        self.lock = threading.Lock()
+        self.startedAt = time.time()
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(METRIC_PHASES, 0.0)  # phase -> seconds
+        self.counts = Counter()
+        self.outcome = 'Failed'  # until the run says otherwise
+        self.diff = None  # the run's FeedDiff, kept for replays
 
-    if 'lastTouched' in event:
-        lastTouched = int(event['lastTouched'])
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] += seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    def consumed(self, response, kind):
+        # Adds the ConsumedCapacity of a DynamoDB response to the read or write total. Batch and transaction
+        # calls return a list, one entry per table.
+        capacity = response.get('ConsumedCapacity') if isinstance(response, dict) else None
+        if isinstance(capacity, dict):
+            capacity = [capacity]
+        if isinstance(capacity, list):
+            units = sum(float(entry.get('CapacityUnits', 0)) for entry in capacity)
+            self.count(f'DynamoDB{kind}Capacity', units)
+
+    def record(self):
+        # The EMF document: metric values at the top level, described under _aws for CloudWatch to extract
+        metricValues = {f'{name}Time': round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+        metricValues['TotalTime'] = round((time.perf_counter() - self.started) * 1000, 3)
+        units = dict.fromkeys(metricValues, 'Milliseconds')
+        for name in METRIC_COUNTS:
+            metricValues[name] = self.counts.get(name, 0)
+            units[name] = 'Count'
+        return {
+            '_aws': {
+                'Timestamp': int(self.startedAt * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': get_config().get('metrics_namespace', METRICS_NAMESPACE),
+                    'Dimensions': [['Function', 'Feed']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()]
+                }]
+            },
+            'Function': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'ab511'),
+            'Feed': self.feedName or get_feed().name,
+            'Outcome': self.outcome,
+            **metricValues
+        }
+
+    def emit(self):
+        # Written straight to stdout, as EMF needs each record on a line of its own without the log prefix
+        if not get_config().get('emit_metrics', True):
+            return
+        sys.stdout.write(json.dumps(self.record()) + '\n')
+        sys.stdout.flush()
+
+# The current run's metrics. Outside a run, counts go to a throwaway instance.
+current_run = contextvars.ContextVar('current_run', default=RunMetrics())
+
+def run_metrics():
+    return current_run.get()
+
+def dynamodb_call(kind, operation, **params):
+    # Makes a DynamoDB request asking for its consumed capacity, and adds both to the run metrics.
+    # kind is 'Read' or 'Write'.
+    response = operation(ReturnConsumedCapacity='TOTAL', **params)
+    run_metrics().count('DynamoDBRequests')
+    run_metrics().consumed(response, kind)
+    return response
+
+def hot_loop_log(message, *args):
+    # Logs per-event and per-run detail at hot_loop_log_level. The message is only formatted when that level is enabled.
+    level = get_config().get('hot_loop_log_level', HOT_LOOP_LOG_LEVEL)
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    if logger.isEnabledFor(level):
+        logger.log(level, message, *args)
+
+def check_and_post_events(state=None, feed=None):
+    # Runs one poll of a feed, the first configured one by default. A long-running poller passes its PollerState
+    # so the feed state, active index, liveness and cleanup day are kept in memory instead of being read back
+    # from DynamoDB on every poll. Returns True when the full closures changed since the previous run.
+    # set the current UTC timestamp for this run
+    update_utc_timestamp()
+    return run_feed(feed if feed is not None else get_feeds()[0], state)
+
+def run_feed(feed, state=None):
+    # Processes the feed with it as the current feed and its own metrics, which are emitted as one record
+    # whether the run finishes or fails. The run's timestamp has to be set already.
+    runMetrics = RunMetrics(feed.name)
+    feedToken = current_feed.set(feed)
+    runToken = current_run.set(runMetrics)
+    try:
+        return process_feed(state)
+    finally:
+        if state is not None:
+            state.lastRun = runMetrics
+        runMetrics.emit()
+        current_run.reset(runToken)
+        current_feed.reset(feedToken)
+
+def run_feeds(feeds, states=None):
+    # Processes several feeds at once on a worker pool, all with the same run timestamp, so a run takes about as
+    # long as the slowest feed. A feed that fails is logged, and its poller state reset, without affecting the
+    # others. Returns a dict of feed name -> whether its closures changed, or the exception it failed with.
+    update_utc_timestamp()
+    states = states or {}
+    results = {}
+    workers = min(len(feeds), get_config().get('feed_workers', len(feeds)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='feed') as executor:
+        futures = {
+            feed.name: executor.submit(contextvars.copy_context().run, run_feed, feed, states.get(feed.name))
+            for feed in feeds
+        }
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.exception(f"Feed {name} failed")
+                results[name] = e
+                if name in states:
+                    states[name].reset()
+    return results
+
+def process_feed(state=None):
+    metrics = run_metrics()
+    # One cheap read tells us what the feed looked like last time
+    if state is not None and state.feedState is not None:
+        feedState = state.feedState
     else:
-        lastTouched = utc_timestamp
+        with metrics.phase('DBRead'):
+            feedState = load_feed_state()
+    # Force a full run now and then so the LastSeen checkpoint stays fresh even when nothing changes
+    heartbeatDue = utc_timestamp - int(feedState.get('CheckedAt', 0)) >= get_config().get('heartbeat_seconds', HEARTBEAT_SECONDS)
+
+    # Perform API call to AB511 API, streaming the body so it is parsed as it arrives
+    headers = {'Accept-Encoding': ACCEPT_ENCODING}
+    if not heartbeatDue:
+        if feedState.get('ETag'):
+            headers['If-None-Match'] = feedState['ETag']
+        if feedState.get('LastModified'):
+            headers['If-Modified-Since'] = feedState['LastModified']
+    response = None
+    try:
+        with metrics.phase('Fetch'):
+            response = open_feed(headers=headers)
+        if response.status_code == 304:
+            hot_loop_log("AB511 feed not modified since the last run, nothing to do")
+            metrics.outcome = 'NotModified'
+            if state is not None:
+                state.mark_seen()
+            return False
+        if not response.ok:
+            raise Exception('Issue connecting to AB511 API')
+        # Parse the feed once, keeping only full closures and the set of every ID. The body is streamed,
+        # so this includes downloading it. When recording, every event is kept for the recorder as well.
+        feedRecorder = get_recorder()
+        with metrics.phase('Parse'):
+            feedEvents = iter_json_array(response.iter_content(chunk_size=FEED_CHUNK_SIZE))
+            if feedRecorder is not None:
+                feedEvents = list(feedEvents)
+            closures, feedIds = index_feed(feedEvents)
+        metrics.count('FeedEvents', len(feedIds))
+        metrics.count('FullClosures', len(closures))
+        etag = response.headers.get('ETag')
+        lastModified = response.headers.get('Last-Modified')
+    except requests.RequestException:
+        # Covers the GET itself failing as well as the body breaking off, so the next run starts on fresh connections
+        reset_http_session('511')
+        raise
+    finally:
+        if response is not None:
+            response.close()
+    if feedRecorder is not None:
+        try:
+            feedRecorder.record(feedEvents, utc_timestamp, etag, lastModified)
+        except Exception:
+            # A recording is a debugging aid, so failing to write one never stops the run
+            logging.exception("Failed to record the feed snapshot")
+
+    # The full closures are all that matter, so an identical set means there is nothing to do
+    with metrics.phase('Diff'):
+        fingerprint = feed_fingerprint(closures)
+    changed = fingerprint != feedState.get('Fingerprint')
+    if not changed and not heartbeatDue:
+        hot_loop_log("Full closures unchanged since the last run, nothing to do")
+        metrics.outcome = 'Unchanged'
+        if state is not None:
+            state.mark_seen()
+        return False
 
-    embed = DiscordEmbed(title=f"Cleared", color='34e718')
-    embed.add_embed_field(name="Road", value=event['RoadwayName'])
-    embed.add_embed_field(name="Direction", value=event['DirectionOfTravel'])
-    embed.add_embed_field(name="Information", value=event['Description'], inline=False)
-    embed.add_embed_field(name="Start Time", value=unix_to_readable(event['StartDate']))
-    embed.add_embed_field(name="Ended", value=unix_to_readable(lastTouched))
-    embed.add_embed_field(name="Links", value=f"[WME]({urlWME}) | [Livemap]({urlLivemap})", inline=False)
-    embed.set_footer(text=config['license_notice'])
-    embed.set_timestamp(datetime.utcfromtimestamp(lastTouched))
-
-    # Send the closure notification
-    webhook.add_embed(embed)
-    webhook.execute()
-
-def check_and_post_events():
     #check if we need to clean old events
-    last_execution_day = get_last_execution_day()
     today = date.today().isoformat()
-    if last_execution_day is None or last_execution_day < today:
-        # Perform cleanup of old events
-        cleanup_old_events()
-
-        # Update last execution day to current date
-        update_last_execution_day()
-
-    # Perform API call to ON511 API
-    response = requests.get("https://511.alberta.ca/api/v2/get/event")
-    if not response.ok:
-        raise Exception('Issue connecting to AB511 API')
-
-    #use the response to close out anything recent
-    close_recent_events(response)
-    # Parse the response
-    data = json.loads(response.text)
-
-    # Iterate over the events
-    for event in data:
-        # Check if the event is a full closure
-        if event['IsFullClosure']:
-            # Create a point from the event's coordinates
-            point = Point(event['Latitude'], event['Longitude'])
-            # Try to get the event with the specified ID and isActive=1 from the DynamoDB table
-            dbResponse = table.query(
-                KeyConditionExpression=Key('EventID').eq(str(event['ID'])),
-                FilterExpression=Attr('isActive').eq(1),
-                ConsistentRead=True
-            )
-            #If the event is not in the DynamoDB table
-            update_utc_timestamp()
-            if not dbResponse['Items']:
-                # Set the EventID key in the event data
-                event['EventID'] = str(event['ID'])
-                # Set the isActive attribute
-                event['isActive'] = 1
-                # set LastTouched
-                event['lastTouched'] = utc_timestamp
-                event['DetectedPolygon'] = check_which_polygon_point(point)
-                # Convert float values in the event to Decimal
-                event = float_to_decimal(event)
-                # If the event is within the specified area and has not been posted before, post it to Discord
-                post_to_discord_closure(event,event['DetectedPolygon'])
-                # Add the event ID to the DynamoDB table
-                table.put_item(Item=event)
+    if state is None or state.cleanupDay != today:
+        with metrics.phase('DBRead'):
+            last_execution_day = get_last_execution_day()
+        if last_execution_day is None or last_execution_day < today:
+            # Perform cleanup of old events
+            cleanup_old_events()
+
+            # Update last execution day to current date
+            with metrics.phase('DBWrite'):
+                update_last_execution_day()
+        if state is not None:
+            state.cleanupDay = today
+
+    # Load every active item once, rather than querying the table for each event
+    if state is not None and state.active_index is not None:
+        active_index = state.active_index
+    else:
+        with metrics.phase('DBRead'):
+            active_index = load_active_index()
+        if state is not None:
+            state.active_index = active_index
+    # The export follows the table from where the last run left it, so it is rebuilt when this process missed a run
+    exporter = get_geojson_export()
+    if exporter is not None:
+        exporter.sync(active_index, feedState.get('Fingerprint'))
+
+    # Queue Discord notifications on a thread pool so they are sent while the DynamoDB work carries on
+    # Embeds are grouped per forum thread and sent as multi-embed messages once the run has them all
+    dispatcher = DiscordDispatcher(get_config().get('discord_workers', DISCORD_WORKERS))
+    embed_batcher = EmbedBatcher()
+    dispatcherToken = current_dispatcher.set(dispatcher)
+    batcherToken = current_embed_batcher.set(embed_batcher)
+    outbox = get_config().get('outbox', False)
+    try:
+        shardCount = get_feed().setting('shards', 1)
+        if shardCount > 1:
+            diff, writers, checkpoint = apply_shards(closures, feedIds, active_index, state, shardCount)
+        else:
+            # Work out what is new, updated, unchanged or gone in a single pass
+            with metrics.phase('Diff'):
+                diff = diff_events(closures, feedIds, active_index)
+            writer = apply_diff(diff, closures, state)
+            # The liveness checkpoint goes out on its own, once every other write is in
+            lastSeenKey = feed_key(LAST_SEEN_KEY)
+            checkpoint = writer.take(lambda eventID: eventID.startswith(lastSeenKey))
+            writers = [writer]
+        # Nothing has been written or sent yet, so a run that failed up to here leaves the feed to be re-diffed
+        pending = write_outbox(embed_batcher, writers, checkpoint) if outbox else []
+        metrics.diff = diff
+        # Remember this version of the feed so unchanged runs can stop early
+        newFeedState = {
+            'EventID': feed_key(FEED_STATE_KEY),
+            'ETag': etag,
+            'LastModified': lastModified,
+            'Fingerprint': fingerprint,
+            'CheckedAt': utc_timestamp
+        }
+        checkpoint.put(newFeedState)
+        if outbox:
+            # Each notification is stored along with the write of its event, and delivery follows from the outbox
+            with metrics.phase('DBWrite'):
+                flush_writers(writers)
+                checkpoint.flush()
+            drain_outbox(pending)
+        else:
+            # The writes of every event with a notification, like the checkpoint and feed state, wait until Discord
+            # has accepted the messages. Those of an event whose message failed are dropped along with the
+            # checkpoint, so the next run diffs it again and posts it then.
+            notified = embed_batcher.event_ids()
+            held = [writer.take(lambda eventID: eventID in notified) for writer in writers]
+            # Discord time runs from the first message queued until the last is delivered, alongside the writes
+            discordStarted = time.perf_counter()
+            messages = embed_batcher.flush()
+            metrics.count('Notifications', embed_batcher.sequence)
+            metrics.count('DiscordMessages', messages)
+            hot_loop_log("Queued %d notifications in %d Discord messages", embed_batcher.sequence, messages)
+            # Write to DynamoDB while the notifications send, then wait for them to finish
+            with metrics.phase('DBWrite'):
+                flush_writers(writers)
+            try:
+                dispatcher.wait()
+            except Exception:
+                failed = embed_batcher.failed_event_ids(dispatcher.failures)
+                for writer in held:
+                    writer.take(lambda eventID: eventID in failed)
+                with metrics.phase('DBWrite'):
+                    flush_writers(held)
+                raise
+            finally:
+                metrics.add_time('Discord', time.perf_counter() - discordStarted)
+            with metrics.phase('DBWrite'):
+                flush_writers(held)
+                checkpoint.flush()
+        if exporter is not None:
+            exporter.apply(diff, fingerprint)
+        log_http_session_stats()
+    except Exception:
+        # Some of the run's writes may be in while the feed state still has the old fingerprint, so the next
+        # run has to rebuild the export from the table rather than trust the fingerprints to match
+        if exporter is not None:
+            exporter.invalidate()
+        raise
+    finally:
+        current_embed_batcher.reset(batcherToken)
+        current_dispatcher.reset(dispatcherToken)
+        dispatcher.shutdown()
+    if state is not None:
+        state.finish_run(closures, newFeedState)
+    metrics.outcome = 'Processed'
+    return changed
+
+def apply_diff(diff, closures, state=None):
+    # Posts everything the diff found and queues its writes, including the liveness checkpoint.
+    # Returns the WriteBatcher for the caller to flush. A poller's state has its in-memory index
+    # updated to match the queued writes.
+    # Collect this run's writes so they go out in batches at the end
+    writer = get_store().writer()
+    apply_events(diff, writer, run_last_seen(state), state.active_index if state is not None else None)
+
+    # Record that every full closure in the feed was seen by this run, in one checkpoint instead of per-event writes
+    save_last_seen({eventID: utc_timestamp for eventID in closures}, writer)
+
+    hot_loop_log("Region cache: %s", region_cache.stats())
+    return writer
+
+def run_last_seen(state=None):
+    # The liveness checkpoint of the last run, from a poller's memory when it has one
+    if state is not None and state.lastSeen is not None:
+        return state.lastSeen
+    with run_metrics().phase('DBRead'):
+        return load_last_seen()
+
+def apply_events(diff, writer, lastSeen, active_index=None):
+    # Posts the closures the diff found and queues their item writes on writer, keeping a poller's
+    # active_index in step with them
+    #use the diff to close out anything recent
+    close_recent_events(diff, writer, lastSeen)
+    if active_index is not None:
+        for item in diff.cleared + diff.downgraded:
+            active_index.pop(item['EventID'], None)
+
+    # Work out the region of every event we are about to post, reusing stored and cached results
+    with run_metrics().phase('Classify'):
+        regionByID = resolve_regions([(event, None) for event in diff.new] + diff.updated)
+    diff.regions = regionByID
+
+    # Events we have never seen before: post them, then queue the slim item to be stored
+    for event in diff.new:
+        region = regionByID[event_key(event)]
+        hot_loop_log("New closure %s in %s", event['ID'], region)
+        post_to_discord_closure(event, region)
+        queue_item(writer, build_item(event, region), active_index)
+
+    # Events we have seen before, but whose stored version is out of date
+    for event, storedItem in diff.updated:
+        region = regionByID[event_key(event)]
+        # It's different, so we should fire an update notification
+        hot_loop_log("Updated closure %s in %s", event['ID'], region)
+        post_to_discord_updated(event, region)
+        queue_item(writer, build_item(event, region), active_index)
+
+    # Only the timestamp moved: keep the item current with a small update, and don't post
+    for event, storedItem in diff.touched:
+        writer.touch(storedItem['EventID'], event['LastUpdated'], utc_timestamp)
+        storedItem['LastUpdated'] = to_decimal(event['LastUpdated'])
+        storedItem['lastTouched'] = utc_timestamp
+    run_metrics().count('New', len(diff.new))
+    run_metrics().count('Updated', len(diff.updated))
+    run_metrics().count('Touched', len(diff.touched))
+    run_metrics().count('Cleared', len(diff.cleared) + len(diff.downgraded))
+
+def shard_of(eventID, shardCount):
+    # Stable across runs and processes, unlike hash(), so an event always lands on the same shard
+    return zlib.crc32(eventID.encode()) % shardCount
+
+def partition_shards(closures, active_index, shardCount):
+    # Splits the feed's full closures and the active items into shardCount pairs of dicts by EventID
+    shards = [({}, {}) for _ in range(shardCount)]
+    for eventID, event in closures.items():
+        shards[shard_of(eventID, shardCount)][0][eventID] = event
+    for eventID, item in active_index.items():
+        shards[shard_of(eventID, shardCount)][1][eventID] = item
+    return shards
+
+def apply_shards(closures, feedIds, active_index, state, shardCount):
+    # Splits the run by EventID hash and diffs, classifies and posts each shard on its own worker, so a large
+    # feed's work proceeds side by side. Notifications still share the run's embed batcher. Nothing is written
+    # here: returns the merged diff, every shard's writer and a writer holding the liveness checkpoint, for the
+    # caller to flush once all the shards have succeeded, so a failed shard leaves the whole feed to be re-diffed.
+    lastSeen = run_last_seen(state)
+    pollerIndex = state.active_index if state is not None else None
+
+    def run_shard(shardClosures, shardIndex):
+        with run_metrics().phase('Diff'):
+            diff = diff_events(shardClosures, feedIds, shardIndex)
+        writer = get_store().writer()
+        apply_events(diff, writer, lastSeen, pollerIndex)
+        return diff, writer
+
+    workers = min(shardCount, get_feed().setting('shard_workers', shardCount))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard') as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, run_shard, shardClosures, shardIndex)
+            for shardClosures, shardIndex in partition_shards(closures, active_index, shardCount)
+        ]
+        results = [future.result() for future in futures]
+    hot_loop_log("Applied %d shards on %d workers", shardCount, workers)
+
+    checkpoint = get_store().writer()
+    save_last_seen({eventID: utc_timestamp for eventID in closures}, checkpoint)
+    hot_loop_log("Region cache: %s", region_cache.stats())
+    return merge_diffs([diff for diff, writer in results]), [writer for diff, writer in results], checkpoint
+
+def flush_writers(writers):
+    # Flushes several writers side by side, one worker each, as a sharded run queued them
+    if len(writers) == 1:
+        writers[0].flush()
+        return
+    with ThreadPoolExecutor(max_workers=len(writers), thread_name_prefix='flush') as executor:
+        futures = [executor.submit(contextvars.copy_context().run, writer.flush) for writer in writers]
+        for future in futures:
+            future.result()
+
+def merge_diffs(diffs):
+    # Combines per-shard diffs into the diff of the whole run
+    merged = FeedDiff()
+    for diff in diffs:
+        for name in ('new', 'updated', 'touched', 'unchanged', 'downgraded', 'cleared'):
+            getattr(merged, name).extend(getattr(diff, name))
+        merged.regions.update(diff.regions)
+    return merged
+
+def outbox_item(threadID, embed, eventTime, sequence, tag):
+    # A pending notification. The key is a digest of what it says and which event it is about, so a run retried
+    # after failing to write its state rewrites the same items instead of queueing the notifications twice.
+    embedJSON = json.dumps(embed, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha256(f"{tag}\n{threadID}\n{embedJSON}".encode()).hexdigest()[:32]
+    return {
+        'EventID': feed_key(f"{OUTBOX_KEY}#{digest}"),
+        'OutboxFlag': INDEX_FLAG,
+        # Thread IDs from config.json can be numbers, which DynamoDB would give back as Decimal
+        'ThreadID': None if threadID is None else str(threadID),
+        'Embed': embedJSON,
+        'EventTime': eventTime,
+        'Sequence': sequence,
+        'Attempts': 0,
+        'NextAttemptAt': utc_timestamp
+    }
+
+def write_outbox(embed_batcher, writers, fallback):
+    # Moves the notifications collected so far into the outbox. Each item is queued on the writer holding the write of
+    # the event it announces, to land in the same transaction, so a run whose writes fail part way stores the
+    # notifications of exactly the events it stored. Any other goes on fallback. Returns the items for the run to
+    # deliver once the writers are flushed.
+    owners = {eventID: writer for writer in writers for eventID in writer.event_ids()}
+    items = []
+    for threadID, (eventTime, sequence, embed, tag) in embed_batcher.take():
+        item = outbox_item(threadID, embed, eventTime, sequence, tag)
+        eventID = tag_event_id(tag)
+        if eventID in owners:
+            owners[eventID].put_with(eventID, item)
+        else:
+            fallback.put(item)
+        items.append(item)
+    run_metrics().count('Notifications', len(items))
+    return items
+
+def outbox_thread_id(item):
+    # Items written before ThreadID was stored as a string may hold it as a number
+    threadID = item.get('ThreadID')
+    return str(int(threadID)) if isinstance(threadID, Decimal) else threadID
+
+def drain_outbox(pending=()):
+    # Delivers the feed's due outbox notifications, packed per forum thread as a run packs them, and deletes
+    # each once Discord has accepted its message. pending holds items just written, which the index may not
+    # show yet. Each item is claimed before it is sent, so drains running at once never both deliver it.
+    # A message that fails is retried by a later drain. Returns the number of messages delivered.
+    store = get_store()
+    with run_metrics().phase('DBRead'):
+        items = {item['EventID']: item for item in store.load_outbox(feed_key(OUTBOX_KEY))}
+    items.update((item['EventID'], item) for item in pending)
+    leaseUntil = utc_timestamp + OUTBOX_CLAIM_SECONDS
+    with run_metrics().phase('DBWrite'):
+        claimed = [
+            item for item in items.values()
+            if item['NextAttemptAt'] <= utc_timestamp and store.claim(item['EventID'], item['NextAttemptAt'], leaseUntil)
+        ]
+    embed_batcher = EmbedBatcher()
+    for item in claimed:
+        embed_batcher.add(outbox_thread_id(item), json.loads(item['Embed']), item['EventTime'], item)
+    messages = embed_batcher.pack_entries()
+    if not messages:
+        return 0
+
+    discordStarted = time.perf_counter()
+    dispatcher = DiscordDispatcher(get_config().get('discord_workers', DISCORD_WORKERS))
+    sent = []
+    try:
+        for threadID, entries in messages:
+            webhook = new_webhook(threadID, [entry[2] for entry in entries])
+            sent.append((webhook, [entry[3] for entry in entries]))
+            dispatcher.submit(webhook)
+        try:
+            dispatcher.wait()
+        except Exception:
+            # Each failure was logged as it happened, and its notifications are retried below
+            pass
+    finally:
+        dispatcher.shutdown()
+    run_metrics().add_time('Discord', time.perf_counter() - discordStarted)
+    run_metrics().count('DiscordMessages', len(messages))
+    delivered = len(messages) - len(dispatcher.failures)
+    hot_loop_log("Delivered %d of %d outbox notification messages", delivered, len(messages))
+
+    failed = {id(webhook) for webhook, error in dispatcher.failures}
+    writer = store.writer()
+    for webhook, outboxItems in sent:
+        for item in outboxItems:
+            if id(webhook) in failed:
+                retry_outbox_item(item, writer)
             else:
-                # We have seen this event before
-                # First, let's see if it has a lastupdated time
-                event = float_to_decimal(event)
-                lastUpdated = dbResponse['Items'][0].get('LastUpdated')
-                if lastUpdated != None:
-                    # Now, see if the version we stored is different
-                    if lastUpdated != event['LastUpdated']:
-                        # Store the most recent updated time:
-                        event['EventID'] = str(event['ID'])
-                        event['isActive'] = 1
-                        event['lastTouched'] = utc_timestamp
-                        event['DetectedPolygon'] = check_which_polygon_point(point)
-                        # It's different, so we should fire an update notification
-                        post_to_discord_updated(event,event['DetectedPolygon'])
-                        table.put_item(Item=event)
-                # Get the lastTouched time
-                lastTouched = dbResponse['Items'][0].get('lastTouched')
-                if lastTouched is None:
-                    logging.warning(f"EventID: {event['ID']} - Missing lastTouched. Setting it now.")
-                    lastTouched_datetime = now
+                writer.delete({'EventID': item['EventID']})
+    with run_metrics().phase('DBWrite'):
+        writer.flush()
+    return delivered
+
+def retry_outbox_item(item, writer):
+    # Puts a failed notification back with exponential backoff, or gives up on it after OUTBOX_MAX_ATTEMPTS
+    attempts = int(item.get('Attempts', 0)) + 1
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        logging.error(f"Giving up on notification {item['EventID']} after {attempts} attempts: {item['Embed']}")
+        run_metrics().count('OutboxDropped')
+        writer.delete({'EventID': item['EventID']})
+        return
+    delay = min(OUTBOX_RETRY_MAX_SECONDS, OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    run_metrics().count('OutboxRetries')
+    writer.put(dict(item, Attempts=attempts, NextAttemptAt=utc_timestamp + delay))
+
+def drain_feeds(feeds=None):
+    # Delivers every feed's due outbox notifications outside of a run, for a separate schedule or by hand
+    update_utc_timestamp()
+    sent = {}
+    for feed in feeds or get_feeds():
+        feedToken = current_feed.set(feed)
+        runToken = current_run.set(RunMetrics(feed.name))
+        try:
+            sent[feed.name] = drain_outbox()
+        finally:
+            current_run.reset(runToken)
+            current_feed.reset(feedToken)
+    return sent
+
+def queue_item(writer, item, active_index=None):
+    writer.put(item)
+    if active_index is not None:
+        # Kept in the form DynamoDB would return it, so the next diff compares like with like
+        active_index[item['EventID']] = float_to_decimal(item)
+
+@dataclass
+class PollerState:
+    # What a long-running poller keeps in memory between polls. None means "not loaded yet": the next poll
+    # reads it from DynamoDB, which is also how the state recovers after a failed poll.
+    feedState: dict = None
+    active_index: dict = None
+    lastSeen: dict = None  # EventID -> the last poll that saw it, for every current full closure
+    cleanupDay: str = None
+    lastRun: object = None  # the RunMetrics of the last poll
+
+    def mark_seen(self):
+        # The feed didn't change, so every known closure was seen again by this poll
+        if self.lastSeen is not None:
+            self.lastSeen = dict.fromkeys(self.lastSeen, utc_timestamp)
+
+    def finish_run(self, closures, feedState):
+        # Records what a full run wrote; apply_diff has already brought active_index up to date
+        self.lastSeen = {eventID: utc_timestamp for eventID in closures}
+        self.feedState = feedState
+
+    def reset(self):
+        self.feedState = self.active_index = self.lastSeen = self.cleanupDay = None
+
+class WriteBatcher:
+    # Collects a run's table mutations and flushes them in as few requests as possible:
+    # puts and deletes through BatchWriteItem, deactivations through TransactWriteItems. Touches are
+    # plain UpdateItems sent side by side, at half a transaction's write cost and each failing alone.
+    # Items put with an event's write go in the same transaction as it.
+    def __init__(self, tableName, client=None):
+        self.tableName = tableName
+        self.client = client if client is not None else get_client()
+        self.writes = {}  # EventID -> write request, the last write to a key wins
+        self.updates = {}  # EventID -> (update expression, values), kept in insertion order
+        self.touches = {}  # EventID -> values for TOUCH_EXPRESSION
+        self.attached = {}  # EventID -> {EventID: Put action} of the items put with that event's write
+        self.requests = 0
+
+    def put(self, item):
+        self.writes[item['EventID']] = {'PutRequest': {'Item': serialize_item(item)}}
+
+    def delete(self, key):
+        self.writes[key['EventID']] = {'DeleteRequest': {'Key': serialize_item(key)}}
+
+    def update(self, eventID, expression, values):
+        self.updates[eventID] = (expression, values)
+
+    def deactivate(self, eventID):
+        self.update(eventID, DEACTIVATE_EXPRESSION, {':val': 0, ':flag': INDEX_FLAG})
+
+    def touch(self, eventID, lastUpdated, lastTouched):
+        self.touches[eventID] = {':updated': lastUpdated, ':touched': lastTouched}
+
+    def put_with(self, eventID, item):
+        # Puts item in the same transaction as the write queued for eventID, so neither lands without the other
+        self.attached.setdefault(eventID, {})[item['EventID']] = {
+            'Put': {'TableName': self.tableName, 'Item': serialize_item(item)}
+        }
+
+    def event_ids(self):
+        # The EventIDs of every queued write
+        return set(self.writes) | set(self.updates) | set(self.touches)
+
+    def take(self, selected):
+        # Moves the queued writes to every key selected(eventID) picks into a new WriteBatcher, flushed on its own
+        taken = WriteBatcher(self.tableName, self.client)
+        for name in ('writes', 'updates', 'touches', 'attached'):
+            queued = getattr(self, name)
+            setattr(taken, name, {eventID: write for eventID, write in queued.items() if selected(eventID)})
+            setattr(self, name, {eventID: write for eventID, write in queued.items() if not selected(eventID)})
+        return taken
+
+    def flush(self):
+        pending = len(self.writes) + len(self.updates) + len(self.touches) + sum(map(len, self.attached.values()))
+        self._transact_groups([self._paired_actions(eventID, attached) for eventID, attached in self.attached.items()])
+        self.attached = {}
+        updates = list(self.updates.items())
+        for start in range(0, len(updates), TRANSACT_WRITE_SIZE):
+            self._transact_update(updates[start:start + TRANSACT_WRITE_SIZE])
+        writes = list(self.writes.values())
+        for start in range(0, len(writes), BATCH_WRITE_SIZE):
+            self._batch_write(writes[start:start + BATCH_WRITE_SIZE])
+        self._update_items([(eventID, (TOUCH_EXPRESSION, values)) for eventID, values in self.touches.items()])
+        self.writes = {}
+        self.updates = {}
+        self.touches = {}
+        if pending:
+            hot_loop_log("Flushed %d writes to %s in %d requests", pending, self.tableName, self.requests)
+
+    def _batch_write(self, writeRequests):
+        # Sends one BatchWriteItem, retrying anything DynamoDB leaves unprocessed with exponential backoff
+        requestItems = {self.tableName: writeRequests}
+        for attempt in range(WRITE_RETRY_ATTEMPTS):
+            self.requests += 1
+            response = dynamodb_call('Write', self.client.batch_write_item, RequestItems=requestItems)
+            requestItems = response.get('UnprocessedItems')
+            if not requestItems:
+                return
+            time.sleep(WRITE_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+        raise Exception(f"{sum(len(v) for v in requestItems.values())} writes left unprocessed by DynamoDB")
+
+    def _paired_actions(self, eventID, attached):
+        # The transaction actions of the write queued for eventID and the items put with it. The write leaves its queue.
+        actions = []
+        if eventID in self.writes:
+            request = self.writes.pop(eventID)
+            if 'PutRequest' in request:
+                actions.append({'Put': {'TableName': self.tableName, 'Item': request['PutRequest']['Item']}})
+            else:
+                actions.append({'Delete': {'TableName': self.tableName, 'Key': request['DeleteRequest']['Key']}})
+        elif eventID in self.updates:
+            actions.append(self._update_action(eventID, *self.updates.pop(eventID)))
+        elif eventID in self.touches:
+            actions.append(self._update_action(eventID, TOUCH_EXPRESSION, self.touches.pop(eventID)))
+        return actions + list(attached.values())
+
+    def _transact_groups(self, groups):
+        # Sends groups of actions that must land together, as many whole groups to a transaction as fit. The groups of a
+        # cancelled transaction are retried one transaction each, so a group never lands in part.
+        from botocore.exceptions import ClientError
+        transactions = []
+        size = TRANSACT_WRITE_SIZE
+        for group in groups:
+            if size + len(group) > TRANSACT_WRITE_SIZE:
+                transactions.append([])
+                size = 0
+            transactions[-1].append(group)
+            size += len(group)
+        for transaction in transactions:
+            try:
+                self._transact([action for group in transaction for action in group])
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'TransactionCanceledException' or len(transaction) == 1:
+                    raise
+                logging.warning(f"Paired write transaction cancelled, retrying its {len(transaction)} groups one at a time")
+                for group in transaction:
+                    self._transact(group)
+
+    def _transact(self, actions):
+        self.requests += 1
+        dynamodb_call('Write', self.client.transact_write_items, TransactItems=actions)
+
+    def _update_action(self, eventID, expression, values):
+        return {
+            'Update': {
+                'TableName': self.tableName,
+                'Key': {'EventID': {'S': eventID}},
+                'UpdateExpression': expression,
+                'ExpressionAttributeValues': serialize_item(values)
+            }
+        }
+
+    def _transact_update(self, updates):
+        # Applies a group of updates in one transaction, falling back to single updates if it is cancelled
+        from botocore.exceptions import ClientError
+        try:
+            self._transact([self._update_action(eventID, expression, values) for eventID, (expression, values) in updates])
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            logging.warning(f"Update transaction cancelled, retrying {len(updates)} items one at a time")
+        self._update_items(updates)
+
+    def _update_items(self, updates):
+        # Sends each (eventID, (expression, values)) as its own UpdateItem, UPDATE_WORKERS at a time
+        if not updates:
+            return
+        self.requests += len(updates)
+        with ThreadPoolExecutor(max_workers=min(UPDATE_WORKERS, len(updates)), thread_name_prefix='update') as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._update_item, eventID, expression, values)
+                for eventID, (expression, values) in updates
+            ]
+            for future in futures:
+                future.result()
+
+    def _update_item(self, eventID, expression, values):
+        dynamodb_call(
+            'Write', self.client.update_item,
+            TableName=self.tableName,
+            Key={'EventID': {'S': eventID}},
+            UpdateExpression=expression,
+            ExpressionAttributeValues=serialize_item(values)
+        )
+
+def get_consistent_read(readName, default=False):
+    # Read consistency is configurable per read through the 'consistent_reads' map in config.json
+    return bool(get_config().get('consistent_reads', {}).get(readName, default))
+
+def set_active_flags(item, active):
+    # Sets isActive along with the sparse index keys: only active items carry ActiveFlag,
+    # and only inactive items carry InactiveFlag
+    item['isActive'] = 1 if active else 0
+    item.pop('InactiveFlag' if active else 'ActiveFlag', None)
+    item['ActiveFlag' if active else 'InactiveFlag'] = INDEX_FLAG
+    return item
+
+def load_active_index(consistentRead=None):
+    # Loads every active item of the current feed and returns a dict of EventID -> item
+    if consistentRead is None:
+        consistentRead = get_consistent_read('active_index')
+    feed = get_feed()
+    active_index = get_store().load_active(consistentRead, feed.keyPrefix)
+    if feed.excludedPrefixes:
+        active_index = {eventID: item for eventID, item in active_index.items() if feed.owns(eventID)}
+    return active_index
+
+def batch_get_items(eventIDs, consistentRead=False, projection=None):
+    # Fetches items by EventID through BatchGetItem, 100 keys per request
+    items = []
+    for start in range(0, len(eventIDs), BATCH_GET_SIZE):
+        requestItems = {table_name(): {
+            'Keys': [{'EventID': {'S': eventID}} for eventID in eventIDs[start:start + BATCH_GET_SIZE]],
+            'ConsistentRead': consistentRead,
+            **(projection or {})
+        }}
+        for attempt in range(WRITE_RETRY_ATTEMPTS):
+            response = dynamodb_call('Read', get_client().batch_get_item, RequestItems=requestItems)
+            items.extend(deserialize_item(item) for item in response['Responses'].get(table_name(), []))
+            requestItems = response.get('UnprocessedKeys')
+            if not requestItems:
+                break
+            time.sleep(WRITE_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+        else:
+            raise Exception(f"{len(requestItems[table_name()]['Keys'])} keys left unprocessed by DynamoDB")
+    return items
+
+def backfill_index_flags():
+    # One-off migration: adds ActiveFlag/InactiveFlag to items written before the sparse indexes existed
+    scan_params = {
+        'TableName': table_name(),
+        'FilterExpression': 'attribute_exists(isActive) AND attribute_not_exists(ActiveFlag) AND attribute_not_exists(InactiveFlag)'
+    }
+    writer = WriteBatcher(table_name())
+    while True:
+        response = dynamodb_call('Read', get_client().scan, **scan_params)
+        for item in map(deserialize_item, response['Items']):
+            writer.put(set_active_flags(item, item['isActive'] == 1))
+        if 'LastEvaluatedKey' in response:
+            scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        else:
+            break
+    writer.flush()
+
+class DynamoDBStore:
+    # State in the DynamoDB table: active events through the sparse ActiveEvents index, expired events
+    # through InactiveEvents, and writes through WriteBatcher. Every request goes through the client, which
+    # feeds processed at once can share, with items converted to and from the resource layer's form.
+    def query_items(self, indexName, condition, values, **params):
+        # Yields every item an index query matches, reading page after page
+        query_params = {
+            'TableName': table_name(),
+            'IndexName': indexName,
+            'KeyConditionExpression': condition,
+            'ExpressionAttributeValues': serialize_item(values),
+            **params
+        }
+        while True:
+            response = dynamodb_call('Read', get_client().query, **query_params)
+            for item in response['Items']:
+                yield deserialize_item(item)
+            if 'LastEvaluatedKey' in response:
+                query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            else:
+                break
+
+    def load_active(self, consistentRead=False, prefix=''):
+        # Global secondary indexes are eventually consistent, so a consistent read re-fetches the items from the table.
+        # The index is sorted by EventID, so one feed's items are read with a prefix condition.
+        condition = 'ActiveFlag = :flag'
+        values = {':flag': INDEX_FLAG}
+        if prefix:
+            condition += ' AND begins_with(EventID, :prefix)'
+            values[':prefix'] = prefix
+        active_index = {item['EventID']: item for item in self.query_items(ACTIVE_INDEX, condition, values, **ITEM_PROJECTION)}
+        if consistentRead and active_index:
+            active_index = {
+                item['EventID']: item
+                for item in batch_get_items(list(active_index), consistentRead=True, projection=ITEM_PROJECTION)
+                if item.get('isActive') == 1
+            }
+        return active_index
+
+    def load_outbox(self, prefix):
+        # Pending notifications, from the sparse index of items carrying OutboxFlag
+        return list(self.query_items(
+            OUTBOX_INDEX, 'OutboxFlag = :flag AND begins_with(EventID, :prefix)', {':flag': INDEX_FLAG, ':prefix': prefix}
+        ))
+
+    def get_item(self, eventID, consistentRead=False):
+        item = dynamodb_call(
+            'Read', get_client().get_item,
+            TableName=table_name(), Key={'EventID': {'S': eventID}}, ConsistentRead=consistentRead
+        ).get('Item')
+        return deserialize_item(item) if item is not None else None
+
+    def get_items(self, eventIDs, consistentRead=False):
+        return batch_get_items(eventIDs, consistentRead)
+
+    def put_item(self, item):
+        dynamodb_call('Write', get_client().put_item, TableName=table_name(), Item=serialize_item(item))
+
+    def claim(self, eventID, nextAttemptAt, leaseUntil):
+        # Moves an outbox item's NextAttemptAt on to leaseUntil, unless another drain already has
+        from botocore.exceptions import ClientError
+        try:
+            dynamodb_call(
+                'Write', get_client().update_item,
+                TableName=table_name(),
+                Key={'EventID': {'S': eventID}},
+                UpdateExpression=CLAIM_EXPRESSION,
+                ConditionExpression=CLAIM_CONDITION,
+                ExpressionAttributeValues=serialize_item({':lease': leaseUntil, ':due': nextAttemptAt})
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+
+    def expired_events(self, cutoff):
+        # EventIDs of inactive events last updated before the cutoff, from the sparse index sorted by LastUpdated
+        for item in self.query_items(
+            INACTIVE_INDEX, 'InactiveFlag = :flag AND LastUpdated < :cutoff', {':flag': INDEX_FLAG, ':cutoff': cutoff},
+            ProjectionExpression='EventID'
+        ):
+            yield item['EventID']
+
+    def writer(self):
+        return WriteBatcher(table_name())
+
+class LocalWriter:
+    # Queues a run's writes for a local store and applies them together on flush, as one transaction
+    def __init__(self, store):
+        self.store = store
+        self.operations = []
+        self.requests = 0
+
+    def put(self, item):
+        self.operations.append(('put', item['EventID'], serialize_item(item)))
+
+    def delete(self, key):
+        self.operations.append(('delete', key['EventID'], None))
+
+    def deactivate(self, eventID):
+        self.operations.append(('update', eventID, {'isActive': {'N': '0'}, 'InactiveFlag': {'S': INDEX_FLAG}, 'ActiveFlag': None}))
+
+    def touch(self, eventID, lastUpdated, lastTouched):
+        self.operations.append(('update', eventID, serialize_item({'LastUpdated': lastUpdated, 'lastTouched': lastTouched})))
+
+    def put_with(self, eventID, item):
+        # The whole flush is one transaction, so the item already lands along with eventID's write
+        self.put(item)
+
+    def event_ids(self):
+        # The EventIDs of every queued operation
+        return {operation[1] for operation in self.operations}
+
+    def take(self, selected):
+        # Moves the queued operations on every key selected(eventID) picks into a new LocalWriter, keeping their order
+        taken = LocalWriter(self.store)
+        taken.operations = [operation for operation in self.operations if selected(operation[1])]
+        self.operations = [operation for operation in self.operations if not selected(operation[1])]
+        return taken
+
+    def flush(self):
+        if self.operations:
+            self.requests += 1
+            self.store.apply(self.operations)
+            self.operations = []
+
+def apply_local_operation(stored, operation, attributes):
+    # Applies a LocalWriter operation to an item held as DynamoDB attribute values. Returns the new item,
+    # or None if it is deleted. Like DynamoDB, an update to a missing item creates it.
+    if operation == 'put':
+        return attributes
+    if operation == 'delete':
+        return None
+    item = dict(stored or {})
+    for name, value in attributes.items():
+        if value is None:
+            item.pop(name, None)
+        else:
+            item[name] = value
+    return item
+
+def claim_local(stored, nextAttemptAt, leaseUntil):
+    # The local stores' version of DynamoDBStore.claim, on an item held as DynamoDB attribute values.
+    # Returns the claimed item, or None if it is gone or was claimed by someone else.
+    if stored is None or Decimal(stored.get('NextAttemptAt', {}).get('N', 'NaN')) != nextAttemptAt:
+        return None
+    return dict(stored, NextAttemptAt=serialize_value(leaseUntil))
+
+class MemoryStore:
+    # State held in process memory, for tests, benchmarks and a single long-running poller that can
+    # afford to start from nothing after a restart
+    def __init__(self):
+        self.items = {}  # EventID -> item as DynamoDB attribute values
+        self.lock = threading.Lock()
+
+    def load_active(self, consistentRead=False, prefix=''):
+        with self.lock:
+            return {eventID: deserialize_item(item) for eventID, item in self.items.items()
+                    if 'ActiveFlag' in item and eventID.startswith(prefix)}
+
+    def load_outbox(self, prefix):
+        with self.lock:
+            return [deserialize_item(item) for eventID, item in self.items.items()
+                    if 'OutboxFlag' in item and eventID.startswith(prefix)]
+
+    def get_item(self, eventID, consistentRead=False):
+        with self.lock:
+            item = self.items.get(eventID)
+        return deserialize_item(item) if item is not None else None
+
+    def get_items(self, eventIDs, consistentRead=False):
+        with self.lock:
+            return [deserialize_item(self.items[eventID]) for eventID in eventIDs if eventID in self.items]
+
+    def put_item(self, item):
+        self.apply([('put', item['EventID'], serialize_item(item))])
+
+    def claim(self, eventID, nextAttemptAt, leaseUntil):
+        with self.lock:
+            item = claim_local(self.items.get(eventID), nextAttemptAt, leaseUntil)
+            if item is not None:
+                self.items[eventID] = item
+            return item is not None
+
+    def expired_events(self, cutoff):
+        with self.lock:
+            return [eventID for eventID, item in self.items.items()
+                    if 'InactiveFlag' in item and 'LastUpdated' in item and Decimal(item['LastUpdated']['N']) < cutoff]
+
+    def writer(self):
+        return LocalWriter(self)
+
+    def apply(self, operations):
+        with self.lock:
+            for operation, eventID, attributes in operations:
+                item = apply_local_operation(self.items.get(eventID), operation, attributes)
+                if item is None:
+                    self.items.pop(eventID, None)
                 else:
-                    lastTouched_datetime = datetime.fromtimestamp(int(lastTouched))
-                # store the current time now
-                now = datetime.fromtimestamp(utc_timestamp)
-                # Compute the difference in minutes between now and lastUpdated
-                time_diff_min = (now - lastTouched_datetime).total_seconds() / 60
-                # Compute the variability
-                variability = random.uniform(-2, 2)  # random float between -2 and 2
-                # Add variability to the time difference
-                time_diff_min += variability
-                # Log calculated time difference and variability
-                logging.info(
-                    f"EventID: {event['ID']}, TimeDiff: {time_diff_min:.2f} minutes (Variability: {variability:.2f}), LastTouched: {lastTouched_datetime}, Now: {now}"
-                )
-                # If time_diff_min > 5, then more than 5 minutes have passed (considering variability)
-                if abs(time_diff_min) > 5:
-                    logging.info(f"EventID: {event['ID']} - Updating lastTouched to {utc_timestamp}.")
-                    response = table.update_item(
-                        Key={'EventID': str(event['ID'])},
-                        UpdateExpression="SET lastTouched = :val",
-                        ExpressionAttributeValues={':val': utc_timestamp}
+                    self.items[eventID] = item
+
+class SQLiteStore:
+    # State in a local SQLite file in WAL mode. Items are stored as their DynamoDB attribute values, with the
+    # index flags and LastUpdated copied into columns: partial indexes on them stand in for the sparse GSIs.
+    def __init__(self, path):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SQLITE_SCHEMA)
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def load_active(self, consistentRead=False, prefix=''):
+        rows = self.query('SELECT EventID, Item FROM events WHERE Active = 1 AND substr(EventID, 1, ?) = ?', (len(prefix), prefix))
+        return {eventID: deserialize_item(json.loads(item)) for eventID, item in rows}
+
+    def load_outbox(self, prefix):
+        # Outbox keys share a prefix, so they are a range of the primary key
+        rows = self.query('SELECT Item FROM events WHERE EventID >= ? AND EventID < ?', (prefix, prefix + '\U0010ffff'))
+        return [deserialize_item(json.loads(item)) for item, in rows]
+
+    def get_item(self, eventID, consistentRead=False):
+        rows = self.query('SELECT Item FROM events WHERE EventID = ?', (eventID,))
+        return deserialize_item(json.loads(rows[0][0])) if rows else None
+
+    def get_items(self, eventIDs, consistentRead=False):
+        items = []
+        for start in range(0, len(eventIDs), SQLITE_VARIABLE_LIMIT):
+            keys = eventIDs[start:start + SQLITE_VARIABLE_LIMIT]
+            rows = self.query(f"SELECT Item FROM events WHERE EventID IN ({', '.join('?' * len(keys))})", keys)
+            items.extend(deserialize_item(json.loads(item)) for item, in rows)
+        return items
+
+    def put_item(self, item):
+        self.apply([('put', item['EventID'], serialize_item(item))])
+
+    def claim(self, eventID, nextAttemptAt, leaseUntil):
+        # BEGIN IMMEDIATE takes the write lock first, so other processes sharing the file see the claim or wait for it
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                row = cursor.execute('SELECT Item FROM events WHERE EventID = ?', (eventID,)).fetchone()
+                item = claim_local(json.loads(row[0]) if row else None, nextAttemptAt, leaseUntil)
+                if item is not None:
+                    cursor.execute('UPDATE events SET Item = ? WHERE EventID = ?', (json.dumps(item), eventID))
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+        return item is not None
+
+    def expired_events(self, cutoff):
+        rows = self.query('SELECT EventID FROM events WHERE Inactive = 1 AND LastUpdated < ?', (float(cutoff),))
+        return [eventID for eventID, in rows]
+
+    def writer(self):
+        return LocalWriter(self)
+
+    def apply(self, operations):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for operation, eventID, attributes in operations:
+                    stored = None
+                    if operation == 'update':
+                        row = cursor.execute('SELECT Item FROM events WHERE EventID = ?', (eventID,)).fetchone()
+                        stored = json.loads(row[0]) if row else None
+                    item = apply_local_operation(stored, operation, attributes)
+                    if item is None:
+                        cursor.execute('DELETE FROM events WHERE EventID = ?', (eventID,))
+                        continue
+                    cursor.execute(
+                        'INSERT OR REPLACE INTO events (EventID, Active, Inactive, LastUpdated, Item) VALUES (?, ?, ?, ?, ?)',
+                        (eventID, 1 if 'ActiveFlag' in item else None, 1 if 'InactiveFlag' in item else None,
+                         float(item['LastUpdated']['N']) if 'N' in item.get('LastUpdated', {}) else None, json.dumps(item))
                     )
-                    logging.info(f"Update response for EventID {event['ID']}: {response}")
-                    logging.info(f"EventID: {event['ID']} - lastTouched updated successfully.")
-                # else:
-                #     logging.info(f"EventID: {event['ID']} - No update needed. TimeDiff: {time_diff_min:.2f}")
-
-def close_recent_events(responseObject):
-    #function uses the API response from ON511 to determine what we stored in the DB that can now be closed
-    #if it finds a closure no longer listed in the response object, then it marks it closed and posts to discord
-    data = json.loads(responseObject.text)
-
-    # Create a set of active event IDs
-    active_event_ids = {str(event['ID']) for event in data}
-
-    # Get the list of event IDs in the table
-    response = table.scan(
-        FilterExpression=Attr('isActive').eq(1)
-    )
-    # Iterate over the items
-    for item in response['Items']:
-        markCompleted = False
-        # If an item's ID is not in the set of active event IDs, mark it as closed
-        if item['EventID'] not in active_event_ids:
-            markCompleted = True
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+STATE_STORES = {
+    'dynamodb': lambda settings: DynamoDBStore(),
+    'sqlite': lambda settings: SQLiteStore(settings.get('sqlite_path', SQLITE_PATH)),
+    'memory': lambda settings: MemoryStore()
+}
+
+def get_store():
+    # Creates the configured state store once. config.json's 'state_store' picks the backend, DynamoDB by default.
+    global store
+    if store is None:
+        with init_lock:
+            if store is None:
+                name = get_config().get('state_store', 'dynamodb')
+                if name not in STATE_STORES:
+                    raise Exception(f"Unknown state_store '{name}', expected one of {', '.join(STATE_STORES)}")
+                store = STATE_STORES[name](get_config())
+    return store
+
+@dataclass
+class FeedDiff:
+    # Result of comparing one feed snapshot against the stored active events
+    new: list = field(default_factory=list)         # feed events with no active item
+    updated: list = field(default_factory=list)     # (event, storedItem) pairs whose LastUpdated and content changed
+    touched: list = field(default_factory=list)     # (event, storedItem) pairs whose LastUpdated changed, content didn't
+    unchanged: list = field(default_factory=list)   # (event, storedItem) pairs with nothing new
+    downgraded: list = field(default_factory=list)  # stored items still in the feed, but no longer full closures
+    cleared: list = field(default_factory=list)     # stored items missing from the feed entirely
+    regions: dict = field(default_factory=dict)     # EventID -> region of each new and updated event, once applied
+
+def iter_json_array(chunks):
+    # Incrementally decodes a top-level JSON array from an iterable of byte chunks,
+    # yielding each element as soon as it is complete so the whole body is never held at once
+    decoder = json.JSONDecoder()
+    textDecoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    state = 'start'  # start -> first -> (value <-> after) -> done
+    chunks = iter(chunks)
+    eof = False
+    while state != 'done':
+        while True:
+            # Skip whitespace up to the next token
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if state == 'start':
+                if char != '[':
+                    raise ValueError('Feed is not a JSON array')
+                pos += 1
+                state = 'first'
+            elif state == 'after' or (state == 'first' and char == ']'):
+                if char == ']':
+                    state = 'done'
+                    break
+                if char != ',':
+                    raise ValueError(f'Unexpected {char!r} in feed at offset {pos}')
+                pos += 1
+                state = 'value'
+            else:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    break  # the element is incomplete, wait for more data
+                if end == len(buffer) and not eof:
+                    break  # a bare number may continue in the next chunk
+                pos = end
+                state = 'after'
+                yield value
+        if state == 'done':
+            break
+        if eof:
+            raise ValueError('Feed ended before the JSON array was closed')
+        # Drop what has been consumed and read the next chunk
+        buffer = buffer[pos:]
+        pos = 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buffer += textDecoder.decode(b'', final=True)
         else:
-            # item exists, but now we need to check to see if it's no longer a full closure
-            event = [x for x in data if x['ID']==item['EventID']]
-            if event:
-                if event[0]['IsFullClosure'] is False:
-                    #now it's no longer a full closure - markt it as closed.
-                    markCompleted = True
-        # process relevant completions
-        if markCompleted == True:
-            # Convert float values in the item to Decimal
-            item = float_to_decimal(item)
-            # Remove the isActive attribute from the item
-            table.update_item(
-                Key={'EventID': str(item['EventID'])},
-                UpdateExpression="SET isActive = :val",
-                ExpressionAttributeValues={':val': 0}
-            )
-            # Notify about closure on Discord
-            if 'DetectedPolygon' in item and item['DetectedPolygon'] is not None:
-                post_to_discord_completed(item,item['DetectedPolygon'])
+            buffer += textDecoder.decode(chunk)
+
+def index_feed(events):
+    # Builds a dict of full-closure events keyed by ID, plus the set of every ID in the feed.
+    # Only the fields in FEED_FIELDS are kept, and only for full closures.
+    closures = {}
+    feedIds = set()
+    prefix = get_feed().keyPrefix
+    for event in events:
+        eventID = prefix + str(event['ID'])
+        feedIds.add(eventID)
+        if event['IsFullClosure']:
+            closures[eventID] = {key: event[key] for key in FEED_FIELDS if key in event}
+    return closures, feedIds
+
+def diff_events(closures, feedIds, active_index):
+    # Compares the indexed feed with the active items in one pass over each
+    diff = FeedDiff()
+    for eventID, item in active_index.items():
+        event = closures.get(eventID)
+        if event is None:
+            if eventID in feedIds:
+                diff.downgraded.append(item)
+            else:
+                diff.cleared.append(item)
+            continue
+        lastUpdated = item.get('LastUpdated')
+        # Only items with a stored LastUpdated can be compared for updates
+        if lastUpdated is not None and lastUpdated != to_decimal(event['LastUpdated']):
+            # Items stored before ContentDigest existed have nothing to compare, so they count as changed.
+            # A move counts as a change too, so the item is re-put with its new coordinates and region.
+            if item.get('ContentDigest') == content_digest(event) and not moved(event, item):
+                diff.touched.append((event, item))
             else:
-                post_to_discord_completed(item)
+                diff.updated.append((event, item))
+        else:
+            diff.unchanged.append((event, item))
+    for eventID, event in closures.items():
+        if eventID not in active_index:
+            diff.new.append(event)
+    return diff
+
+def moved(event, item):
+    # Whether a feed event's coordinates differ from its stored item's
+    return any(to_decimal(event.get(name)) != item.get(name) for name in ('Latitude', 'Longitude'))
+
+def close_recent_events(diff, writer=None, lastSeen=None):
+    #function uses the feed diff to determine what we stored in the DB that can now be closed
+    #anything no longer listed in the feed, or no longer a full closure, is marked closed and posted to discord
+    ownWriter = writer is None
+    if ownWriter:
+        writer = get_store().writer()
+    for item in diff.cleared + diff.downgraded:
+        # Queue the item to be marked inactive
+        writer.deactivate(str(item['EventID']))
+        hot_loop_log("Cleared closure %s", item['EventID'])
+        # Notify about closure on Discord
+        if 'DetectedPolygon' in item and item['DetectedPolygon'] is not None:
+            post_to_discord_completed(item,item['DetectedPolygon'],lastSeen)
+        else:
+            post_to_discord_completed(item,lastSeen=lastSeen)
+    if ownWriter:
+        writer.flush()
+
+def load_feed_state():
+    # Reads what the last processed run saw: the feed's ETag/Last-Modified and a fingerprint of its full closures
+    return get_store().get_item(feed_key(FEED_STATE_KEY), get_consistent_read('feed_state')) or {}
+
+def feed_fingerprint(closures):
+    # Stable digest of the full-closure subset of the feed, independent of event order
+    digest = hashlib.sha256()
+    for eventID in sorted(closures):
+        digest.update(json.dumps(closures[eventID], sort_keys=True, separators=(',', ':'), default=str).encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def load_last_seen():
+    # Reads the run-level liveness checkpoint: a dict of EventID -> the last run timestamp that saw it.
+    # Large checkpoints are sharded across LastSeen, LastSeen#1, LastSeen#2...
+    consistentRead = get_consistent_read('last_seen')
+    lastSeenKey = feed_key(LAST_SEEN_KEY)
+    item = get_store().get_item(lastSeenKey, consistentRead)
+    if item is None:
+        return {}
+    lastSeen = dict(item.get('Events', {}))
+    shardCount = int(item.get('Shards', 1))
+    if shardCount > 1:
+        shardKeys = [f"{lastSeenKey}#{i}" for i in range(1, shardCount)]
+        for shard in get_store().get_items(shardKeys, consistentRead):
+            lastSeen.update(shard.get('Events', {}))
+    return lastSeen
+
+def save_last_seen(lastSeen, writer):
+    # Queues the liveness checkpoint as one item, or a few shards when there are many active events
+    eventIDs = sorted(lastSeen)
+    shards = [eventIDs[i:i + LAST_SEEN_SHARD_SIZE] for i in range(0, len(eventIDs), LAST_SEEN_SHARD_SIZE)] or [[]]
+    lastSeenKey = feed_key(LAST_SEEN_KEY)
+    for i, shardIDs in enumerate(shards):
+        item = {
+            'EventID': lastSeenKey if i == 0 else f"{lastSeenKey}#{i}",
+            'RunAt': utc_timestamp,
+            'Events': {eventID: lastSeen[eventID] for eventID in shardIDs}
+        }
+        if i == 0:
+            item['Shards'] = len(shards)
+        writer.put(item)
 
 def cleanup_old_events():
     # Get the current time and subtract 5 days to get the cut-off time
@@ -610,48 +2393,211 @@ def cleanup_old_events():
     cutoff = now - timedelta(days=5)
     # Convert the cutoff time to Unix timestamp
     cutoff_unix = Decimal(str(cutoff.timestamp()))
-    # Initialize the scan parameters
-    scan_params = {
-        'FilterExpression': Attr('LastUpdated').lt(cutoff_unix) & Attr('isActive').eq(0)
-    }
-    while True:
-        # Perform the scan operation
-        response = table.scan(**scan_params)
-        # Iterate over the matching items and delete each one
-        for item in response['Items']:
-            table.delete_item(
-                Key={
-                    'EventID': str(item['EventID'])
-                }
-            )
-        # If the scan returned a LastEvaluatedKey, continue the scan from where it left off
-        if 'LastEvaluatedKey' in response:
-            scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
-        else:
-            # If no LastEvaluatedKey was returned, the scan has completed and we can break from the loop
-            break
+    # Queue every event that closed before the cut-off for deletion
+    store = get_store()
+    writer = store.writer()
+    feed = get_feed()
+    with run_metrics().phase('DBRead'):
+        for eventID in store.expired_events(cutoff_unix):
+            # Each feed cleans up its own events
+            if feed.owns(str(eventID)):
+                writer.delete({'EventID': str(eventID)})
+    with run_metrics().phase('DBWrite'):
+        writer.flush()
 
 def get_last_execution_day():
-    response = table.query(
-        KeyConditionExpression=Key('EventID').eq('LastCleanup')
-    )
-
-    items = response.get('Items')
-    if items:
-        item = items[0]
-        last_execution_day = item.get('LastExecutionDay')
-        return last_execution_day
-
+    item = get_store().get_item(feed_key(LAST_CLEANUP_KEY), get_consistent_read('last_cleanup'))
+    if item:
+        return item.get('LastExecutionDay')
     return None
 
 def update_last_execution_day():
     today = datetime.now().date().isoformat()
-    table.put_item(
-        Item={
-            'EventID': 'LastCleanup',
-            'LastExecutionDay': today
+    get_store().put_item({
+        'EventID': feed_key(LAST_CLEANUP_KEY),
+        'LastExecutionDay': today
+    })
+
+def event_digest(eventJSON):
+    return hashlib.sha256(eventJSON.encode()).hexdigest()[:SNAPSHOT_DIGEST_SIZE]
+
+class SnapshotRecorder:
+    # Appends each fetched feed to a gzipped NDJSON recording. An event's JSON is written once, the first time
+    # that exact content is seen, as {"digest", "event"}; a snapshot is then one line listing its events' digests
+    # in feed order, with the run time and the response's ETag/Last-Modified. Each snapshot is its own gzip
+    # member, so a recording cut short by a crash is still readable up to the last complete snapshot.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.known = set()
+        if os.path.exists(path):
+            for line in read_recording_lines(path):
+                if 'digest' in line:
+                    self.known.add(line['digest'])
+
+    def record(self, events, at, etag=None, lastModified=None):
+        import gzip
+        lines = []
+        digests = []
+        with self.lock:
+            for event in events:
+                eventJSON = json.dumps(event, sort_keys=True, separators=(',', ':'))
+                digest = event_digest(eventJSON)
+                if digest not in self.known:
+                    self.known.add(digest)
+                    lines.append(f'{{"digest":"{digest}","event":{eventJSON}}}')
+                digests.append(digest)
+            lines.append(json.dumps({'snapshot': at, 'etag': etag, 'lastModified': lastModified, 'events': digests}, separators=(',', ':')))
+            with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+
+def get_recorder():
+    # Returns the current feed's snapshot recorder when it has a 'record_path', otherwise None. Feeds listed in
+    # 'feeds' only record with their own record_path, so feeds never share a recording. Replays never record.
+    feed = get_feed()
+    path = (feed.settings if feed.settings is not None else get_config()).get('record_path')
+    if path is None or replay_time is not None:
+        return None
+    if path not in recorders:
+        with init_lock:
+            if path not in recorders:
+                recorders[path] = SnapshotRecorder(path)
+    return recorders[path]
+
+def plain_number(value):
+    # json.dumps default for the Decimals that stored items hold
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Cannot encode {type(value).__name__} as JSON")
+
+def geojson_feature(eventID, record, region):
+    # One closure as a compact GeoJSON Feature, from a feed event or a stored item
+    latitude, longitude = record.get('Latitude'), record.get('Longitude')
+    geometry = None
+    if latitude is not None and longitude is not None:
+        geometry = {'type': 'Point', 'coordinates': [float(longitude), float(latitude)]}
+    properties = {'EventID': eventID, 'DetectedPolygon': region}
+    properties.update((name, record.get(name)) for name in GEOJSON_PROPERTIES)
+    return json.dumps({'type': 'Feature', 'id': eventID, 'geometry': geometry, 'properties': properties},
+                      separators=(',', ':'), default=plain_number)
+
+def iter_feature_collection(features):
+    # Streams a FeatureCollection around already encoded Features
+    yield '{"type":"FeatureCollection","features":['
+    for i, feature in enumerate(features):
+        yield feature if i == 0 else ',' + feature
+    yield ']}'
+
+def write_feature_collection(path, features):
+    # Writes the collection to a temporary file, hashing it on the way, then moves it and its ETag sidecar into
+    # place. Returns the ETag.
+    digest = hashlib.sha256()
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as f:
+        for chunk in iter_feature_collection(features):
+            data = chunk.encode()
+            digest.update(data)
+            f.write(data)
+    etag = f'"{digest.hexdigest()[:32]}"'
+    os.replace(temporary, path)
+    with open(temporary, 'w') as f:
+        f.write(etag)
+    os.replace(temporary, path + GEOJSON_ETAG_SUFFIX)
+    return etag
+
+class LiveGeoJSON:
+    # A FeatureCollection of one feed's active closures, kept in memory as an encoded Feature per EventID and
+    # updated from each run's diff. The file is only rewritten when a Feature changed, and its ETag is written
+    # to a sidecar so whatever serves it can answer conditional requests without reading the file.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.features = {}  # EventID -> encoded Feature
+        self.fingerprint = None  # the feed fingerprint the features match
+        self.loaded = False
+        self.etag = None
+
+    def sync(self, active_index, fingerprint):
+        # Rebuilds the features from the active items unless they already match the run's starting point
+        with self.lock:
+            if self.loaded and self.fingerprint == fingerprint:
+                return
+            self.features = {
+                eventID: geojson_feature(eventID, item, item.get('DetectedPolygon'))
+                for eventID, item in active_index.items()
+            }
+            self.fingerprint = fingerprint
+            self.loaded = True
+            self.etag = None
+
+    def invalidate(self):
+        # Makes the next sync rebuild the features whatever fingerprint it is given
+        with self.lock:
+            self.loaded = False
+
+    def apply(self, diff, fingerprint):
+        # Adds, replaces and removes only the Features the diff touched, then writes the file if any changed
+        with self.lock:
+            changed = 0
+            for item in diff.cleared + diff.downgraded:
+                changed += self.features.pop(item['EventID'], None) is not None
+            updates = [(event, diff.regions[event_key(event)]) for event in diff.new]
+            updates += [(event, diff.regions[event_key(event)]) for event, storedItem in diff.updated]
+            updates += [(event, storedItem.get('DetectedPolygon')) for event, storedItem in diff.touched]
+            for event, region in updates:
+                eventID = event_key(event)
+                feature = geojson_feature(eventID, event, region)
+                if self.features.get(eventID) != feature:
+                    self.features[eventID] = feature
+                    changed += 1
+            self.fingerprint = fingerprint
+            if changed or self.etag is None:
+                try:
+                    self.etag = write_feature_collection(self.path, (self.features[k] for k in sorted(self.features)))
+                except Exception:
+                    # The export is for viewers, so a failed write doesn't fail the run; the next run rebuilds it
+                    logging.exception(f"Failed to write the GeoJSON export {self.path}")
+                    self.loaded = False
+                    return
+                hot_loop_log("GeoJSON export: %d features, %d changed, ETag %s", len(self.features), changed, self.etag)
+
+def get_geojson_export():
+    # Returns the current feed's live GeoJSON export when it has a 'geojson_path', otherwise None. Like
+    # recordings, feeds listed in 'feeds' only export with their own path. Replays never export.
+    feed = get_feed()
+    path = (feed.settings if feed.settings is not None else get_config()).get('geojson_path')
+    if path is None or replay_time is not None:
+        return None
+    if path not in geojson_exports:
+        with init_lock:
+            if path not in geojson_exports:
+                geojson_exports[path] = LiveGeoJSON(path)
+    return geojson_exports[path]
+
+def read_recording_lines(path):
+    # Yields the parsed lines of a recording, stopping quietly at a snapshot that was cut short
+    import gzip
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    yield json.loads(line)
+    except EOFError:
+        logging.warning(f"Recording {path} ends in an incomplete snapshot, which was skipped")
+
+def read_snapshots(path):
+    # Yields each recorded snapshot as a dict of 'at', 'etag', 'lastModified' and 'body', the feed as JSON bytes
+    events = {}  # digest -> the event's JSON
+    for line in read_recording_lines(path):
+        if 'digest' in line:
+            events[line['digest']] = json.dumps(line['event'], separators=(',', ':')).encode()
+            continue
+        yield {
+            'at': line['snapshot'],
+            'etag': line.get('etag'),
+            'lastModified': line.get('lastModified'),
+            'body': b'[' + b','.join(events[digest] for digest in line['events']) + b']'
         }
-    )
 
 def generate_geojson():
     # Create a dictionary to store GeoJSON
@@ -661,10 +2607,7 @@ def generate_geojson():
     }
 
     # Define your polygons and their names
-    polygons = {
-        "Edmonton": polygon_Edmonton,
-        "Calgary": polygon_Calgary
-    }
+    polygons = {name: polygon for name, polygon in get_regions() if name in ("Edmonton", "Calgary")}
 
     # Convert each polygon to GeoJSON format
     for name, polygon in polygons.items():
@@ -689,10 +2632,193 @@ def generate_geojson():
     print("GeoJSON saved as 'polygons.geojson'")
 
 def lambda_handler(event, context):
-    check_and_post_events()
+    # {"drain_outbox": true} only delivers pending notifications, for a schedule of its own
+    if event and event.get('drain_outbox'):
+        drain_feeds()
+        return
+    feeds = get_feeds()
+    if len(feeds) == 1:
+        check_and_post_events()
+        return
+    # Several feeds run side by side; the invocation still fails if any of them did, once the others are done
+    failed = [name for name, result in run_feeds(feeds).items() if isinstance(result, Exception)]
+    if failed:
+        raise Exception(f"Feeds failed: {', '.join(failed)}")
+
+def next_poll_interval(interval, changed):
+    # Polls faster while the full closures are changing and backs off while they are quiet
+    minimum = get_config().get('poll_min_seconds', POLL_MIN_SECONDS)
+    maximum = get_config().get('poll_max_seconds', POLL_MAX_SECONDS)
+    interval = interval / 2 if changed else interval * POLL_BACKOFF
+    return min(max(interval, minimum), maximum)
+
+def checkpoint_poller(state, feed=None):
+    # Writes the in-memory liveness on shutdown, so cleared events get accurate end times after a restart
+    if state.lastSeen is None:
+        return
+    update_utc_timestamp()
+    token = current_feed.set(feed if feed is not None else get_feeds()[0])
+    try:
+        writer = get_store().writer()
+        save_last_seen(state.lastSeen, writer)
+        writer.flush()
+    finally:
+        current_feed.reset(token)
+
+def poll_feeds(feeds, states):
+    # One poll of several feeds. Failures are handled per feed by run_feeds, so this never raises.
+    results = run_feeds(feeds, states)
+    return any(result is True for result in results.values())
+
+async def poll_forever(state=None, stop=None):
+    # Long-running alternative to the scheduled Lambda: polls the feed on an adaptive interval, keeping state in
+    # memory between polls, until SIGTERM or SIGINT. The blocking poll runs on a worker thread so a signal is
+    # handled straight away, and the poll in progress is allowed to finish before shutting down.
+    import asyncio
+    import signal
+    state = state if state is not None else PollerState()
+    stop = stop if stop is not None else asyncio.Event()
+    # With several feeds configured, each keeps its own state and they are polled together
+    feeds = get_feeds()
+    states = {feed.name: PollerState() for feed in feeds} if len(feeds) > 1 else None
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    interval = get_config().get('poll_min_seconds', POLL_MIN_SECONDS)
+    polls = 0
+    try:
+        while not stop.is_set():
+            try:
+                if states is not None:
+                    changed = await asyncio.to_thread(poll_feeds, feeds, states)
+                else:
+                    changed = await asyncio.to_thread(check_and_post_events, state)
+                interval = next_poll_interval(interval, changed)
+            except Exception:
+                logging.exception("Poll failed, state will be reloaded from DynamoDB on the next poll")
+                state.reset()
+                interval = get_config().get('poll_max_seconds', POLL_MAX_SECONDS)
+            polls += 1
+            logging.info(f"Next poll in {interval:.0f}s")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+    logging.info(f"Stopping after {polls} polls")
+    if states is not None:
+        for feed in feeds:
+            await asyncio.to_thread(checkpoint_poller, states[feed.name], feed)
+    else:
+        await asyncio.to_thread(checkpoint_poller, state)
+    for name in list(http_sessions):
+        reset_http_session(name)
+
+class ReplayResponse:
+    # Just enough of a requests.Response for the feed and Discord paths
+    def __init__(self, status_code, body=b'', headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.body = body
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def json(self):
+        return json.loads(self.body)
+
+    def close(self):
+        pass
+
+class ReplaySession:
+    # Stands in for the pooled HTTP sessions during a replay: a GET returns the snapshot being replayed, whatever
+    # the conditional headers say, and Discord posts are counted and dropped
+    def __init__(self):
+        self.snapshot = None
+        self.posts = 0
+
+    def get(self, url, **kwargs):
+        snapshot = self.snapshot
+        return ReplayResponse(200, snapshot['body'], {'ETag': snapshot['etag'], 'Last-Modified': snapshot['lastModified']})
+
+    def post(self, url, **kwargs):
+        self.posts += 1
+        return ReplayResponse(204)
+
+    def close(self):
+        pass
+
+def replay_summary(snapshot, runMetrics, feed):
+    # What one replayed snapshot did: the IDs in each part of the diff, the counts and the phase timings
+    diff = runMetrics.diff
+    record = runMetrics.record()
+    return {
+        'at': snapshot['at'],
+        'outcome': record['Outcome'],
+        'diff': {
+            'new': sorted(str(event['ID']) for event in diff.new),
+            'updated': sorted(str(event['ID']) for event, storedItem in diff.updated),
+            'touched': sorted(str(event['ID']) for event, storedItem in diff.touched),
+            'cleared': sorted(str(item['EventID'])[len(feed.keyPrefix):] for item in diff.cleared + diff.downgraded)
+        } if diff is not None else None,
+        'counts': {name: record[name] for name in ('FeedEvents', 'FullClosures', 'Notifications', 'DiscordMessages')},
+        'timings_ms': {name: record[f'{name}Time'] for name in METRIC_PHASES + ('Total',)}
+    }
+
+def replay(path, storeName='memory', sqlitePath=None, feedName=None):
+    # Runs a recording's snapshots through the real pipeline as fast as it will go, the way the poller would:
+    # state in a local store and in memory, the feed served from the recording, Discord posts dropped, and each
+    # run timed as if it happened when the snapshot was recorded. feedName is the configured feed the recording
+    # was made from, the first one by default. Returns a replay_summary per snapshot.
+    global config, store, replay_time
+    feeds = get_feeds()
+    feed = next((feed for feed in feeds if feed.name == feedName), feeds[0])
+    settings = dict(get_config(), state_store=storeName, emit_metrics=False)
+    if sqlitePath is not None:
+        settings['sqlite_path'] = sqlitePath
+    session = ReplaySession()
+    savedConfig, savedStore = config, store
+    with http_sessions_lock:
+        savedSessions = dict(http_sessions)
+        http_sessions.update({'511': session, 'discord': session})
+    config, store = settings, None
+    state = PollerState()
+    summaries = []
+    try:
+        for snapshot in read_snapshots(path):
+            session.snapshot = snapshot
+            replay_time = snapshot['at']
+            check_and_post_events(state, feed)
+            summaries.append(replay_summary(snapshot, state.lastRun, feed))
+    finally:
+        if hasattr(store, 'close'):
+            store.close()
+        config, store, replay_time = savedConfig, savedStore, None
+        with http_sessions_lock:
+            http_sessions.clear()
+            http_sessions.update(savedSessions)
+    return summaries
 
 if __name__ == "__main__":
-    # Simulate the Lambda environment by passing an empty event and context
-    event = {}
-    context = None
-    lambda_handler(event, context)
+    if '--backfill-index-flags' in sys.argv:
+        backfill_index_flags()
+    elif '--replay' in sys.argv:
+        # python scrape.py --replay recording.ndjson.gz [sqlite-path]: one JSON summary per snapshot
+        arguments = sys.argv[sys.argv.index('--replay') + 1:]
+        sqlitePath = arguments[1] if len(arguments) > 1 else None
+        for summary in replay(arguments[0], 'sqlite' if sqlitePath else 'memory', sqlitePath):
+            print(json.dumps(summary))
+    elif '--drain-outbox' in sys.argv:
+        print(json.dumps(drain_feeds()))
+    elif '--poll' in sys.argv:
+        import asyncio
+        asyncio.run(poll_forever())
+    else:
+        # Simulate the Lambda environment by passing an empty event and context
+        event = {}
+        context = None
+        lambda_handler(event, context)
@@ -6,7 +6,9 @@ from decimal import Decimal
 from freezegun import freeze_time
 from moto import mock_aws
 import boto3
+from boto3.dynamodb.types import TypeDeserializer
 import os
+import time
 
 # Add this before the scrape import
 os.environ['DISCORD_WEBHOOK'] = 'https://mock-discord-webhook.com/test'
@@ -15,7 +17,19 @@ from scrape import (
     check_which_polygon_point, getThreadID, unix_to_readable,
     post_to_discord_closure, post_to_discord_updated, post_to_discord_completed,
     close_recent_events, cleanup_old_events, float_to_decimal,
-    check_and_post_events, generate_geojson
+    check_and_post_events, generate_geojson, load_active_index,
+    index_feed, diff_events, iter_json_array, classify_points,
+    resolve_regions, RegionCache, WriteBatcher, set_active_flags,
+    backfill_index_flags, load_last_seen, save_last_seen,
+    DiscordDispatcher, DiscordRateLimiter, deliver_webhook, EmbedBatcher,
+    feed_fingerprint, get_http_session, execute_webhook, http_session_stats,
+    serialize_item, apply_diff, FeedDiff, ITEM_FIELDS, build_item, content_digest,
+    PollerState, next_poll_interval, poll_forever,
+    DynamoDBStore, SQLiteStore, MemoryStore, get_store,
+    SnapshotRecorder, read_snapshots, replay,
+    get_feeds, run_feeds, load_feed_state, current_feed, shard_of, apply_shards,
+    drain_feeds, OUTBOX_RETRY_BASE_SECONDS, geojson_feature, apply_events, outbox_item, OUTBOX_CLAIM_SECONDS,
+    TOUCH_EXPRESSION
 )
 
 # Load fixture data
@@ -41,13 +55,56 @@ def sample_event(sample_events):
     return sample_events[0]
 
 @pytest.fixture
-def mock_dynamodb_table():
-    with patch('boto3.resource') as mock_boto:
-        mock_table = mock_boto.return_value.Table.return_value
-        # Add common table operations
-        mock_table.query.return_value = {'Items': []}
-        mock_table.scan.return_value = {'Items': []}
-        yield mock_table
+def mock_dynamodb_client():
+    # Every request goes through the plain client, which takes and returns attribute values
+    client = Mock()
+    client.query.return_value = {'Items': []}
+    client.scan.return_value = {'Items': []}
+    client.get_item.return_value = {}
+    client.batch_write_item.return_value = {'UnprocessedItems': {}}
+    with patch('scrape.client', client):
+        yield client
+
+def create_test_table(dynamodb):
+    # Table with the same keys and sparse indexes as production
+    return dynamodb.create_table(
+        TableName='test-db',
+        KeySchema=[{'AttributeName': 'EventID', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'EventID', 'AttributeType': 'S'},
+            {'AttributeName': 'ActiveFlag', 'AttributeType': 'S'},
+            {'AttributeName': 'InactiveFlag', 'AttributeType': 'S'},
+            {'AttributeName': 'LastUpdated', 'AttributeType': 'N'},
+            {'AttributeName': 'OutboxFlag', 'AttributeType': 'S'},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': 'ActiveEvents',
+                'KeySchema': [
+                    {'AttributeName': 'ActiveFlag', 'KeyType': 'HASH'},
+                    {'AttributeName': 'EventID', 'KeyType': 'RANGE'},
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+            },
+            {
+                'IndexName': 'InactiveEvents',
+                'KeySchema': [
+                    {'AttributeName': 'InactiveFlag', 'KeyType': 'HASH'},
+                    {'AttributeName': 'LastUpdated', 'KeyType': 'RANGE'},
+                ],
+                'Projection': {'ProjectionType': 'KEYS_ONLY'},
+            },
+            {
+                'IndexName': 'PendingNotifications',
+                'KeySchema': [
+                    {'AttributeName': 'OutboxFlag', 'KeyType': 'HASH'},
+                    {'AttributeName': 'EventID', 'KeyType': 'RANGE'},
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+            },
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
 
 @pytest.fixture
 def mock_config():
@@ -62,6 +119,22 @@ def mock_config():
         'db_name': 'test-db'
     }
 
+def feed_response(mock_get, *feeds, headers=None):
+    # Makes the patched open_feed answer 200 with each feed's events in turn, then the last one again
+    bodies = [json.dumps(events).encode() for events in feeds]
+    response = mock_get.return_value
+    response.status_code = 200
+    response.ok = True
+    response.headers = headers or {}
+    response.iter_content.side_effect = lambda chunk_size: [bodies.pop(0) if len(bodies) > 1 else bodies[0]]
+    return response
+
+@pytest.fixture(autouse=True)
+def default_config(mock_config):
+    # No test reads config.json from disk: every one runs with mock_config unless it patches in its own
+    with patch('scrape.config', mock_config):
+        yield mock_config
+
 # Polygon Tests
 @pytest.mark.parametrize("coordinates,expected_region", [
     ((53.5461, -113.4938), 'Edmonton'),  # Edmonton city center
@@ -75,6 +148,41 @@ def test_check_which_polygon_point(coordinates, expected_region):
     point = Point(coordinates[0], coordinates[1])
     assert check_which_polygon_point(point) == expected_region
 
+def test_classify_points_matches_per_point():
+    import random
+    from shapely.geometry import Point
+    rng = random.Random(1)
+    points = [(rng.uniform(49, 60), rng.uniform(-120, -110)) for _ in range(500)]
+    points += [(53.5461, -113.4938), (51.0447, -114.0719), (0, 0)]
+    labels = classify_points([p[0] for p in points], [p[1] for p in points])
+    assert labels == [check_which_polygon_point(Point(*p)) for p in points]
+    assert labels[-3:] == ['Edmonton', 'Calgary', 'Other']
+    assert {'NorthOfEdmonton', 'SouthOfEdmonton'} <= set(labels)
+
+def test_classify_points_handles_missing_coordinates():
+    assert classify_points([None, 53.5461], [None, -113.4938]) == ['Other', 'Edmonton']
+    assert classify_points([], []) == []
+
+def test_resolve_regions_reuses_stored_and_cached_regions():
+    edmonton = {'ID': 'E1', 'Latitude': 53.5461, 'Longitude': -113.4938}
+    moved = {'ID': 'E2', 'Latitude': 51.0447, 'Longitude': -114.0719}
+    stored_same = float_to_decimal(dict(edmonton, DetectedPolygon='Stored'))
+    stored_moved = float_to_decimal(dict(moved, Latitude=53.5461, Longitude=-113.4938, DetectedPolygon='Edmonton'))
+
+    with patch('scrape.region_cache', RegionCache(maxsize=2)) as cache:
+        regions = resolve_regions([(edmonton, stored_same), (moved, stored_moved)])
+        # Unchanged coordinates reuse the stored attribute, moved ones are reclassified
+        assert regions == {'E1': 'Stored', 'E2': 'Calgary'}
+        assert cache.stats() == {'stored_hits': 1, 'hits': 0, 'misses': 1, 'size': 1}
+
+        # A repeat lookup for the same event and point comes from the cache
+        assert resolve_regions([(moved, None)]) == {'E2': 'Calgary'}
+        assert cache.hits == 1
+
+        # The cache is bounded
+        resolve_regions([({'ID': f'N{i}', 'Latitude': 0, 'Longitude': 0}, None) for i in range(3)])
+        assert cache.stats()['size'] == 2
+
 # Thread ID Tests
 @pytest.mark.parametrize("region,expected_thread", [
     ('Edmonton', '123456'),
@@ -98,41 +206,218 @@ def test_unix_to_readable(timestamp, expected_time):
     assert unix_to_readable(timestamp) == expected_time
 
 # Discord Posting Tests
-@patch('scrape.DiscordWebhook')
-def test_post_to_discord_closure(mock_webhook, sample_event, mock_config):
+@patch('scrape.get_http_session')
+def test_post_to_discord_closure(mock_session, sample_event, mock_config):
     with patch('scrape.config', mock_config):
         post_to_discord_closure(sample_event, 'Edmonton')
-        mock_webhook.assert_called_once()
-        webhook_instance = mock_webhook.return_value
-        webhook_instance.execute.assert_called_once()
+        mock_session.return_value.post.assert_called_once()
+        payload = mock_session.return_value.post.call_args.kwargs['json']
+        assert payload['thread_id'] == '123456'
+        assert payload['embeds'][0]['title'] == 'Closed'
+        assert [f['name'] for f in payload['embeds'][0]['fields']] == ['Road', 'Direction', 'Information', 'Start Time', 'Planned End Time', 'Links']
 
-@patch('scrape.DiscordWebhook')
-def test_post_to_discord_updated(mock_webhook, sample_event, mock_config):
+@patch('scrape.get_http_session')
+def test_post_to_discord_updated(mock_session, sample_event, mock_config):
     with patch('scrape.config', mock_config):
-        post_to_discord_updated(sample_event, 'Edmonton')
-        mock_webhook.assert_called_once()
-        webhook_instance = mock_webhook.return_value
-        webhook_instance.execute.assert_called_once()
+        post_to_discord_updated(dict(sample_event, Comment=None), 'Edmonton')
+        mock_session.return_value.post.assert_called_once()
+        embed = mock_session.return_value.post.call_args.kwargs['json']['embeds'][0]
+        assert embed['title'] == 'Closure Update'
+        assert 'Comment' not in [f['name'] for f in embed['fields']]
 
-@patch('scrape.DiscordWebhook')
-def test_post_to_discord_completed(mock_webhook, sample_event, mock_config):
+@patch('scrape.get_http_session')
+def test_post_to_discord_completed(mock_session, sample_event, mock_config):
     with patch('scrape.config', mock_config):
         post_to_discord_completed(sample_event, 'Edmonton')
-        mock_webhook.assert_called_once()
-        webhook_instance = mock_webhook.return_value
-        webhook_instance.execute.assert_called_once()
+        mock_session.return_value.post.assert_called_once()
+        embed = mock_session.return_value.post.call_args.kwargs['json']['embeds'][0]
+        assert embed['title'] == 'Cleared'
+        assert embed['fields'][-1]['value'].startswith('[WME](')
+
+@patch('scrape.get_http_session')
+def test_post_to_discord_completed_uses_last_seen(mock_session, sample_event, mock_config):
+    event = dict(sample_event, EventID=sample_event['ID'], lastTouched=1672531200)
+    with patch('scrape.config', mock_config):
+        post_to_discord_completed(event, 'Edmonton', {sample_event['ID']: 1672574400})
+        embed = mock_session.return_value.post.call_args.kwargs['json']['embeds'][0]
+        assert {'name': 'Ended', 'value': unix_to_readable(1672574400), 'inline': True} in embed['fields']
+    assert embed['timestamp'] == datetime.utcfromtimestamp(1672574400).isoformat()
+
+def load_rendered_messages():
+    # Payloads recorded from the DiscordEmbed/DiscordWebhook implementation, for byte for byte comparison
+    with open('tests/fixtures/rendered_messages.json', 'r') as f:
+        return json.load(f)
+
+@pytest.mark.parametrize("case", load_rendered_messages()['cases'])
+def test_rendered_messages_match_recorded_payloads(case, mock_config):
+    event = case['event']
+    if case.get('decimal'):
+        event = {key: Decimal(str(value)) if isinstance(value, float) else value for key, value in event.items()}
+    post = {'closure': post_to_discord_closure, 'updated': post_to_discord_updated, 'completed': post_to_discord_completed}[case['kind']]
+    args = [event, case['threadName']] + ([case['lastSeen']] if 'lastSeen' in case else [])
+    sent = []
+    with patch('scrape.config', mock_config), \
+         patch('scrape.utc_timestamp', load_rendered_messages()['utcTimestamp']), \
+         patch('scrape.send_webhook', sent.append):
+        post(*args)
+    assert json.dumps(sent[0].json) == case['payload']
+
+class FakeWebhook:
+    # Stand-in for DiscordWebhook that records the order messages were sent in
+    def __init__(self, thread_id, label, sent, responses=None, delay=0):
+        self.url = 'https://mock-discord-webhook.com/test'
+        self.thread_id = thread_id
+        self.label = label
+        self.sent = sent
+        self.responses = list(responses or [])
+        self.delay = delay
+
+    def execute(self):
+        if self.delay:
+            import time
+            time.sleep(self.delay)
+        self.sent.append((self.thread_id, self.label))
+        if self.responses:
+            return self.responses.pop(0)
+        return Mock(status_code=204, headers={})
+
+@pytest.fixture
+def fake_execute():
+    with patch('scrape.execute_webhook', side_effect=lambda webhook: webhook.execute()) as mock_execute:
+        yield mock_execute
+
+def test_discord_dispatcher_keeps_per_thread_order(fake_execute):
+    sent = []
+    dispatcher = DiscordDispatcher(maxWorkers=4)
+    for i in range(20):
+        for thread in ('A', 'B', 'C'):
+            dispatcher.submit(FakeWebhook(thread, i, sent, delay=0.001))
+    dispatcher.wait()
+    dispatcher.shutdown()
+
+    assert len(sent) == 60
+    for thread in ('A', 'B', 'C'):
+        assert [label for t, label in sent if t == thread] == list(range(20))
+
+@patch('scrape.time.sleep')
+def test_deliver_webhook_honours_rate_limits(mock_sleep, fake_execute):
+    limited = Mock(status_code=429, headers={'X-RateLimit-Bucket': 'abc'})
+    limited.json.return_value = {'retry_after': 2.5}
+    exhausted = Mock(status_code=204, headers={'X-RateLimit-Bucket': 'abc', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': '1.5'})
+    sent = []
+    webhook = FakeWebhook('A', 'first', sent, [limited, exhausted])
+
+    with patch('scrape.discord_rate_limiter', DiscordRateLimiter()) as limiter:
+        deliver_webhook(webhook)
+        # The 429 was retried after waiting out retry_after
+        assert len(sent) == 2
+        assert limiter.rateLimited == 1 and limiter.retries == 1
+        assert 2.0 < mock_sleep.call_args.args[0] <= 2.5
+
+        # The bucket is now exhausted, so the next message waits for the reset
+        mock_sleep.reset_mock()
+        deliver_webhook(FakeWebhook('A', 'second', sent))
+        assert 1.0 < mock_sleep.call_args.args[0] <= 1.5
+
+def test_embed_batcher_packs_per_thread():
+    batcher = EmbedBatcher()
+    for i in range(23):
+        batcher.add('A', {'title': f'A{i}', 'fields': []}, 1000 - i)
+    batcher.add('B', {'title': 'B-late', 'fields': []}, 2000)
+    batcher.add('B', {'title': 'B-early', 'fields': []}, 1000)
+
+    messages = batcher.pack()
+    assert [(thread, len(embeds)) for thread, embeds in messages] == [('A', 10), ('A', 10), ('A', 3), ('B', 2)]
+    # Ordered by event time within each thread
+    assert messages[0][1][0]['title'] == 'A22'
+    assert [e['title'] for e in messages[3][1]] == ['B-early', 'B-late']
+
+def test_embed_batcher_respects_character_limit():
+    batcher = EmbedBatcher()
+    for i in range(5):
+        embed = {'title': 'Closed', 'fields': [{'name': 'Information', 'value': 'x' * 2500, 'inline': False}]}
+        batcher.add('A', embed, i)
+    assert [len(embeds) for thread, embeds in batcher.pack()] == [2, 2, 1]
+
+@patch('scrape.get_http_session')
+@patch('scrape.open_feed')
+def test_check_and_post_events_batches_embeds(mock_get, mock_session, mock_dynamodb_client, sample_events, mock_config):
+    events = [dict(sample_events[0], ID=f'MTO--{i}', IsFullClosure=True) for i in range(12)]
+    feed_response(mock_get, events)
+
+    with patch('scrape.config', mock_config):
+        check_and_post_events()
+
+    # Twelve closures in the same thread go out as two messages rather than twelve
+    assert mock_session.return_value.post.call_count == 2
+    assert [len(c.kwargs['json']['embeds']) for c in mock_session.return_value.post.call_args_list] == [10, 2]
+
+@patch('scrape.time.sleep')
+@patch('scrape.get_http_session')
+@patch('scrape.open_feed')
+def test_check_and_post_events_emits_one_metrics_record(mock_get, mock_session, mock_sleep, mock_dynamodb_client, sample_events, mock_config, capsys, caplog):
+    events = [dict(sample_events[0], ID=f'MTO--{i}', IsFullClosure=True) for i in range(3)]
+    feed_response(mock_get, events)
+    mock_dynamodb_client.query.return_value = {'Items': [], 'ConsumedCapacity': {'TableName': 'test', 'CapacityUnits': 0.5}}
+    mock_dynamodb_client.batch_write_item.return_value = {
+        'UnprocessedItems': {}, 'ConsumedCapacity': [{'TableName': 'test', 'CapacityUnits': 5.0}]
+    }
+    limited = Mock(status_code=429, headers={})
+    limited.json.return_value = {'retry_after': 0.01}
+    mock_session.return_value.post.side_effect = [limited, Mock(status_code=204, headers={})]
+
+    caplog.set_level('INFO')
+    with patch('scrape.config', mock_config), \
+         patch('scrape.discord_rate_limiter', DiscordRateLimiter()):
+        check_and_post_events()
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    assert len(records) == 1
+    record = records[0]
+    assert record['Outcome'] == 'Processed'
+    assert {m['Name'] for m in record['_aws']['CloudWatchMetrics'][0]['Metrics']} <= set(record)
+    assert record['New'] == 3 and record['Notifications'] == 3 and record['DiscordMessages'] == 1
+    assert record['DiscordRequests'] == 2 and record['DiscordRateLimited'] == 1 and record['DiscordRetries'] == 1
+    # Two batch writes: the items, then the checkpoint and feed state once they are in
+    assert record['DynamoDBReadCapacity'] == 1.0 and record['DynamoDBWriteCapacity'] == 10.0
+    assert record['ParseTime'] > 0 and record['DBWriteTime'] > 0
+    assert all(c.kwargs['ReturnConsumedCapacity'] == 'TOTAL' for c in mock_dynamodb_client.query.call_args_list)
+    # Nothing from inside the run is logged at INFO unless hot_loop_log_level asks for it
+    assert not [r for r in caplog.records if r.levelname == 'INFO']
+
+def test_http_sessions_are_pooled_and_reset_after_errors(mock_config):
+    import requests
+    with patch('scrape.config', mock_config), \
+         patch('scrape.http_sessions', {}):
+        session = get_http_session('discord')
+        assert get_http_session('discord') is session
+        assert session.get_adapter('https://').poolmanager.connection_pool_kw['maxsize'] == 4
+        assert http_session_stats('discord') == {'requests': 0, 'connections': 0}
+
+        webhook = Mock(url='https://mock-discord-webhook.com/test', thread_id='123', json={'embeds': []})
+        with patch.object(session, 'post', side_effect=requests.ConnectionError('reset by peer')):
+            with pytest.raises(requests.ConnectionError):
+                execute_webhook(webhook)
+        # A broken session is replaced on the next use
+        assert get_http_session('discord') is not session
+
+@patch('scrape.load_feed_state', return_value={})
+def test_feed_session_is_reset_when_the_feed_request_fails(mock_state, mock_config):
+    import requests
+    with patch('scrape.config', mock_config), \
+         patch('scrape.http_sessions', {}):
+        session = get_http_session('511')
+        with patch.object(session, 'get', side_effect=requests.exceptions.RetryError('too many 503s')):
+            with pytest.raises(requests.exceptions.RetryError):
+                check_and_post_events()
+        assert get_http_session('511') is not session
 
 # Database Operation Tests
 @mock_aws
 def test_cleanup_old_events(sample_db_items):
     # Create mock DynamoDB table
     dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-    table = dynamodb.create_table(
-        TableName='test-db',
-        KeySchema=[{'AttributeName': 'EventID', 'KeyType': 'HASH'}],
-        AttributeDefinitions=[{'AttributeName': 'EventID', 'AttributeType': 'S'}],
-        BillingMode='PAY_PER_REQUEST'
-    )
+    table = create_test_table(dynamodb)
     
     # Modify items to ensure they're old enough
     old_timestamp = int((datetime.now() - timedelta(days=8)).timestamp())
@@ -142,42 +427,280 @@ def test_cleanup_old_events(sample_db_items):
     
     # Add test items from fixture
     for item in sample_db_items:
-        table.put_item(Item=item)
+        table.put_item(Item=set_active_flags(item, item.get('isActive') == 1))
+    # A recently closed item has to survive the cleanup
+    recent = dict(sample_db_items[0], EventID='MTO--recent', LastUpdated=Decimal(int(datetime.now().timestamp())))
+    table.put_item(Item=set_active_flags(recent, False))
     
-    with patch('scrape.table', table):
+    with patch('scrape.client', boto3.client('dynamodb', region_name='us-east-1')), \
+         patch.object(table, 'scan') as mock_scan:
         cleanup_old_events()
+        # Cleanup reads the inactive index instead of scanning the table
+        mock_scan.assert_not_called()
     
     # Verify old items were deleted
     for item in sample_db_items:
         if item.get('isActive') == 0:
             response = table.get_item(Key={'EventID': item['EventID']})
             assert 'Item' not in response
+    assert 'Item' in table.get_item(Key={'EventID': 'MTO--recent'})
 
 @mock_aws
 def test_close_recent_events(sample_db_items):
     # Setup mock DynamoDB
     dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-    table = dynamodb.create_table(
-        TableName='test-db',
-        KeySchema=[{'AttributeName': 'EventID', 'KeyType': 'HASH'}],
-        AttributeDefinitions=[{'AttributeName': 'EventID', 'AttributeType': 'S'}],
-        BillingMode='PAY_PER_REQUEST'
-    )
+    table = create_test_table(dynamodb)
 
     # Ensure we have an active item
     active_item = sample_db_items[0].copy()
-    active_item['isActive'] = 1
-    table.put_item(Item=active_item)
+    table.put_item(Item=set_active_flags(active_item, True))
 
-    # Mock API response with empty list (no active events)
-    mock_response = Mock()
-    mock_response.text = json.dumps([])  # Empty list means no current events
+    # Empty feed means no current events
+    closures, feedIds = index_feed([])
 
-    with patch('scrape.table', table), \
+    with patch('scrape.client', boto3.client('dynamodb', region_name='us-east-1')), \
          patch('scrape.post_to_discord_completed') as mock_post:
-        close_recent_events(mock_response)
+        close_recent_events(diff_events(closures, feedIds, load_active_index()))
         mock_post.assert_called_once()
 
+    stored = table.get_item(Key={'EventID': active_item['EventID']})['Item']
+    assert stored['isActive'] == 0
+    assert 'ActiveFlag' not in stored and stored['InactiveFlag'] == '1'
+
+def test_diff_events(sample_events):
+    new_event, updated_event, downgraded_event = [dict(e, IsFullClosure=True) for e in sample_events]
+    unchanged_event = dict(new_event, ID='MTO--unchanged')
+    downgraded_event['IsFullClosure'] = False
+
+    def stored(event, **changes):
+        return float_to_decimal(dict(event, EventID=event['ID'], isActive=1) | changes)
+
+    active_index = {
+        updated_event['ID']: stored(updated_event, LastUpdated=updated_event['LastUpdated'] - 60),
+        unchanged_event['ID']: stored(unchanged_event),
+        downgraded_event['ID']: stored(downgraded_event),
+        'MTO--gone': stored(new_event, ID='MTO--gone', EventID='MTO--gone'),
+    }
+    closures, feedIds = index_feed([new_event, updated_event, unchanged_event, downgraded_event])
+    diff = diff_events(closures, feedIds, active_index)
+
+    assert [e['ID'] for e in diff.new] == [new_event['ID']]
+    assert [e['ID'] for e, item in diff.updated] == [updated_event['ID']]
+    assert [e['ID'] for e, item in diff.unchanged] == [unchanged_event['ID']]
+    assert [item['EventID'] for item in diff.downgraded] == [downgraded_event['ID']]
+    assert [item['EventID'] for item in diff.cleared] == ['MTO--gone']
+
+@pytest.mark.parametrize("value", [
+    45.40719, -113.4938, 0.1, 1e-05, 1.5e+16, 1735406520, 0, True, None, 'Highway 2',
+    {'MTO--1': 1700000000, 'nested': {'x': -0.25}}, [1.25, 'a']
+])
+def test_serialize_item_matches_type_serializer(value):
+    from boto3.dynamodb.types import TypeSerializer
+    def as_decimal(v):
+        if isinstance(v, float):
+            return Decimal(str(v))
+        if isinstance(v, dict):
+            return {k: as_decimal(x) for k, x in v.items()}
+        if isinstance(v, list):
+            return [as_decimal(x) for x in v]
+        return v
+    # Same AttributeValue the resource layer sent after the Decimal(str(x)) conversion
+    assert serialize_item({'v': value}) == {'v': TypeSerializer().serialize(as_decimal(value))}
+
+@mock_aws
+@patch('scrape.post_to_discord_closure')
+def test_apply_diff_stores_slim_items(mock_post, sample_events, mock_config):
+    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+    table = create_test_table(dynamodb)
+    event = dict(sample_events[0], IsFullClosure=True)
+    closures, feedIds = index_feed([event])
+
+    with patch('scrape.client', boto3.client('dynamodb', region_name='us-east-1')), \
+         patch('scrape.config', mock_config):
+        apply_diff(FeedDiff(new=list(closures.values())), closures).flush()
+        index = load_active_index()
+
+    # The notification gets the full event, the table only the schema's fields
+    assert mock_post.call_args.args[0]['Comment'] == event['Comment']
+    stored = table.get_item(Key={'EventID': event['ID']})['Item']
+    assert set(stored) == set(ITEM_FIELDS) - {'InactiveFlag'}
+    assert stored['Latitude'] == Decimal(str(event['Latitude']))
+    assert index[event['ID']] == stored
+
+@pytest.mark.parametrize("changes,expected", [
+    ({}, 'touched'),
+    ({'Comment': 'Detour via Highway 2'}, 'updated'),
+    ({'PlannedEndDate': None}, 'updated'),
+    ({'Latitude': 51.0447, 'Longitude': -114.0719}, 'updated'),
+])
+def test_diff_events_compares_content_digest(sample_events, changes, expected):
+    event = dict(sample_events[0], IsFullClosure=True)
+    stored = float_to_decimal(build_item(event, 'Edmonton') | {'LastUpdated': event['LastUpdated'] - 60})
+    closures, feedIds = index_feed([dict(event, **changes)])
+    diff = diff_events(closures, feedIds, {stored['EventID']: stored})
+    assert [e['ID'] for e, item in getattr(diff, expected)] == [event['ID']]
+
+@mock_aws
+@patch('scrape.post_to_discord_updated')
+def test_apply_diff_touches_items_with_unchanged_content(mock_post, sample_events, mock_config):
+    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+    table = create_test_table(dynamodb)
+    event = dict(sample_events[0], IsFullClosure=True)
+    table.put_item(Item=float_to_decimal(build_item(event, 'Edmonton')))
+    bumped = dict(event, LastUpdated=event['LastUpdated'] + 600)
+    closures, feedIds = index_feed([bumped])
+
+    with patch('scrape.client', boto3.client('dynamodb', region_name='us-east-1')), \
+         patch('scrape.config', mock_config):
+        diff = diff_events(closures, feedIds, load_active_index())
+        apply_diff(diff, closures).flush()
+
+    mock_post.assert_not_called()
+    stored = table.get_item(Key={'EventID': event['ID']})['Item']
+    assert stored['LastUpdated'] == bumped['LastUpdated']
+    assert stored['ContentDigest'] == content_digest(event)
+
+@mock_aws
+def test_write_batcher_coalesces_writes(sample_db_items):
+    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+    table = create_test_table(dynamodb)
+    for i in range(30):
+        table.put_item(Item=dict(sample_db_items[0], EventID=f'OLD-{i}', isActive=1))
+
+    writer = WriteBatcher(table.name, boto3.client('dynamodb', region_name='us-east-1'))
+    for i in range(60):
+        writer.put(dict(sample_db_items[0], EventID=f'NEW-{i}', isActive=1))
+    for i in range(10):
+        writer.delete({'EventID': f'OLD-{i}'})
+    for i in range(10, 30):
+        writer.deactivate(f'OLD-{i}')
+    writer.flush()
+
+    # 70 puts/deletes in 3 batches, 20 deactivations in one transaction
+    assert writer.requests == 4
+    assert table.get_item(Key={'EventID': 'NEW-59'})['Item']['isActive'] == 1
+    assert 'Item' not in table.get_item(Key={'EventID': 'OLD-0'})
+    assert table.get_item(Key={'EventID': 'OLD-29'})['Item']['isActive'] == 0
+
+@patch('scrape.time.sleep')
+def test_write_batcher_retries_unprocessed_items(mock_sleep):
+    client = Mock()
+    unprocessed = {'test-db': [{'DeleteRequest': {'Key': {'EventID': {'S': 'A'}}}}]}
+    client.batch_write_item.side_effect = [
+        {'UnprocessedItems': unprocessed},
+        {'UnprocessedItems': {}},
+    ]
+    writer = WriteBatcher('test-db', client)
+    writer.delete({'EventID': 'A'})
+    writer.delete({'EventID': 'B'})
+    writer.flush()
+
+    assert client.batch_write_item.call_args_list[1].kwargs['RequestItems'] == unprocessed
+    mock_sleep.assert_called_once()
+
+def test_write_batcher_falls_back_when_transaction_cancelled():
+    from botocore.exceptions import ClientError
+    client = Mock()
+    client.transact_write_items.side_effect = ClientError(
+        {'Error': {'Code': 'TransactionCanceledException', 'Message': 'cancelled'}}, 'TransactWriteItems')
+    writer = WriteBatcher('test-db', client)
+    writer.deactivate('A')
+    writer.deactivate('B')
+    writer.flush()
+    assert sorted(c.kwargs['Key']['EventID']['S'] for c in client.update_item.call_args_list) == ['A', 'B']
+
+def test_write_batcher_puts_attached_items_in_their_events_transaction():
+    from botocore.exceptions import ClientError
+    client = Mock()
+    client.batch_write_item.return_value = {'UnprocessedItems': {}}
+    writer = WriteBatcher('test-db', client)
+    for i in range(60):
+        writer.put({'EventID': f'E-{i}'})
+        writer.put_with(f'E-{i}', {'EventID': f'Outbox#{i}'})
+    writer.deactivate('C')
+    writer.put_with('C', {'EventID': 'Outbox#C'})
+    writer.put({'EventID': 'Plain'})
+    writer.flush()
+    # Two actions an event, so 50 events fill a transaction
+    transactions = [c.kwargs['TransactItems'] for c in client.transact_write_items.call_args_list]
+    assert [len(actions) for actions in transactions] == [100, 22]
+    assert transactions[0][:2] == [
+        {'Put': {'TableName': 'test-db', 'Item': {'EventID': {'S': 'E-0'}}}},
+        {'Put': {'TableName': 'test-db', 'Item': {'EventID': {'S': 'Outbox#0'}}}},
+    ]
+    assert transactions[1][-2]['Update']['Key'] == {'EventID': {'S': 'C'}}
+    [batch] = client.batch_write_item.call_args_list
+    assert batch.kwargs['RequestItems'] == {'test-db': [{'PutRequest': {'Item': {'EventID': {'S': 'Plain'}}}}]}
+
+    # A cancelled transaction is retried an event at a time, never splitting an event from its items
+    client.reset_mock()
+    cancelled = ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'cancelled'}}, 'TransactWriteItems')
+    client.transact_write_items.side_effect = [cancelled, None, None]
+    for i in range(2):
+        writer.put({'EventID': f'E-{i}'})
+        writer.put_with(f'E-{i}', {'EventID': f'Outbox#{i}'})
+    writer.flush()
+    assert [len(c.kwargs['TransactItems']) for c in client.transact_write_items.call_args_list] == [4, 2, 2]
+    assert not client.update_item.called
+
+def test_write_batcher_sends_touches_as_plain_updates():
+    client = Mock()
+    writer = WriteBatcher('test-db', client)
+    writer.deactivate('A')
+    for i in range(20):
+        writer.touch(f'T-{i}', 1700000000 + i, 1700000100)
+    writer.flush()
+    # Deactivations share a transaction; touches are single updates at one write unit each
+    [transaction] = client.transact_write_items.call_args_list
+    assert [action['Update']['Key'] for action in transaction.kwargs['TransactItems']] == [{'EventID': {'S': 'A'}}]
+    touched = {c.kwargs['Key']['EventID']['S']: c.kwargs for c in client.update_item.call_args_list}
+    assert set(touched) == {f'T-{i}' for i in range(20)}
+    assert touched['T-3']['UpdateExpression'] == TOUCH_EXPRESSION
+    assert touched['T-3']['ExpressionAttributeValues'] == {':updated': {'N': '1700000003'}, ':touched': {'N': '1700000100'}}
+    assert writer.requests == 21
+
+@mock_aws
+@patch('scrape.LAST_SEEN_SHARD_SIZE', 4)
+def test_last_seen_checkpoint_round_trip():
+    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+    table = create_test_table(dynamodb)
+    lastSeen = {f'EVT-{i}': 1700000000 + i for i in range(10)}
+
+    with patch('scrape.client', boto3.client('dynamodb', region_name='us-east-1')):
+        writer = WriteBatcher(table.name)
+        save_last_seen(lastSeen, writer)
+        writer.flush()
+        # Ten events in shards of four is three items, written in a single batch
+        assert writer.requests == 1
+        assert load_last_seen() == lastSeen
+
+        writer = WriteBatcher(table.name)
+        save_last_seen({}, writer)
+        writer.flush()
+        assert load_last_seen() == {}
+
+@patch('scrape.open_feed')
+@patch('scrape.post_to_discord_closure')
+def test_check_and_post_events_checkpoints_once(mock_post, mock_get, mock_dynamodb_client, sample_events, mock_config):
+    for event in sample_events:
+        event['IsFullClosure'] = True
+    feed_response(mock_get, sample_events)
+    stored = [set_active_flags(float_to_decimal(dict(e, EventID=e['ID'])), True) for e in sample_events]
+    mock_dynamodb_client.query.side_effect = lambda **kwargs: {
+        'Items': [serialize_item(item) for item in stored] if kwargs.get('IndexName') == 'ActiveEvents' else []
+    }
+
+    with patch('scrape.config', mock_config):
+        check_and_post_events()
+
+    # Nothing changed, so the only batched writes are the LastSeen checkpoint and the feed state
+    mock_dynamodb_client.update_item.assert_not_called()
+    batch = mock_dynamodb_client.batch_write_item.call_args.kwargs['RequestItems']
+    [writes] = batch.values()
+    items = {w['PutRequest']['Item']['EventID']['S']: TypeDeserializer().deserialize({'M': w['PutRequest']['Item']}) for w in writes}
+    assert set(items) == {'LastSeen', 'FeedState'}
+    assert set(items['LastSeen']['Events']) == {e['ID'] for e in sample_events}
+
 # Utility Function Tests
 def test_float_to_decimal(sample_event):
     result = float_to_decimal(sample_event)
@@ -192,27 +715,669 @@ def test_float_to_decimal(sample_event):
                     assert isinstance(result[key][nested_key], Decimal)
 
 # Main Function Test
-@patch('scrape.requests.get')
+@patch('scrape.open_feed')
 @patch('scrape.post_to_discord_closure')
-def test_check_and_post_events(mock_post, mock_get, mock_dynamodb_table, sample_events):
+def test_check_and_post_events(mock_post, mock_get, mock_dynamodb_client, sample_events, mock_config):
     # Modify sample event to ensure it triggers a post
     sample_events[0]['IsFullClosure'] = True
     
     # Mock API response
-    mock_get.return_value.ok = True
-    mock_get.return_value.text = json.dumps(sample_events)
+    feed_response(mock_get, sample_events)
     
     # Mock the database query to return no existing items
-    mock_dynamodb_table.query.return_value = {'Items': []}
+    mock_dynamodb_client.query.return_value = {'Items': []}
     
-    with patch('scrape.table', mock_dynamodb_table), \
-         patch('scrape.config', mock_config):
+    with patch('scrape.config', mock_config):
         # Test the main function
         check_and_post_events()
         
         # Verify Discord post was called for new events
         assert mock_post.call_count > 0
 
+@patch('scrape.open_feed')
+@patch('scrape.post_to_discord_updated')
+@patch('scrape.post_to_discord_closure')
+def test_check_and_post_events_uses_active_index(mock_closure, mock_updated, mock_get, mock_dynamodb_client, sample_events, mock_config):
+    for event in sample_events:
+        event['IsFullClosure'] = True
+    feed_response(mock_get, sample_events)
+
+    # The first event is already stored and unchanged
+    stored = float_to_decimal(dict(sample_events[0], EventID=sample_events[0]['ID'], isActive=1, lastTouched=int(datetime.now().timestamp())))
+    mock_dynamodb_client.query.side_effect = lambda **kwargs: {
+        'Items': [serialize_item(stored)] if kwargs.get('IndexName') == 'ActiveEvents' else []
+    }
+
+    with patch('scrape.config', mock_config):
+        check_and_post_events()
+
+    # The cleanup page and one page of the active index; events are matched against the index
+    assert [c.kwargs.get('IndexName') for c in mock_dynamodb_client.query.call_args_list] == ['InactiveEvents', 'ActiveEvents']
+    # FeedState, LastCleanup and LastSeen are single-item reads
+    assert [c.kwargs['Key']['EventID']['S'] for c in mock_dynamodb_client.get_item.call_args_list] == ['FeedState', 'LastCleanup', 'LastSeen']
+    mock_dynamodb_client.scan.assert_not_called()
+    assert mock_closure.call_count == len(sample_events) - 1
+    mock_updated.assert_not_called()
+
+@mock_aws
+@pytest.mark.parametrize("consistent", [False, True])
+def test_load_active_index_paginates(sample_db_items, mock_config, consistent):
+    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+    table = create_test_table(dynamodb)
+    for i in range(30):
+        item = dict(sample_db_items[0], EventID=f'EVT-{i}')
+        table.put_item(Item=set_active_flags(item, i % 2 == 1))
+
+    mock_config['consistent_reads'] = {'active_index': consistent}
+    # Force several pages so the whole index has to be read
+    client = boto3.client('dynamodb', region_name='us-east-1')
+    real_query = client.query
+    with patch('scrape.client', client), \
+         patch('scrape.config', mock_config), \
+         patch.object(client, 'query', side_effect=lambda **kwargs: real_query(Limit=7, **kwargs)) as mock_query:
+        index = load_active_index()
+
+    assert set(index) == {f'EVT-{i}' for i in range(30) if i % 2}
+    assert mock_query.call_count > 1
+    assert all(c.kwargs['IndexName'] == 'ActiveEvents' for c in mock_query.call_args_list)
+
+@mock_aws
+def test_backfill_index_flags(sample_db_items):
+    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+    table = create_test_table(dynamodb)
+    for i, item in enumerate(sample_db_items):
+        table.put_item(Item=dict(item, isActive=i % 2))
+
+    with patch('scrape.client', boto3.client('dynamodb', region_name='us-east-1')):
+        backfill_index_flags()
+        assert set(load_active_index(consistentRead=False)) == {
+            item['EventID'] for i, item in enumerate(sample_db_items) if i % 2
+        }
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_iter_json_array_streams_chunks(sample_events, chunk_size):
+    sample_events[0]['Description'] = 'Fermé – détour ⛔'
+    body = json.dumps(sample_events, ensure_ascii=False, indent=2).encode('utf-8')
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    assert list(iter_json_array(chunks)) == sample_events
+
+def test_iter_json_array_rejects_truncated_feed(sample_events):
+    body = json.dumps(sample_events).encode()
+    with pytest.raises(ValueError):
+        list(iter_json_array([body[:-10]]))
+    assert list(iter_json_array([b' [ ] '])) == []
+
+def test_index_feed_keeps_only_full_closure_fields(sample_events):
+    sample_events[1]['IsFullClosure'] = True
+    closures, feedIds = index_feed(iter_json_array([json.dumps(sample_events).encode()]))
+    assert feedIds == {e['ID'] for e in sample_events}
+    assert list(closures) == [sample_events[1]['ID']]
+    assert 'LinkId' not in closures[sample_events[1]['ID']]
+    assert closures[sample_events[1]['ID']]['Latitude'] == sample_events[1]['Latitude']
+
+def test_feed_fingerprint_ignores_order(sample_events):
+    closures, feedIds = index_feed(dict(e, IsFullClosure=True) for e in sample_events)
+    reordered, feedIds = index_feed(dict(e, IsFullClosure=True) for e in reversed(sample_events))
+    assert feed_fingerprint(closures) == feed_fingerprint(reordered)
+    closures[sample_events[0]['ID']]['Comment'] = 'changed'
+    assert feed_fingerprint(closures) != feed_fingerprint(reordered)
+
+@patch('scrape.open_feed')
+def test_check_and_post_events_stops_on_not_modified(mock_get, mock_dynamodb_client, mock_config):
+    mock_dynamodb_client.get_item.return_value = {'Item': serialize_item({
+        'EventID': 'FeedState', 'ETag': '"abc"', 'CheckedAt': int(time.time())
+    })}
+    mock_get.return_value.status_code = 304
+
+    with patch('scrape.config', mock_config):
+        check_and_post_events()
+
+    assert mock_get.call_args.kwargs['headers']['If-None-Match'] == '"abc"'
+    assert 'gzip' in mock_get.call_args.kwargs['headers']['Accept-Encoding']
+    # A single read, and no other DynamoDB work
+    mock_dynamodb_client.get_item.assert_called_once()
+    mock_dynamodb_client.query.assert_not_called()
+    mock_dynamodb_client.batch_write_item.assert_not_called()
+
+@pytest.mark.parametrize("checked_ago,processed", [(60, False), (600, True)])
+@patch('scrape.open_feed')
+@patch('scrape.post_to_discord_closure')
+def test_check_and_post_events_skips_unchanged_closures(mock_post, mock_get, mock_dynamodb_client, sample_events, mock_config, checked_ago, processed):
+    sample_events[0]['IsFullClosure'] = True
+    closures, feedIds = index_feed(json.loads(json.dumps(sample_events)))
+    mock_dynamodb_client.get_item.return_value = {'Item': serialize_item({
+        'EventID': 'FeedState', 'Fingerprint': feed_fingerprint(closures),
+        'CheckedAt': int(time.time()) - checked_ago
+    })}
+    feed_response(mock_get, sample_events)
+
+    with patch('scrape.config', mock_config):
+        check_and_post_events()
+
+    # A matching fingerprint ends the run, unless the heartbeat is due
+    assert mock_dynamodb_client.query.called == processed
+    assert mock_dynamodb_client.batch_write_item.called == processed
+    assert ('If-None-Match' in mock_get.call_args.kwargs['headers']) is False
+
+@pytest.fixture(params=['dynamodb', 'sqlite', 'memory'])
+def state_store(request, tmp_path):
+    # Each backend, empty, installed as the module's store
+    if request.param == 'dynamodb':
+        with mock_aws():
+            table = create_test_table(boto3.resource('dynamodb', region_name='us-east-1'))
+            with patch('scrape.client', boto3.client('dynamodb', region_name='us-east-1')), \
+                 patch('scrape.store', DynamoDBStore()) as store:
+                yield store
+    elif request.param == 'sqlite':
+        store = SQLiteStore(str(tmp_path / 'state.db'))
+        with patch('scrape.store', store):
+            yield store
+        store.close()
+    else:
+        with patch('scrape.store', MemoryStore()) as store:
+            yield store
+
+def test_state_store_contract(state_store, sample_events):
+    events = [dict(e, IsFullClosure=True) for e in sample_events]
+    writer = state_store.writer()
+    for i, event in enumerate(events):
+        writer.put(build_item(event, 'Edmonton') | {'LastUpdated': 1000 + i})
+    writer.put({'EventID': 'LastSeen', 'Events': {'A': 1}, 'Shards': 1})
+    writer.flush()
+
+    active = state_store.load_active()
+    assert set(active) == {e['ID'] for e in events}
+    assert active[events[0]['ID']]['Latitude'] == Decimal(str(events[0]['Latitude']))
+
+    writer.deactivate(events[0]['ID'])
+    writer.deactivate(events[1]['ID'])
+    writer.touch(events[2]['ID'], 5000, 6000)
+    writer.flush()
+    assert set(state_store.load_active()) == {events[2]['ID']}
+    touched = state_store.get_item(events[2]['ID'])
+    assert (touched['LastUpdated'], touched['lastTouched']) == (5000, 6000)
+    # Only inactive events older than the cutoff expire
+    assert list(state_store.expired_events(Decimal(1001))) == [events[0]['ID']]
+
+    writer.delete({'EventID': events[0]['ID']})
+    writer.flush()
+    assert state_store.get_item(events[0]['ID']) is None
+    assert [item['EventID'] for item in state_store.get_items([events[1]['ID'], 'missing'])] == [events[1]['ID']]
+    state_store.put_item({'EventID': 'LastCleanup', 'LastExecutionDay': '2024-01-01'})
+    assert state_store.get_item('LastCleanup')['LastExecutionDay'] == '2024-01-01'
+    assert state_store.get_item('LastSeen')['Events'] == {'A': 1}
+
+@pytest.mark.parametrize("name,expected", [('memory', MemoryStore), ('sqlite', SQLiteStore), ('dynamodb', DynamoDBStore)])
+def test_get_store_follows_config(tmp_path, mock_config, name, expected):
+    mock_config.update(state_store=name, sqlite_path=str(tmp_path / 'state.db'))
+    with patch('scrape.config', mock_config), \
+         patch('scrape.store', None):
+        assert isinstance(get_store(), expected)
+    mock_config['state_store'] = 'postgres'
+    with patch('scrape.config', mock_config), \
+         patch('scrape.store', None):
+        with pytest.raises(Exception, match='Unknown state_store'):
+            get_store()
+
+@patch('scrape.open_feed')
+@patch('scrape.post_to_discord_completed')
+@patch('scrape.post_to_discord_closure')
+def test_check_and_post_events_with_sqlite_store(mock_closure, mock_completed, mock_get, tmp_path, sample_events, mock_config):
+    events = [dict(e, IsFullClosure=True) for e in sample_events]
+    feed_response(mock_get, events, events[1:])
+    store = SQLiteStore(str(tmp_path / 'state.db'))
+
+    with patch('scrape.store', store), \
+         patch('scrape.config', mock_config):
+        check_and_post_events()
+        check_and_post_events()
+        assert set(load_active_index()) == {e['ID'] for e in events[1:]}
+        assert load_last_seen().keys() == {e['ID'] for e in events[1:]}
+    assert mock_closure.call_count == len(events)
+    mock_completed.assert_called_once()
+    store.close()
+
+@pytest.mark.parametrize("interval,changed,expected", [(60, True, 30), (20, True, 15), (60, False, 90), (100, False, 120)])
+def test_next_poll_interval(mock_config, interval, changed, expected):
+    with patch('scrape.config', mock_config):
+        assert next_poll_interval(interval, changed) == expected
+
+@mock_aws
+@patch('scrape.open_feed')
+@patch('scrape.post_to_discord_completed')
+@patch('scrape.post_to_discord_closure')
+def test_poller_keeps_state_in_memory(mock_closure, mock_completed, mock_get, sample_events, mock_config):
+    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+    table = create_test_table(dynamodb)
+    events = [dict(e, IsFullClosure=True) for e in sample_events]
+    feed_response(mock_get, events, events, events[1:])
+    state = PollerState()
+
+    client = boto3.client('dynamodb', region_name='us-east-1')
+    real_query, real_get_item = client.query, client.get_item
+    with patch('scrape.client', client), \
+         patch('scrape.config', mock_config), \
+         patch.object(client, 'query', side_effect=real_query) as mock_query, \
+         patch.object(client, 'get_item', side_effect=real_get_item) as mock_get_item:
+        assert check_and_post_events(state) is True
+        reads = mock_query.call_count + mock_get_item.call_count
+        # The same feed again is recognised from memory, without touching DynamoDB
+        assert check_and_post_events(state) is False
+        # A change is diffed against the in-memory index
+        assert check_and_post_events(state) is True
+        assert mock_query.call_count + mock_get_item.call_count == reads
+        # and matches what was written
+        assert state.active_index == load_active_index()
+
+    assert mock_closure.call_count == len(events)
+    mock_completed.assert_called_once()
+    assert set(state.active_index) == {e['ID'] for e in events[1:]}
+
+@patch('scrape.checkpoint_poller')
+@patch('scrape.check_and_post_events')
+def test_poll_forever_stops_cleanly_on_sigterm(mock_check, mock_checkpoint, mock_config):
+    import asyncio
+    import signal
+    polls = []
+    def poll(state):
+        polls.append(state)
+        if len(polls) == 2:
+            os.kill(os.getpid(), signal.SIGTERM)
+        return False
+    mock_check.side_effect = poll
+    mock_config['poll_min_seconds'] = 0.01
+
+    with patch('scrape.config', mock_config):
+        asyncio.run(poll_forever())
+
+    assert len(polls) == 2 and polls[0] is polls[1]
+    mock_checkpoint.assert_called_once_with(polls[0])
+
+@patch('scrape.open_feed')
+def test_recorder_stores_each_event_once(mock_get, tmp_path, sample_events, mock_config):
+    import gzip
+    path = str(tmp_path / 'feed.ndjson.gz')
+    feed_response(mock_get, sample_events, headers={'ETag': '"v1"'})
+    mock_config['record_path'] = path
+
+    with patch('scrape.config', mock_config), \
+         patch('scrape.store', MemoryStore()), \
+         patch('scrape.recorders', {}):
+        check_and_post_events()
+    # A second recorder picks up where the first left off, so unchanged events aren't written again
+    SnapshotRecorder(path).record(sample_events[1:] + [dict(sample_events[0], Comment='Changed')], 1735000060)
+
+    with gzip.open(path, 'rt') as f:
+        lines = [json.loads(line) for line in f]
+    assert len([line for line in lines if 'digest' in line]) == len(sample_events) + 1
+    snapshots = list(read_snapshots(path))
+    assert [s['etag'] for s in snapshots] == ['"v1"', None]
+    assert json.loads(snapshots[0]['body']) == sample_events
+    assert [e['ID'] for e in json.loads(snapshots[1]['body'])] == [e['ID'] for e in sample_events[1:] + sample_events[:1]]
+
+def test_replay_runs_recording_locally(tmp_path, sample_events, mock_config):
+    path = str(tmp_path / 'feed.ndjson.gz')
+    events = [dict(e, IsFullClosure=True) for e in sample_events]
+    recorder = SnapshotRecorder(path)
+    recorder.record(events, 1735000000, '"1"')
+    recorder.record(events[1:], 1735000060, '"2"')
+    recorder.record(events[1:], 1735000120, '"3"')
+
+    with patch('scrape.config', mock_config), \
+         patch('requests.Session.request', side_effect=AssertionError('replay must not reach the network')):
+        summaries = replay(path)
+
+    assert [s['at'] for s in summaries] == [1735000000, 1735000060, 1735000120]
+    assert summaries[0]['diff']['new'] == sorted(e['ID'] for e in events)
+    assert summaries[1]['diff']['cleared'] == [events[0]['ID']]
+    # The third snapshot has the same closures, so the run stops after the fingerprint check
+    assert summaries[2]['outcome'] == 'Unchanged' and summaries[2]['diff'] is None
+    assert summaries[0]['counts']['Notifications'] == len(events)
+    assert set(summaries[0]['timings_ms']) >= {'Parse', 'Diff', 'Total'}
+
+def test_run_feeds_runs_feeds_side_by_side(sample_events, mock_config):
+    import requests
+    events = [dict(e, IsFullClosure=True) for e in sample_events]
+    mock_config['feeds'] = [
+        {'name': 'AB', 'url': 'https://511.alberta.ca/api/v2/get/event', 'regions': 'alberta',
+         'threads': {'Edmonton': 'ab-edmonton', 'CatchAll': 'ab-all'}},
+        {'name': 'ON', 'url': 'https://511on.ca/api/v2/get/event', 'key_prefix': 'ON#', 'timezone': 'US/Eastern',
+         'threads': {'CatchAll': 'on-all'}},
+        {'name': 'BC', 'url': 'https://broken.invalid/api/v2/get/event', 'key_prefix': 'BC#', 'threads': {'CatchAll': 'bc'}},
+    ]
+    posts = []
+    fetchSeconds = 0.4
+
+    class FakeSession:
+        def get(self, url, **kwargs):
+            time.sleep(fetchSeconds)
+            if 'broken' in url:
+                raise requests.ConnectionError('feed is down')
+            return Mock(status_code=200, ok=True, headers={}, iter_content=Mock(return_value=[json.dumps(events).encode()]))
+
+        def post(self, url, json=None, params=None, timeout=None):
+            posts.append((params['thread_id'], json['embeds'][-1]['fields'][-1]['value']))
+            return Mock(status_code=204, headers={})
+
+    store = MemoryStore()
+    with patch('scrape.config', mock_config), \
+         patch('scrape.store', store), \
+         patch('scrape.get_http_session', return_value=FakeSession()):
+        feeds = get_feeds()
+        start = time.perf_counter()
+        results = run_feeds(feeds)
+        elapsed = time.perf_counter() - start
+        # The same event IDs from two feeds are kept apart, and each feed only sees its own events
+        token = current_feed.set(feeds[0])
+        assert set(load_active_index()) == {e['ID'] for e in events}
+        current_feed.reset(token)
+        token = current_feed.set(feeds[1])
+        assert set(load_active_index()) == {f"ON#{e['ID']}" for e in events}
+        assert load_feed_state()['EventID'] == 'ON#FeedState'
+        current_feed.reset(token)
+
+    # One broken feed doesn't stop the others, and the feeds were fetched at the same time
+    assert results['AB'] is True and results['ON'] is True
+    assert isinstance(results['BC'], requests.ConnectionError)
+    assert elapsed < fetchSeconds * len(feeds)
+    assert {thread for thread, links in posts} == {'ab-all', 'on-all'}
+    assert all(('511on.ca/map#' in links) == (thread == 'on-all') for thread, links in posts)
+
+@freeze_time("2025-01-01 12:00:00", tz_offset=0)
+@pytest.mark.parametrize("outbox", [False, True])
+@patch('scrape.open_feed')
+def test_sharded_run_matches_unsharded_run(mock_get, sample_events, mock_config, outbox):
+    events = [dict(sample_events[i % len(sample_events)], ID=f'TEST-{i}', IsFullClosure=True) for i in range(40)]
+    changed = [dict(event, LastUpdated=event['LastUpdated'] + 60, Comment=f'Changed {i}') for i, event in enumerate(events[10:30])]
+
+    def run(shards):
+        # Two runs: everything new, then some events updated, some cleared and some left alone
+        feed_response(mock_get, events, changed + events[30:])
+        posts = []
+        session = Mock()
+        session.post.side_effect = lambda url, json=None, params=None, timeout=None: posts.extend(
+            (params['thread_id'], embed['title'], embed['description']) for embed in json['embeds']) or Mock(status_code=204, headers={})
+        store = MemoryStore()
+        with patch('scrape.config', dict(mock_config, shards=shards, outbox=outbox)), \
+             patch('scrape.store', store), \
+             patch('scrape.get_http_session', return_value=session):
+            check_and_post_events()
+            check_and_post_events()
+        return store.items, sorted(posts)
+
+    # Shards come from the EventID alone, the same in every process
+    assert [shard_of(f'TEST-{i}', 4) for i in range(6)] == [0, 2, 0, 2, 1, 3]
+    assert len({shard_of(event['ID'], 4) for event in events}) == 4
+    with patch('scrape.apply_shards', side_effect=apply_shards) as mock_shards:
+        sharded = run(4)
+    assert mock_shards.call_count == 2
+    assert len(sharded[1]) == len(events) + len(changed) + 10
+    assert sharded == run(1)
+
+@freeze_time("2025-01-01 12:00:00", tz_offset=0)
+@pytest.mark.parametrize("outbox", [False, True])
+@patch('scrape.open_feed')
+def test_failed_shard_leaves_nothing_stored_or_posted(mock_get, sample_events, mock_config, outbox):
+    events = [dict(sample_events[i % len(sample_events)], ID=f'TEST-{i}', IsFullClosure=True) for i in range(40)]
+    feed_response(mock_get, events)
+    session = Mock()
+    session.post.return_value = Mock(status_code=204, ok=True, headers={})
+    store = MemoryStore()
+
+    def failing_shard(diff, writer, lastSeen, active_index=None):
+        # The shard holding TEST-1 fails after posting and queueing its own events
+        apply_events(diff, writer, lastSeen, active_index)
+        if 'TEST-1' in {event['ID'] for event in diff.new}:
+            raise Exception('Shard failed')
+
+    with patch('scrape.config', dict(mock_config, shards=4, outbox=outbox)), \
+         patch('scrape.store', store), \
+         patch('scrape.get_http_session', return_value=session):
+        with patch('scrape.apply_events', side_effect=failing_shard):
+            with pytest.raises(Exception, match='Shard failed'):
+                check_and_post_events()
+        # The other shards finished, but none of their writes or notifications went out
+        assert set(store.items) == {'LastCleanup'}
+        assert not session.post.called
+
+        # The next run picks up every event
+        assert check_and_post_events() is True
+    assert set(store.load_active()) == {e['ID'] for e in events}
+    assert sum(len(c.kwargs['json']['embeds']) for c in session.post.call_args_list) == len(events)
+
+@patch('scrape.open_feed')
+def test_outbox_keeps_state_writes_apart_from_delivery(mock_get, state_store, sample_events, mock_config):
+    events = [dict(e, IsFullClosure=True) for e in sample_events]
+    feed_response(mock_get, events)
+    session = Mock()
+
+    def outbox():
+        return {item['EventID']: item for item in state_store.load_outbox('Outbox#')}
+
+    with freeze_time("2025-01-01 12:00:00", tz_offset=0) as frozen, \
+         patch('scrape.config', dict(mock_config, outbox=True)), \
+         patch('scrape.get_http_session', return_value=session):
+        # Discord is down: the run still stores its state, and the notifications wait in the outbox
+        session.post.return_value = Mock(status_code=500, ok=False, headers={})
+        assert check_and_post_events() is True
+        assert set(load_active_index()) == {e['ID'] for e in events}
+        pending = outbox()
+        assert len(pending) == len(events)
+        assert all(item['Attempts'] == 1 for item in pending.values())
+        failedPosts = session.post.call_count
+
+        # Nothing is due before the backoff runs out
+        session.post.return_value = Mock(status_code=204, ok=True, headers={})
+        frozen.tick(OUTBOX_RETRY_BASE_SECONDS - 1)
+        assert drain_feeds() == {'AB': 0}
+        frozen.tick(1)
+        assert drain_feeds() == {'AB': failedPosts}
+        assert outbox() == {}
+    posted = [embed for call in session.post.call_args_list[failedPosts:] for embed in call.kwargs['json']['embeds']]
+    assert len(posted) == len(events)
+
+@freeze_time("2025-01-01 12:00:00", tz_offset=0)
+@patch('scrape.open_feed')
+def test_failed_notifications_are_posted_by_the_next_run(mock_get, state_store, sample_events, mock_config):
+    # More closures than fit in one message, so the run sends several
+    events = [dict(sample_events[i % len(sample_events)], ID=f'TEST-{i}', IsFullClosure=True) for i in range(25)]
+    feed_response(mock_get, events)
+    outage = {'down': True}
+    posts = []
+
+    def post(url, json=None, params=None, timeout=None):
+        # While down, Discord refuses the first message it is sent
+        if outage['down'] and not outage.get('refused'):
+            outage['refused'] = json['embeds']
+            return Mock(status_code=500, ok=False, headers={})
+        posts.extend(json['embeds'])
+        return Mock(status_code=204, ok=True, headers={})
+
+    session = Mock()
+    session.post.side_effect = post
+    with patch('scrape.get_http_session', return_value=session):
+        with pytest.raises(Exception, match='HTTP 500'):
+            check_and_post_events()
+        # The events that were announced are stored; the others, the checkpoint and the feed state are not
+        stored = set(load_active_index())
+        assert 0 < len(stored) == len(posts) < len(events)
+        assert load_feed_state() == {}
+        assert state_store.get_item('LastSeen') is None
+
+        # Discord is back: the next run posts only what the failed messages carried
+        outage['down'] = False
+        assert check_and_post_events() is True
+        assert posts[-len(outage['refused']):] == outage['refused']
+        assert len(posts) == len(events)
+        assert set(load_active_index()) == {e['ID'] for e in events}
+        assert load_feed_state()['Fingerprint']
+
+@freeze_time("2025-01-01 12:00:00", tz_offset=0)
+@patch('scrape.open_feed')
+def test_outbox_items_land_with_their_events_writes(mock_get, state_store, sample_events, mock_config):
+    events = [dict(sample_events[i % len(sample_events)], ID=f'TEST-{i}', IsFullClosure=True) for i in range(25)]
+    feed_response(mock_get, events)
+    session = Mock()
+    session.post.return_value = Mock(status_code=204, ok=True, headers={})
+
+    def flush_in_turn(writers):
+        # moto copies the table for each transaction, so shards flushing side by side would trip over each other
+        for writer in writers:
+            writer.flush()
+
+    def failing_flush(writers):
+        # The state flush fails after the first shard's writes are in
+        writers[0].flush()
+        raise Exception('State flush failed')
+
+    with patch('scrape.config', dict(mock_config, outbox=True, shards=4)), \
+         patch('scrape.get_http_session', return_value=session):
+        with patch('scrape.flush_writers', side_effect=failing_flush):
+            with pytest.raises(Exception, match='State flush failed'):
+                check_and_post_events()
+        # Only the stored events have their notifications in the outbox, and nothing was delivered
+        stored = set(load_active_index())
+        assert 0 < len(stored) < len(events)
+        assert len(state_store.load_outbox('Outbox#')) == len(stored)
+        assert load_feed_state() == {}
+        assert not session.post.called
+
+        # The next run stores and announces the rest, and every event is posted once
+        with patch('scrape.flush_writers', side_effect=flush_in_turn):
+            assert check_and_post_events() is True
+    assert set(load_active_index()) == {e['ID'] for e in events}
+    assert state_store.load_outbox('Outbox#') == []
+    posted = [embed for call in session.post.call_args_list for embed in call.kwargs['json']['embeds']]
+    assert len(posted) == len(events)
+
+@patch('scrape.open_feed')
+def test_outbox_delivers_to_numeric_thread_ids(mock_get, state_store, sample_events, mock_config):
+    events = [dict(e, IsFullClosure=True) for e in sample_events]
+    feed_response(mock_get, events)
+    # Thread IDs written in config.json as numbers rather than strings
+    config = dict(mock_config, outbox=True, **{name: int(value) for name, value in mock_config.items() if name.startswith('Thread-')})
+    encode = json.dumps
+    posts = []
+
+    def post(url, json=None, params=None, timeout=None):
+        # Encoded as requests would, so a Decimal anywhere in the message fails here
+        body = encode(json)
+        if not posts:
+            posts.append(None)
+            return Mock(status_code=500, ok=False, headers={})
+        posts.append(body)
+        return Mock(status_code=204, ok=True, headers={})
+
+    session = Mock()
+    session.post.side_effect = post
+    with freeze_time("2025-01-01 12:00:00", tz_offset=0) as frozen, \
+         patch('scrape.config', config), \
+         patch('scrape.get_http_session', return_value=session):
+        assert check_and_post_events() is True
+        pending = state_store.load_outbox('Outbox#')
+        assert {item['ThreadID'] for item in pending} == {'567890'}
+        # An item written before thread IDs were stored as strings still goes out
+        legacy = outbox_item(123456, {'title': 'Legacy'}, 0, 0, 'closure#LEGACY')
+        state_store.put_item(dict(legacy, ThreadID=Decimal(123456), NextAttemptAt=0))
+        frozen.tick(OUTBOX_RETRY_BASE_SECONDS)
+        # Only the first message failed, so all but it count as delivered
+        assert drain_feeds() == {'AB': 2}
+        assert state_store.load_outbox('Outbox#') == []
+    assert sorted(json.loads(body)['thread_id'] for body in posts[1:]) == ['123456', '567890']
+
+@freeze_time("2025-01-01 12:00:00", tz_offset=0)
+def test_outbox_items_are_claimed_before_sending(state_store, mock_config):
+    item = dict(outbox_item('123456', {'title': 'Closed'}, 0, 0, 'closure#TEST-1'), NextAttemptAt=1735732800)
+    session = Mock()
+    session.post.return_value = Mock(status_code=204, ok=True, headers={})
+    with patch('scrape.config', mock_config), \
+         patch('scrape.get_http_session', return_value=session):
+        state_store.put_item(item)
+        # Only one of two drains that loaded the item at the same time gets to claim it
+        leaseUntil = item['NextAttemptAt'] + OUTBOX_CLAIM_SECONDS
+        assert state_store.claim(item['EventID'], item['NextAttemptAt'], leaseUntil) is True
+        assert state_store.claim(item['EventID'], item['NextAttemptAt'], leaseUntil) is False
+        assert state_store.claim('Outbox#missing', item['NextAttemptAt'], leaseUntil) is False
+        assert drain_feeds() == {'AB': 0}
+        assert not session.post.called
+        # A claim that is never released runs out, and the item is delivered by a later drain
+        with freeze_time("2025-01-01 12:05:00", tz_offset=0):
+            assert drain_feeds() == {'AB': 1}
+    assert session.post.call_count == 1
+    assert state_store.load_outbox('Outbox#') == []
+
+@patch('scrape.open_feed')
+@patch('scrape.post_to_discord_completed')
+@patch('scrape.post_to_discord_updated')
+@patch('scrape.post_to_discord_closure')
+def test_geojson_export_follows_each_diff(mock_closure, mock_updated, mock_completed, mock_get, tmp_path, sample_events, mock_config):
+    import hashlib
+    events = [dict(e, IsFullClosure=True) for e in sample_events]
+    changed = dict(events[1], LastUpdated=events[1]['LastUpdated'] + 60, Description='Reopened to one lane')
+    feed_response(mock_get, events, [changed, events[2]])
+    path = tmp_path / 'closures.geojson'
+
+    with patch('scrape.config', dict(mock_config, geojson_path=str(path))), \
+         patch('scrape.store', MemoryStore()), \
+         patch('scrape.geojson_exports', {}) as exports:
+        check_and_post_events()
+        first = json.loads(path.read_text())
+        assert [feature['id'] for feature in first['features']] == sorted(e['ID'] for e in events)
+        # Only the features the second run's diff touched are encoded again
+        with patch('scrape.geojson_feature', side_effect=geojson_feature) as mock_feature:
+            check_and_post_events()
+        assert mock_feature.call_count == 1
+        exporter = exports[str(path)]
+
+    body = path.read_bytes()
+    collection = json.loads(body)
+    assert collection['type'] == 'FeatureCollection'
+    byID = {feature['id']: feature for feature in collection['features']}
+    assert set(byID) == {events[1]['ID'], events[2]['ID']}
+    assert byID[events[1]['ID']]['properties']['Description'] == 'Reopened to one lane'
+    assert byID[events[1]['ID']]['geometry']['coordinates'] == [events[1]['Longitude'], events[1]['Latitude']]
+    assert all(feature['properties']['DetectedPolygon'] for feature in collection['features'])
+    # Written compactly, with the ETag of exactly those bytes next to it
+    assert b'\n' not in body and b'": ' not in body
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    assert (tmp_path / 'closures.geojson.etag').read_text() == etag == exporter.etag
+
+@freeze_time("2025-01-01 12:00:00", tz_offset=0)
+@patch('scrape.open_feed')
+def test_geojson_export_is_rebuilt_after_a_partly_written_run(mock_get, tmp_path, sample_events, mock_config):
+    events = [dict(sample_events[i % len(sample_events)], ID=f'TEST-{i}', IsFullClosure=True) for i in range(25)]
+    feed_response(mock_get, events)
+    path = tmp_path / 'closures.geojson'
+    session = Mock()
+    # Discord refuses the first message of the first run, whose other events are stored anyway
+    session.post.side_effect = [Mock(status_code=500, ok=False, headers={})] + [Mock(status_code=204, ok=True, headers={})] * 10
+    store = MemoryStore()
+
+    with patch('scrape.config', dict(mock_config, geojson_path=str(path))), \
+         patch('scrape.store', store), \
+         patch('scrape.geojson_exports', {}), \
+         patch('scrape.get_http_session', return_value=session):
+        with pytest.raises(Exception, match='HTTP 500'):
+            check_and_post_events()
+        assert 0 < len(store.load_active()) < len(events)
+        # The next run only posts the refused events, but the export still gets every stored closure
+        assert check_and_post_events() is True
+
+    assert len(store.load_active()) == len(events)
+    assert sorted(feature['id'] for feature in json.loads(path.read_text())['features']) == sorted(e['ID'] for e in events)
+
+def test_import_defers_heavy_modules_and_config(tmp_path):
+    import subprocess
+    import sys
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # Run from an empty directory, so importing must not need config.json either
+    result = subprocess.run(
+        [sys.executable, '-c',
+         "import sys, scrape; print(sorted(m for m in ('boto3', 'shapely', 'numpy', 'discord_webhook', 'pytz') if m in sys.modules))"],
+        cwd=tmp_path, env=dict(os.environ, PYTHONPATH=root), capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == '[]'
+
 # Error Handling Tests
 def test_check_which_polygon_point_invalid_input():
     from shapely.geometry import Point
@@ -220,18 +1385,13 @@ def test_check_which_polygon_point_invalid_input():
     assert check_which_polygon_point(point) == 'Other'
 
 @mock_aws
-@patch('scrape.requests.get')
+@patch('scrape.open_feed')
 def test_check_and_post_events_api_error(mock_get):
     # Set up mock DynamoDB table
     dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-    table = dynamodb.create_table(
-        TableName='test-db',
-        KeySchema=[{'AttributeName': 'EventID', 'KeyType': 'HASH'}],
-        AttributeDefinitions=[{'AttributeName': 'EventID', 'AttributeType': 'S'}],
-        BillingMode='PAY_PER_REQUEST'
-    )
+    table = create_test_table(dynamodb)
     
-    with patch('scrape.table', table):
+    with patch('scrape.client', boto3.client('dynamodb', region_name='us-east-1')):
         mock_get.return_value.ok = False
         with pytest.raises(Exception, match='Issue connecting to AB511 API'):
             check_and_post_events()
\ No newline at end of file